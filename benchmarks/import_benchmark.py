@@ -0,0 +1,111 @@
+# import_benchmark.py
+#
+# Measures how long it takes to import the modules of the entry points
+# (measurementScript.py and calibrationScript.py) before the first window can
+# appear. Every measurement runs in a fresh Python process, so nothing is
+# cached. Heavy dependencies (matplotlib, scipy, pandas, sounddevice, keyboard,
+# nidaqmx) must only be imported when the feature that needs them is used;
+# the benchmark fails when one of them is imported at startup or when an entry
+# point takes longer than the budget.
+#
+# Run from the root of the toolbox:
+#   python -m benchmarks.import_benchmark --output import_results.json
+
+# %% imports
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+# %% Settings
+
+# modules imported by the entry points before their first window
+ENTRY_POINTS = {
+    "measurementScript": ["measurement_toolbox.GUI_tools",
+                          "measurement_toolbox.measurement",
+                          "measurement_toolbox.sources",
+                          "measurement_toolbox.storage",
+                          "measurement_toolbox.utils"],
+    "calibrationScript": ["measurement_toolbox.calibration",
+                          "measurement_toolbox.utils"],
+}
+
+HEAVY_MODULES = ("matplotlib", "scipy", "pandas", "sounddevice", "keyboard", "nidaqmx")
+
+# seconds, the settings GUI should be up well under a second
+BUDGET = 0.5
+
+IMPORT_CODE = """
+import json, sys, time
+timeStart = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed = time.perf_counter() - timeStart
+print(json.dumps({{"time": elapsed,
+                  "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+# %% Benchmark
+
+
+def time_imports(modules, repeats=5):
+
+    code = IMPORT_CODE.format(modules=modules, heavy=HEAVY_MODULES)
+    times = []
+    heavy = set()
+    for repeat in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                                text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result["time"])
+        heavy.update(result["heavy"])
+
+    return {"median": float(np.median(times)), "max": float(np.max(times)),
+            "heavyModules": sorted(heavy)}
+
+
+def run_benchmarks(repeats=5, budget=BUDGET):
+
+    results = {}
+    failures = []
+    for entryPoint, modules in ENTRY_POINTS.items():
+        result = time_imports(modules, repeats)
+        results[entryPoint] = result
+        print(f"{entryPoint}: {1e3 * result['median']:.0f} ms "
+              f"(max {1e3 * result['max']:.0f} ms)")
+
+        if result["heavyModules"]:
+            failures.append(f"{entryPoint} imports {', '.join(result['heavyModules'])} at startup")
+        if result["median"] > budget:
+            failures.append(f"{entryPoint} takes {result['median']:.2f} s, "
+                            f"the budget is {budget:.2f} s")
+
+    return {"python": sys.version.split()[0], "budget": budget,
+            "results": results, "failures": failures}
+
+
+def main(arguments=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the entry points.")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=BUDGET,
+                        help="maximum median import time in seconds")
+    args = parser.parse_args(arguments)
+
+    report = run_benchmarks(args.repeats, args.budget)
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+        print(f"Results saved as '{args.output}'")
+
+    for failure in report["failures"]:
+        print(f"FAIL: {failure}")
+    if report["failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+# pipeline_benchmark.py
+#
+# Benchmarks the measurement pipeline without hardware or a display. All
+# signals come from a SimulatedSource with a fixed seed, figures are drawn
+# with the Agg backend. For 2, 4 and 8 channels at several sample rates it
+# measures:
+#   - acquisition: throughput of the read loop (read, ring buffer, journal)
+#   - detection: samples per second of the PeakDetector (one frame per block),
+#     with the low-pass filter and the adaptive threshold as in a trial
+#   - rendering: frame time percentiles of the live raw-signal plot
+#   - latency: time from a movement reversal until the feedback bar is drawn,
+#     with acquisition and visualisation running in real time; the delay of
+#     the low-pass filter (part of this latency) is reported with it
+#
+# Run from the root of the toolbox:
+#   python -m benchmarks.pipeline_benchmark --output benchmark_results.json
+
+# %% imports
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+import os
+
+import matplotlib
+matplotlib.use("Agg")  # noqa: E402, before pyplot is imported
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+from measurement_toolbox.buffers import SampleBuffer
+from measurement_toolbox.detection import NOISE_WINDOW, PeakDetector, adaptive_threshold, slope_lag
+from measurement_toolbox.filters import LowPassFilter
+from measurement_toolbox.live_plot import LiveSignalPlot
+from measurement_toolbox.sources import SimulatedSource
+from measurement_toolbox.storage import TrialWriter
+
+# %% Settings
+
+CHANNEL_COUNTS = (2, 4, 8)
+SAMPLE_FREQUENCIES = (300, 1000, 2000)
+SAMPLES_PER_READ = 5
+FRAME_INTERVAL = 0.05
+FILTER_CUTOFF = 10.0  # Hz, as in MeasurementDAQ.startMeasuring
+BASELINE_DURATION = 2.0  # s
+LINE_STYLES = ['b-', 'r-', 'g-', 'm-', 'c-', 'y-', 'k-', 'b--']
+
+
+def percentiles(values):
+
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {"n": 0}
+
+    return {"n": len(values),
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+            "p99": float(np.percentile(values, 99)),
+            "max": float(np.max(values))}
+
+
+def simulated_source(nChannels, realTime):
+
+    # movements of 1.5 Hz with an amplitude of 1 V, quantized like a 14-bit ADC
+    return SimulatedSource(nChannels, frequency=1.5, amplitude=1.0, noise=0.002,
+                           resolution=20 / 2**14, realTime=realTime, seed=1)
+
+
+def online_detector(nChannels, sampleFrequency):
+
+    # the detector of OnlineAnalysis: low-pass filter and a threshold per
+    # channel from a baseline at rest (before the start of a trial)
+    slopeLag = slope_lag(sampleFrequency)
+    prefilter = LowPassFilter(nChannels, sampleFrequency, FILTER_CUTOFF)
+
+    rest = SimulatedSource(nChannels, amplitude=0.0, noise=0.002,
+                           resolution=20 / 2**14, seed=2)
+    rest.configure(sampleFrequency, slopeLag)
+    rest.start()
+    baseline = rest.signal(np.arange(int(BASELINE_DURATION * sampleFrequency)))
+    threshold, noise = adaptive_threshold(baseline, prefilter, slopeLag,
+                                          round(NOISE_WINDOW * sampleFrequency))
+
+    detector = PeakDetector(nChannels, threshold, slopeLag=slopeLag, prefilter=prefilter)
+    return detector, {"threshold": threshold.tolist(),
+                      "filterDelay": prefilter.delay / sampleFrequency}
+
+# %% Benchmarks
+
+
+def bench_acquisition(nChannels, sampleFrequency, duration=10.0):
+
+    # the body of MeasurementDAQ.data_acquisition without waiting for the device
+    nSamples = int(duration * sampleFrequency)
+    source = simulated_source(nChannels, realTime=False)
+    samples = SampleBuffer(nChannels)
+
+    with tempfile.TemporaryDirectory() as folder:
+        writer = TrialWriter(os.path.join(folder, "trial_1.trial"), {},
+                             [f"dataAI{channel}" for channel in range(nChannels)])
+        data = np.zeros((nChannels, SAMPLES_PER_READ))
+
+        with source:
+            source.configure(sampleFrequency, SAMPLES_PER_READ)
+            source.start()
+            timeStart = time.perf_counter()
+            for read in range(nSamples // SAMPLES_PER_READ):
+                source.read(data)
+                samples.write(data)
+                writer.put(data)
+            elapsed = time.perf_counter() - timeStart
+            source.stop()
+
+        writer.close({}, wait=True)
+
+    return {"samplesPerSecond": nSamples / elapsed,
+            "readsPerSecond": nSamples / SAMPLES_PER_READ / elapsed,
+            "droppedBlocks": writer.droppedBlocks}
+
+
+def bench_detector(nChannels, sampleFrequency, duration=60.0):
+
+    samplesPerFrame = slope_lag(sampleFrequency)
+    source = simulated_source(nChannels, realTime=False)
+    source.configure(sampleFrequency, samplesPerFrame)
+    source.start()
+    channelData = source.signal(np.arange(int(duration * sampleFrequency)))
+
+    detector, settings = online_detector(nChannels, sampleFrequency)
+    blockTimes = []
+    nCycles = 0
+    for start in range(0, channelData.shape[1], samplesPerFrame):
+        timeStart = time.perf_counter()
+        result = detector.process(channelData[:, start:start + samplesPerFrame])
+        blockTimes.append(time.perf_counter() - timeStart)
+        nCycles += len(result.amplitudes)
+
+    return {"samplesPerSecond": channelData.shape[1] / sum(blockTimes),
+            "blockTime": percentiles(blockTimes),
+            "cycles": nCycles,
+            **settings}
+
+
+def bench_render(nChannels, sampleFrequency, nFrames=200):
+
+    samplesPerFrame = slope_lag(sampleFrequency)
+    plotWindow = 100 * samplesPerFrame
+    source = simulated_source(nChannels, realTime=False)
+    source.configure(sampleFrequency, samplesPerFrame)
+    source.start()
+    channelData = source.signal(np.arange(plotWindow + nFrames * samplesPerFrame))
+
+    livePlot = LiveSignalPlot(nChannels, sampleFrequency, plotWindow, LINE_STYLES)
+    frameTimes = []
+    for frame in range(nFrames):
+        windowStart = frame * samplesPerFrame
+        windowData = channelData[:, windowStart:windowStart + plotWindow]
+        peaks = [[windowStart + plotWindow // 2]] * nChannels
+
+        timeStart = time.perf_counter()
+        livePlot.update(windowData, windowStart, peaks)
+        frameTimes.append(time.perf_counter() - timeStart)
+
+    plt.close(livePlot.fig)
+
+    # the first frame includes the full draw that caches the background
+    return {"firstFrame": frameTimes[0], "frameTime": percentiles(frameTimes[1:])}
+
+
+def bench_latency(nChannels, sampleFrequency, duration=5.0):
+
+    # acquisition in a thread and visualisation in the main thread, like
+    # MeasurementDAQ.startMeasuring, both in real time
+    samplesPerFrame = slope_lag(sampleFrequency)
+    plotWindow = 100 * samplesPerFrame
+    source = simulated_source(nChannels, realTime=True)
+    samples = SampleBuffer(nChannels)
+    running = threading.Event()
+    running.set()
+
+    def acquisition():
+        data = np.zeros((nChannels, SAMPLES_PER_READ))
+        with source:
+            source.configure(sampleFrequency, SAMPLES_PER_READ)
+            source.start()
+            while running.is_set():
+                source.read(data)
+                samples.write(data)
+            source.stop()
+
+    acquisitionThread = threading.Thread(target=acquisition, daemon=True)
+    acquisitionThread.start()
+
+    detector, settings = online_detector(nChannels, sampleFrequency)
+    livePlot = LiveSignalPlot(nChannels, sampleFrequency, plotWindow, LINE_STYLES)
+    feedbackFigure, feedbackAxes = plt.subplots()
+    feedbackBars = [feedbackAxes.plot([], [], lw=5, c='red')[0] for channel in range(nChannels)]
+    reader = samples.reader()
+
+    latencies = []
+    timeEnd = time.perf_counter() + duration
+    while time.perf_counter() < timeEnd:
+        newData = reader.read()
+        result = detector.process(newData)
+
+        windowStart = max(0, reader.position - plotWindow)
+        livePlot.update(samples.get(windowStart, reader.position), windowStart,
+                        [[]] * nChannels)
+
+        if len(result.amplitudes):
+            for channel, amplitude in zip(result.cycleChannels, result.amplitudes):
+                feedbackBars[channel].set_data([0, 1], [amplitude, amplitude])
+            feedbackFigure.canvas.draw()
+            shownTime = time.perf_counter()
+
+            # the reversal was measured when its sample was acquired
+            reversalTimes = source.startTime + (result.cycleIndices + 1) / sampleFrequency
+            latencies.extend(shownTime - reversalTimes)
+
+        time.sleep(FRAME_INTERVAL)
+
+    running.clear()
+    acquisitionThread.join()
+    plt.close(livePlot.fig)
+    plt.close(feedbackFigure)
+
+    # the reversal times are corrected for the filter delay, so the latencies
+    # include it
+    return {**percentiles(latencies), "filterDelay": settings["filterDelay"]}
+
+# %% Run all benchmarks
+
+
+def git_commit():
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(channelCounts=CHANNEL_COUNTS, sampleFrequencies=SAMPLE_FREQUENCIES,
+                   latencyDuration=5.0):
+
+    results = []
+    for nChannels in channelCounts:
+        for sampleFrequency in sampleFrequencies:
+            print(f"{nChannels} channels, {sampleFrequency} Hz")
+            result = {"nChannels": nChannels, "sampleFrequency": sampleFrequency}
+            result["acquisition"] = bench_acquisition(nChannels, sampleFrequency)
+            result["detection"] = bench_detector(nChannels, sampleFrequency)
+            result["rendering"] = bench_render(nChannels, sampleFrequency)
+            if latencyDuration:
+                result["latency"] = bench_latency(nChannels, sampleFrequency,
+                                                  latencyDuration)
+            results.append(result)
+
+            print(f"  acquisition {result['acquisition']['samplesPerSecond']:.0f} samples/s, "
+                  f"detection {result['detection']['samplesPerSecond']:.0f} samples/s, "
+                  f"frame time p95 {1e3 * result['rendering']['frameTime']['p95']:.2f} ms, "
+                  f"filter delay {1e3 * result['detection']['filterDelay']:.1f} ms")
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "matplotlib": matplotlib.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def main(arguments=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the measurement pipeline.")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="JSON file for the results")
+    parser.add_argument("--channels", type=int, nargs="+", default=CHANNEL_COUNTS)
+    parser.add_argument("--rates", type=int, nargs="+", default=SAMPLE_FREQUENCIES)
+    parser.add_argument("--latency-duration", type=float, default=5.0,
+                        help="seconds of real-time latency measurement (0 to skip)")
+    args = parser.parse_args(arguments)
+
+    report = run_benchmarks(args.channels, args.rates, args.latency_duration)
+    with open(args.output, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+
+    print(f"Results saved as '{args.output}'")
+
+
+if __name__ == "__main__":
+    main()
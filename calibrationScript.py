@@ -6,15 +6,20 @@ from measurement_toolbox.utils import check_nidaqmx_connected
 
 
 # %% Input values
-# Choose which potentiometer you want to calibrate.
-channel = 1  # Can either be 1 or 0
+# Choose which potentiometers you want to calibrate.
+channels = [0, 1]  # Can be 0, 1 or both ([0, 1]) in one run
 
 # Choose start value, stop value and increments of calibration
 start = 0
 stop = 5
 increment = 0.5
 
+# Every set point is the mean of a burst of samples (the SD is saved as well)
+burstSamples = 500
+burstFrequency = 1000  # Hz
+
 # %% Run calibration
 
 check_nidaqmx_connected()  # check nidaqmx device connected
-start_calibrating(channel, start, stop, increment)
+start_calibrating(channels, start, stop, increment,
+                  burstSamples=burstSamples, burstFrequency=burstFrequency)
@@ -0,0 +1,17 @@
+# convertTrialsScript.py
+
+# %% imports
+from measurement_toolbox.storage import convert_json_trials
+
+
+# %% Input values
+# Folder with one subfolder per participant containing trial_N.json files
+measurementFolder = "measurement_files"
+
+# Remove the trial_N.json files after they are converted and checked
+removeJson = False
+
+# %% Convert trials
+
+convertedTrials = convert_json_trials(measurementFolder, removeJson)
+print(f"{len(convertedTrials)} trial(s) converted")
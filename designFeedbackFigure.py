@@ -18,6 +18,10 @@ maxAmplitude = 5  # Maximum Feedback Amplitude
 targetSize = 0.5  # Target Amplitude Height
 feedbackBarSize = 5  # Feedback Bar Height
 
+# "matplotlib" shows the feedback figure, "qt" the Qt feedback window
+# (feedbackRenderer in measurementScript.py)
+feedbackRenderer = "matplotlib"
+
 # %% data visualisation function
 
 
@@ -79,6 +83,17 @@ def data_visualisation(left_target_A, right_target_A, maxAmplitude,
 
 
 # %% Plot feedback Figure
-data_visualisation(leftTargetAmplitude, rightTargetAmplitude,
-                   maxAmplitude, minAmplitude,
-                   targetSize, feedbackBarSize)
+if feedbackRenderer == "qt":
+    from measurement_toolbox.feedback_window import FeedbackWindow
+
+    feedbackWindow = FeedbackWindow(leftTargetAmplitude, rightTargetAmplitude,
+                                    minAmplitude, maxAmplitude,
+                                    targetSize, feedbackBarSize)
+    feedbackWindow.set_amplitude(0, rightTargetAmplitude)
+    feedbackWindow.set_amplitude(1, leftTargetAmplitude)
+    feedbackWindow.draw()
+    feedbackWindow.app.exec()
+else:
+    data_visualisation(leftTargetAmplitude, rightTargetAmplitude,
+                       maxAmplitude, minAmplitude,
+                       targetSize, feedbackBarSize)
@@ -3,21 +3,65 @@
 # imports
 from measurement_toolbox.GUI_tools import GeneralSettingsGUI, MeasurementSettingsGUI
 from measurement_toolbox.measurement import MeasurementDAQ
+from measurement_toolbox.session import MeasurementSession
+from measurement_toolbox.sources import NidaqmxSource
 from measurement_toolbox.utils import check_nidaqmx_connected, check_callibration_available
+from measurement_toolbox.storage import recover_trials
+
+# %% Acquisition source
+# NidaqmxSource() measures with the USB-6009. To run the toolbox without
+# hardware use SimulatedSource() or
+# ReplaySource("measurement_files/PP1/trial_1.json", speed=1.0)
+# from measurement_toolbox.sources instead.
+acquisitionSource = NidaqmxSource()
+
+# "polling" reads blocks of 5 samples in a loop, "callback" lets the driver
+# deliver a block every latencyBudget seconds (fewer wake-ups at high rates)
+acquisitionMode = "polling"
+latencyBudget = 0.02
+
+# "inline" draws the figures in this process, "process" draws them in a
+# separate render process, so redrawing never delays the DAQ reads
+renderMode = "inline"
+
+# "matplotlib" shows the feedback as a matplotlib figure, "qt" as a window
+# painted with Qt that checks for new amplitudes every display refresh (only
+# with renderMode = "process")
+feedbackRenderer = "matplotlib"
+
+# with an Excel file all its trials run back to back in one session: the plan
+# is read once, and the DAQ task, audio stream and figures stay open between
+# trials (False: the measurement settings window opens before every trial)
+runSession = True
+
+# show the participant the percentage of cycles on target so far above each
+# feedback bar (the statistics of every trial are saved in any case)
+showAccuracy = False
 
 # %% Checks
 
 # check nidaqmx device connected
-check_nidaqmx_connected()
+if isinstance(acquisitionSource, NidaqmxSource):
+    check_nidaqmx_connected()
 
 # Check if calibration files are available
 check_callibration_available()
 
+# Recover trials that were not finished in a previous session (e.g. after a crash)
+recover_trials()
+
 # %% Start measuring program
 
 generalSettings = GeneralSettingsGUI()
-experiment = MeasurementDAQ(generalSettings.settings)
+experiment = MeasurementDAQ(generalSettings.settings, acquisitionSource,
+                            acquisitionMode, latencyBudget, renderMode, feedbackRenderer)
+experiment.showAccuracy = showAccuracy
+
+if runSession and generalSettings.settings["useExcel"] == 1:
+    session = MeasurementSession(experiment, generalSettings.excelSettings)
+    session.run()
 
+# trials after the session (or all trials without a session)
 while True:
 
     measurementSettings = MeasurementSettingsGUI(experiment.trialNr,
@@ -4,7 +4,7 @@
 import tkinter as tk
 import json
 import sys
-from .utils import read_json, get_excel_settings
+from .utils import read_json, get_excel_settings, excel_trial_settings
 from .calibration import calc_intercept
 
 # %% Create a class for a base GUI
@@ -297,16 +297,7 @@ class MeasurementSettingsGUI(BaseGUI):
 
     def update_settings_with_excel(self):
         excelIndex = self.trialNr - 1
-        self.settings["rightTarget"] = float(
-            self.excelSettings.loc[excelIndex, "Target_Right_Limb"])
-        self.settings["leftTarget"] = float(
-            self.excelSettings.loc[excelIndex, "Target_Left_Limb"])
-        self.settings["duration"] = float(
-            self.excelSettings.loc[excelIndex, "Trial_Duration"])
-        self.settings["metronomeDuration"] = float(
-            self.excelSettings.loc[excelIndex, "Metronome_Duration"])
-        self.settings["metronomeFile"] = str(
-            self.excelSettings.loc[excelIndex, "Metronome_Filename"])
+        self.settings.update(excel_trial_settings(self.excelSettings, excelIndex))
 
     def get_settings(self):
 
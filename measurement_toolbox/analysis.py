@@ -0,0 +1,266 @@
+# analysis.py
+#
+# Batch re-analysis of recorded trials. Runs the same peak/amplitude detection
+# as the online feedback on every trial in measurement_files/<participant>/
+# and writes two tables (times are relative to the start of the trial):
+#   - cycles.csv: one row per detected cycle
+#   - trials.csv: one row per trial and channel (mean amplitude, SD, error)
+#
+# Command line:
+#   python -m measurement_toolbox.analysis --folder measurement_files --output analysis_files
+
+# %% imports
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import numpy as np
+
+from .detection import THRESHOLD, detect_recording
+from .filters import LowPassFilter
+from .storage import find_trials, load_trial, trial_number
+
+# %% Settings
+
+# target of every channel: AI0 drives the right feedback bar, AI1 the left bar
+TARGET_KEYS = ("rightTarget", "leftTarget")
+
+CYCLE_COLUMNS = ["participant", "trial", "channel", "cycle", "sampleIndex",
+                 "time", "amplitude", "target", "error"]
+TRIAL_COLUMNS = ["participant", "trial", "channel", "target", "nCycles",
+                 "meanAmplitude", "sdAmplitude", "meanError", "rmsError", "file"]
+
+# %% Analysis of one trial
+
+
+def trial_calibration_models(trial, calibrationModels):
+    """
+    The calibration models (see calibration.py) anchored at the zero points
+    of the trial, as during the measurement.
+    """
+
+    models = []
+    for channel, model in enumerate(calibrationModels):
+        intercept = trial.get(f"interceptAI{channel}")
+        # old trials saved a single number instead of a (units, volts) pair
+        if isinstance(intercept, (list, tuple)) and len(intercept) == 2:
+            model = model.with_reference(*intercept)
+        models.append(model)
+    return models
+
+
+def detect_trial(trial, calibrationSlopes=None, threshold=None, calibrationModels=None):
+    """
+    Run the peak detection over all samples of a loaded trial. Returns the
+    samples (nChannels, nSamples) and the DetectionResult. The amplitudes are
+    converted with calibrationModels (as the online feedback) or with
+    calibrationSlopes; without either they are in volt.
+    """
+
+    channelData = np.array([trial[key] for key in trial["channels"]], dtype=float)
+    sampleFrequency = trial["sampleFrequency"]
+
+    # filter and thresholds of the online detection, saved with newer trials
+    detection = trial.get("detection") or {}
+    prefilter = None
+    if detection.get("filterCutoff"):
+        prefilter = LowPassFilter(channelData.shape[0], sampleFrequency,
+                                  detection["filterCutoff"], detection.get("filterOrder") or 2)
+    if threshold is None:
+        threshold = detection.get("threshold", THRESHOLD)
+    if calibrationSlopes is not None:
+        calibrationSlopes = calibrationSlopes[:channelData.shape[0]]
+    if calibrationModels is not None:
+        calibrationModels = trial_calibration_models(
+            trial, calibrationModels[:channelData.shape[0]])
+
+    result = detect_recording(channelData, sampleFrequency, calibrationSlopes, threshold,
+                              calibrationModels=calibrationModels, prefilter=prefilter)
+    return channelData, result
+
+
+def analyse_trial(filename, calibrationSlopes=None, threshold=None, calibrationModels=None):
+    """
+    Detect the cycles of one trial. Returns a dictionary with the rows of the
+    cycle table ('cycles') and of the trial table ('trials'). Without a
+    threshold the filter and thresholds of the online detection are used.
+    The amplitudes are converted as in detect_trial.
+    """
+
+    trial = load_trial(filename)
+    channelData, result = detect_trial(trial, calibrationSlopes, threshold, calibrationModels)
+    sampleFrequency = trial["sampleFrequency"]
+    participant = os.path.basename(os.path.dirname(filename))
+    trialNr = trial_number(filename)
+
+    # samples before space was pressed are only used to settle the detector,
+    # cycles are counted from the start of the trial
+    startIndex = trial.get("startIndex") or 0
+
+    cycles = []
+    trials = []
+    for channel in range(channelData.shape[0]):
+        target = trial.get(TARGET_KEYS[channel]) if channel < len(TARGET_KEYS) else None
+        inChannel = (result.cycleChannels == channel) & (result.cycleIndices >= startIndex)
+        amplitudes = result.amplitudes[inChannel]
+        sampleIndices = result.cycleIndices[inChannel]
+        errors = amplitudes - target if target is not None else np.full(len(amplitudes), np.nan)
+
+        for cycle in range(len(amplitudes)):
+            cycles.append([participant, trialNr, channel, cycle + 1,
+                           int(sampleIndices[cycle]),
+                           float((sampleIndices[cycle] - startIndex) / sampleFrequency),
+                           float(amplitudes[cycle]), target, float(errors[cycle])])
+
+        nCycles = len(amplitudes)
+        trials.append([participant, trialNr, channel, target, nCycles,
+                       float(np.mean(amplitudes)) if nCycles else np.nan,
+                       float(np.std(amplitudes, ddof=1)) if nCycles > 1 else np.nan,
+                       float(np.mean(errors)) if nCycles else np.nan,
+                       float(np.sqrt(np.mean(errors ** 2))) if nCycles else np.nan,
+                       filename])
+
+    return {"cycles": cycles, "trials": trials}
+
+
+def _cache_filename(filename, outputFolder):
+
+    participant = os.path.basename(os.path.dirname(filename))
+    name = os.path.splitext(os.path.basename(filename))[0] + ".json"
+    return os.path.join(outputFolder, "cache", participant, name)
+
+
+def _cache_key(filename, calibrationModels, threshold):
+
+    # a trial is up to date when the file and the analysis settings are unchanged
+    fileStat = os.stat(filename)
+    return {"file": filename, "mtime": fileStat.st_mtime, "size": fileStat.st_size,
+            "calibrationModels": [model.to_dict() for model in calibrationModels],
+            "threshold": threshold}
+
+
+def _analyse_and_cache(filename, outputFolder, calibrationModels, threshold):
+
+    # runs in a worker process
+    results = analyse_trial(filename, threshold=threshold, calibrationModels=calibrationModels)
+    results["key"] = _cache_key(filename, calibrationModels, threshold)
+
+    cacheFilename = _cache_filename(filename, outputFolder)
+    os.makedirs(os.path.dirname(cacheFilename), exist_ok=True)
+    with open(cacheFilename, "w") as outfile:
+        json.dump(results, outfile)
+
+    return results
+
+
+def _read_cache(filename, outputFolder, calibrationModels, threshold):
+
+    try:
+        with open(_cache_filename(filename, outputFolder), "r") as infile:
+            results = json.load(infile)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if results.get("key") != _cache_key(filename, calibrationModels, threshold):
+        return None
+
+    return results
+
+# %% Batch analysis
+
+
+def analyse_all_trials(folder="measurement_files", outputFolder="analysis_files",
+                       calibrationModels=None, threshold=None, workers=None,
+                       force=False, calibrationFit="linear"):
+    """
+    Analyse all trials in folder/<participant>/ in a process pool and write
+    cycles.csv and trials.csv to outputFolder. The amplitudes are converted
+    with the calibration models of the online feedback (see calibration.py,
+    calibrationFit as the 'calibrationFit' setting of the measurement).
+    Trials whose file and settings did not change since the previous run are
+    read from the cache. Returns the filenames of the two tables.
+    """
+
+    if calibrationModels is None:
+        from .calibration import load_calibration_model
+        calibrationModels = [load_calibration_model(channelNr, calibrationFit)
+                             for channelNr in (0, 1)]
+
+    trialFiles = find_trials(folder)
+    results = {}
+    toAnalyse = []
+    for filename in trialFiles:
+        cached = None if force else _read_cache(filename, outputFolder,
+                                                calibrationModels, threshold)
+        if cached is None:
+            toAnalyse.append(filename)
+        else:
+            results[filename] = cached
+
+    print(f"{len(trialFiles)} trial(s) found, {len(toAnalyse)} to analyse")
+
+    if toAnalyse:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_analyse_and_cache, filename, outputFolder,
+                                   calibrationModels, threshold): filename
+                       for filename in toAnalyse}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as error:
+                    print(f"Skipping '{futures[future]}': {error!r}")
+
+    trialFiles = [filename for filename in trialFiles if filename in results]
+
+    os.makedirs(outputFolder, exist_ok=True)
+    cyclesFilename = os.path.join(outputFolder, "cycles.csv")
+    trialsFilename = os.path.join(outputFolder, "trials.csv")
+
+    _write_table(cyclesFilename, CYCLE_COLUMNS,
+                 [row for filename in trialFiles for row in results[filename]["cycles"]])
+    _write_table(trialsFilename, TRIAL_COLUMNS,
+                 [row for filename in trialFiles for row in results[filename]["trials"]])
+
+    return cyclesFilename, trialsFilename
+
+
+def _write_table(filename, columns, rows):
+
+    with open(filename, "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+# %% Command line
+
+
+def main(arguments=None):
+
+    parser = argparse.ArgumentParser(
+        description="Re-analyse all recorded trials with the online peak detection.")
+    parser.add_argument("--folder", default="measurement_files",
+                        help="folder with one subfolder per participant")
+    parser.add_argument("--output", default="analysis_files",
+                        help="folder for cycles.csv, trials.csv and the cache")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes (default: number of cores)")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="slope threshold in volt (default: as during the measurement, "
+                             f"{THRESHOLD} V for older trials)")
+    parser.add_argument("--force", action="store_true",
+                        help="analyse all trials, also when they are up to date")
+    parser.add_argument("--calibration-fit", default="linear",
+                        choices=("linear", "polynomial", "lookup"),
+                        help="calibration model, as the 'calibrationFit' setting "
+                             "of the measurement (default: linear)")
+    args = parser.parse_args(arguments)
+
+    cyclesFilename, trialsFilename = analyse_all_trials(
+        args.folder, args.output, threshold=args.threshold,
+        workers=args.workers, force=args.force, calibrationFit=args.calibration_fit)
+    print(f"Results saved as '{cyclesFilename}' and '{trialsFilename}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+# buffers.py
+
+# %% imports
+import os
+import tempfile
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+
+# %% Sample buffer
+
+
+class SampleBuffer:
+    """
+    Preallocated ring buffer for multi-channel samples with one writer thread
+    and any number of readers.
+
+    Every sample is stored twice (at position p and p + capacity), so the
+    newest `capacity` samples can always be returned as one contiguous view
+    without copying. The buffer doubles in size until maxCapacity is reached.
+    After that the oldest samples are spilled to a file on disk before they are
+    overwritten, so memory stays bounded for trials of any length.
+
+    The writer first stores the samples and then publishes the new sample
+    count, so readers never see samples that are not completely written.
+    """
+
+    def __init__(self, nChannels, dtype=np.float64, initialCapacity=2**14,
+                 maxCapacity=2**20, spillFile=None):
+
+        self.nChannels = nChannels
+        self.dtype = np.dtype(dtype)
+        self.initialCapacity = int(initialCapacity)
+        self.maxCapacity = max(int(maxCapacity), self.initialCapacity)
+        self.spillFile = spillFile  # filename, None for a temporary file
+
+        self._spill = None
+        self._spillLock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+
+        # only call clear when no writer is active
+        self._data = np.zeros((self.nChannels, 2 * self.initialCapacity), dtype=self.dtype)
+        self.spilledCount = 0
+        self.writeCount = 0
+
+        with self._spillLock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+    @property
+    def capacity(self):
+        return self._data.shape[1] // 2
+
+    def __len__(self):
+        return self.writeCount
+
+    def write(self, block):
+        """
+        Append a block with shape (nChannels, nSamples). Only one thread may
+        write to the buffer.
+        """
+
+        block = np.asarray(block).reshape(self.nChannels, -1)
+        nSamples = block.shape[1]
+
+        # grow while allowed, otherwise move the samples that are about to be
+        # overwritten to disk
+        while self.writeCount + nSamples - self.spilledCount > self.capacity \
+                and self.capacity < self.maxCapacity:
+            self._grow()
+
+        if self.writeCount + nSamples - self.spilledCount > self.capacity:
+            self._spill_samples(
+                min(self.writeCount, self.writeCount + nSamples - self.capacity))
+
+        # a block larger than the buffer only keeps its newest samples in memory
+        if nSamples > self.capacity:
+            self._append_spill(block[:, :nSamples - self.capacity])
+            self.spilledCount += nSamples - self.capacity
+            block = block[:, nSamples - self.capacity:]
+
+        data = self._data
+        capacity = self.capacity
+        start = (self.writeCount + nSamples - block.shape[1]) % capacity
+        stop = start + block.shape[1]
+
+        # write the block twice: once in each half of the mirrored storage
+        if stop <= capacity:
+            data[:, start:stop] = block
+            data[:, start + capacity:stop + capacity] = block
+        else:
+            firstPart = capacity - start
+            data[:, start:capacity] = block[:, :firstPart]
+            data[:, start + capacity:] = block[:, :firstPart]
+            data[:, :stop - capacity] = block[:, firstPart:]
+            data[:, capacity:stop] = block[:, firstPart:]
+
+        # publish the new samples
+        self.writeCount += nSamples
+
+    def get(self, start, stop=None):
+        """
+        Returns samples [start, stop) with shape (nChannels, stop - start).
+        This is a view if all samples are still in memory and a copy if part
+        of them had to be read back from the spill file.
+        """
+
+        # read the count before the storage: the storage is never older than the count
+        writeCount = self.writeCount
+        data = self._data
+        capacity = data.shape[1] // 2
+
+        if stop is None or stop > writeCount:
+            stop = writeCount
+        start = max(0, min(start, stop))
+
+        oldestInMemory = max(0, writeCount - capacity)
+        if start >= oldestInMemory:
+            first = start % capacity
+            return data[:, first:first + stop - start]
+
+        # older samples come from the spill file
+        spilled = self._read_spill(start, min(stop, oldestInMemory))
+        if stop <= oldestInMemory:
+            return spilled
+
+        return np.concatenate((spilled, self.get(oldestInMemory, stop)), axis=1)
+
+    def latest(self, nSamples):
+        """Returns a view of the newest nSamples samples that are in memory."""
+        writeCount = self.writeCount
+        return self.get(max(0, writeCount - min(nSamples, self.capacity)), writeCount)
+
+    def to_array(self):
+        """Returns a copy of all samples written since the last clear()."""
+        return np.array(self.get(0, self.writeCount))
+
+    def reader(self, position=0):
+        return BufferReader(self, position)
+
+    def _grow(self):
+
+        capacity = self.capacity
+        newCapacity = min(2 * capacity, self.maxCapacity)
+        newData = np.zeros((self.nChannels, 2 * newCapacity), dtype=self.dtype)
+
+        # copy the samples that are still in memory to their new positions
+        first = max(self.spilledCount, self.writeCount - capacity)
+        samples = self._data[:, first % capacity:first % capacity + self.writeCount - first]
+        positions = np.arange(first, self.writeCount) % newCapacity
+        newData[:, positions] = samples
+        newData[:, positions + newCapacity] = samples
+
+        self._data = newData
+
+    def _spill_samples(self, stop):
+
+        if stop <= self.spilledCount:
+            return
+
+        capacity = self.capacity
+        first = self.spilledCount % capacity
+        self._append_spill(self._data[:, first:first + stop - self.spilledCount])
+        self.spilledCount = stop
+
+    def _append_spill(self, block):
+
+        samples = np.ascontiguousarray(block.T, dtype=self.dtype).tobytes()
+
+        # spilled samples are stored interleaved: (samples, channels)
+        with self._spillLock:
+            if self._spill is None:
+                if self.spillFile is None:
+                    self._spill = tempfile.TemporaryFile()
+                else:
+                    self._spill = open(self.spillFile, "w+b")
+
+            self._spill.seek(0, 2)
+            self._spill.write(samples)
+            self._spill.flush()
+
+    def _read_spill(self, start, stop):
+
+        frameSize = self.nChannels * self.dtype.itemsize
+        with self._spillLock:
+            self._spill.seek(start * frameSize)
+            samples = np.frombuffer(self._spill.read((stop - start) * frameSize),
+                                    dtype=self.dtype)
+
+        return samples.reshape(-1, self.nChannels).T
+
+
+class BufferReader:
+    """
+    Cursor on a SampleBuffer or SharedRing. Every call to read() returns the
+    samples written since the previous call.
+    """
+
+    def __init__(self, buffer, position=0):
+        self.buffer = buffer
+        self.position = position
+
+    def available(self):
+        return self.buffer.writeCount - self.position
+
+    def read(self):
+        # a SharedRing leaves out samples that were already overwritten
+        writeCount = self.buffer.writeCount
+        newData = self.buffer.get(self.position, writeCount)
+        self.position = writeCount
+        return newData
+
+# %% Shared memory ring buffer
+
+
+def open_shared_memory(size=0, name=None):
+    """
+    Creates a block of shared memory of size bytes, or attaches to the block
+    with the given name (made by another process).
+    """
+
+    if name is None:
+        return shared_memory.SharedMemory(create=True, size=size)
+
+    # the process that created the block removes it, not the processes that
+    # attach to it (before python 3.13 they would remove it when they exit)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        memory = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+class SharedRing:
+    """
+    Ring buffer for multi-channel samples in shared memory, with one writer
+    process and readers in other processes. Readers attach with the name of
+    the ring: SharedRing(name=ring.name).
+
+    Like SampleBuffer every sample is stored twice, and the writer first
+    stores the samples and then publishes the new sample count. Only the
+    newest capacity samples are kept; get() returns a copy, because the
+    writer keeps on writing while a reader uses the samples.
+    """
+
+    # header: sample count, number of channels, capacity
+    HEADER_SIZE = 64
+
+    def __init__(self, nChannels=None, capacity=2**16, name=None):
+
+        if name is None:
+            size = self.HEADER_SIZE + 2 * nChannels * capacity * 8
+            self.memory = open_shared_memory(size)
+            self._header = np.ndarray((3,), dtype=np.int64, buffer=self.memory.buf)
+            self._header[:] = (0, nChannels, capacity)
+        else:
+            self.memory = open_shared_memory(name=name)
+            self._header = np.ndarray((3,), dtype=np.int64, buffer=self.memory.buf)
+
+        self.nChannels = int(self._header[1])
+        self.capacity = int(self._header[2])
+        self._data = np.ndarray((self.nChannels, 2 * self.capacity), dtype=np.float64,
+                                buffer=self.memory.buf, offset=self.HEADER_SIZE)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def writeCount(self):
+        return int(self._header[0])
+
+    def __len__(self):
+        return self.writeCount
+
+    def write(self, block):
+        """
+        Append a block with shape (nChannels, nSamples). Only one process may
+        write to the ring.
+        """
+
+        block = np.asarray(block).reshape(self.nChannels, -1)
+        writeCount = self.writeCount
+        nSamples = block.shape[1]
+        capacity = self.capacity
+
+        # a block larger than the ring only keeps its newest samples
+        block = block[:, max(0, nSamples - capacity):]
+        start = (writeCount + nSamples - block.shape[1]) % capacity
+        stop = start + block.shape[1]
+
+        if stop <= capacity:
+            self._data[:, start:stop] = block
+            self._data[:, start + capacity:stop + capacity] = block
+        else:
+            firstPart = capacity - start
+            self._data[:, start:capacity] = block[:, :firstPart]
+            self._data[:, start + capacity:] = block[:, :firstPart]
+            self._data[:, :stop - capacity] = block[:, firstPart:]
+            self._data[:, capacity:stop] = block[:, firstPart:]
+
+        # publish the new samples
+        self._header[0] = writeCount + nSamples
+
+    def get(self, start, stop=None):
+        """
+        Returns a copy of samples [start, stop) with shape (nChannels,
+        nSamples). Samples that are no longer in the ring are left out, so
+        the result starts at max(start, len(ring) - capacity).
+        """
+
+        writeCount = self.writeCount
+        if stop is None or stop > writeCount:
+            stop = writeCount
+        start = max(0, writeCount - self.capacity, min(start, stop))
+
+        first = start % self.capacity
+        return self._data[:, first:first + stop - start].copy()
+
+    def reader(self, position=0):
+        return BufferReader(self, position)
+
+    def close(self):
+
+        # the numpy views must be gone before the memory can be closed
+        self._header = None
+        self._data = None
+        self.memory.close()
+
+    def unlink(self):
+        # removes the shared memory, only called by the process that made it
+        self.memory.unlink()
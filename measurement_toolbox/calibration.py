@@ -1,75 +1,91 @@
 # calibration.py
 
 # %% imports
-import nidaqmx
-from nidaqmx.constants import TerminalConfiguration
+import hashlib
 import json
-import matplotlib.pyplot as plt
 import os
-from scipy import stats
+import numpy as np
 
+from .sources import NidaqmxSource
 from .utils import read_json
 
 # %% Calibraiton functions
 
 
-def start_calibrating(channelNr: int, start, stop, increment):
+def start_calibrating(channels, start, stop, increment, source=None,
+                      burstSamples=500, burstFrequency=1000):
+    """
+    Calibrate one or both potentiometers (channels 0, 1 or [0, 1]) in one run.
+    At every set point a hardware-timed burst of burstSamples samples is
+    measured on all channels at once and reduced to its mean and SD, which are
+    saved in the calibration report of every channel.
+    """
 
-    if channelNr != 0 and channelNr != 1:
-        raise ValueError("channelNR must be either 0 or 1")
+    channels = [channels] if isinstance(channels, int) else list(channels)
+    if any(channelNr not in (0, 1) for channelNr in channels):
+        raise ValueError("channels must be 0, 1 or both")
 
-    ai_channels = ["Dev1/ai0", "Dev1/ai1"]
-    with nidaqmx.Task() as task:
-        # Configure the AI channel
-        task.ai_channels.add_ai_voltage_chan(
-            ai_channels[channelNr], terminal_config=TerminalConfiguration.RSE)
-
-        keepCalibrating = True
-        calibrationData = {}
+    # the NI-DAQmx channels unless another acquisition source is given
+    if source is None:
+        ai_channels = ["Dev1/ai0", "Dev1/ai1"]
+        source = NidaqmxSource([ai_channels[channelNr] for channelNr in channels])
 
+    with source:
         degreeValues = []
-        voltValues = []
+        bursts = []
 
         i = start
         while i <= stop + 1e-9:  # avoids floating point edge issues
-            input(f"Set the sensor to {i:.1f} and press Enter...")
-
-            voltage = task.read()
+            input(f"Set the sensor(s) to {i:.1f} and press Enter...")
 
             degreeValues.append(i)
-            voltValues.append(voltage)
+            bursts.append(source.read_burst(burstSamples, burstFrequency))
 
             i += increment
 
-        plt.figure()
-        plt.plot(voltValues, degreeValues)
-        plt.plot(voltValues, degreeValues, "r*")
-        plt.xlabel("voltage values")
-        plt.ylabel("degree values")
-        plt.title("Calibration Data")
+    # mean and SD of every set point and channel, shape (nChannels, nPoints)
+    bursts = np.stack(bursts, axis=1)
+    voltMeans = bursts.mean(axis=2)
+    voltSDs = bursts.std(axis=2, ddof=1)
 
-        calibrationData['degreeValues'] = degreeValues
-        calibrationData['voltValues'] = voltValues
+    import matplotlib.pyplot as plt
+
+    plt.figure()
+    for position, channelNr in enumerate(channels):
+        plt.errorbar(voltMeans[position], degreeValues, xerr=voltSDs[position],
+                     fmt="*-", label=f"AI{channelNr}")
+    plt.xlabel("voltage values")
+    plt.ylabel("degree values")
+    plt.title("Calibration Data")
+    plt.legend()
+
+    os.makedirs("potmeter_experiment", exist_ok=True)
 
-        os.makedirs("potmeter_experiment", exist_ok=True)
+    for position, channelNr in enumerate(channels):
+        calibrationData = {}
+        calibrationData['degreeValues'] = degreeValues
+        calibrationData['voltValues'] = voltMeans[position].tolist()
+        calibrationData['voltSD'] = voltSDs[position].tolist()
+        calibrationData['burstSamples'] = burstSamples
+        calibrationData['burstFrequency'] = burstFrequency
 
         jsonData = json.dumps(calibrationData)
-        fullFilename = f"calibration_files/CallibrationReportPotmeter{
-            str(channelNr)}.json"
+        fullFilename = report_filename(channelNr)
         with open(fullFilename, "w") as outfile:
             outfile.write(jsonData)
 
         print(f"CallibrationReport saved as '{fullFilename}'")
 
 
+def calc_calibration_slopes(kind="linear"):
+
+    # slope of the (cached) calibration model of both potentiometers
+    return tuple(load_calibration_model(channelNr, kind).slope for channelNr in (0, 1))
+
+
 def calc_linear_regression(deg90Pot0, deg90Pot1):
 
-    dataPot0 = read_json("calibration_files/CallibrationReportPotmeter0.json")
-    dataPot1 = read_json("calibration_files/CallibrationReportPotmeter1.json")
-    slopePot0, _, _, _, _ = stats.linregress(dataPot0['voltValues'],
-                                             dataPot0['degreeValues'])
-    slopePot1, _, _, _, _ = stats.linregress(dataPot1['voltValues'],
-                                             dataPot1['degreeValues'])
+    slopePot0, slopePot1 = calc_calibration_slopes()
 
     intercept0 = deg90Pot0[0] - (slopePot0 * deg90Pot0[1])
     intercept1 = deg90Pot1[0] - (slopePot1 * deg90Pot1[1])
@@ -77,14 +93,171 @@ def calc_linear_regression(deg90Pot0, deg90Pot1):
     return (slopePot0, intercept0), (slopePot1, intercept1)
 
 
-def calc_intercept(ai_channel, inputValue):
+def calc_intercept(ai_channel, inputValue, source=None):
 
-    ai_channels = ["Dev1/ai0", "Dev1/ai1"]
+    # a given source reads all channels, the default source only ai_channel
+    channel = ai_channel
+    if source is None:
+        ai_channels = ["Dev1/ai0", "Dev1/ai1"]
+        source = NidaqmxSource([ai_channels[ai_channel]])
+        channel = 0
 
-    with nidaqmx.Task() as task:
-        # Configure the AI channel
-        task.ai_channels.add_ai_voltage_chan(
-            ai_channels[ai_channel], terminal_config=TerminalConfiguration.RSE)
-        zeroPoint = task.read()
+    with source:
+        zeroPoint = source.read_single()[channel]
 
     return (inputValue, zeroPoint)
+
+# %% Calibration model
+
+CALIBRATION_KINDS = ("linear", "polynomial", "lookup")
+
+
+class CalibrationModel:
+    """
+    Conversion of voltages to sensor units (degrees for the potentiometers),
+    fitted once on a calibration report.
+
+        linear      units = slope * volts + intercept
+        polynomial  a polynomial of the given degree, for non-linear sensors
+        lookup      linear interpolation between the calibration points (and
+                    linear extrapolation outside them), for sensors like FSRs
+                    without a simple formula
+
+    transform() converts a whole block of samples at once. slope is the
+    average number of units per volt over the calibrated range, which is the
+    fitted slope for a linear model.
+    """
+
+    def __init__(self, kind, coefficients=None, voltTable=None, unitTable=None,
+                 voltRange=(0.0, 5.0), offset=0.0, reportHash=None):
+
+        if kind not in CALIBRATION_KINDS:
+            raise ValueError(f"Unknown calibration model '{kind}', "
+                             f"choose from {', '.join(CALIBRATION_KINDS)}")
+
+        self.kind = kind
+        self.coefficients = None if coefficients is None else np.asarray(coefficients, dtype=float)
+        self.voltTable = None if voltTable is None else np.asarray(voltTable, dtype=float)
+        self.unitTable = None if unitTable is None else np.asarray(unitTable, dtype=float)
+        self.voltRange = tuple(float(volts) for volts in voltRange)  # calibrated range
+        self.offset = float(offset)  # units added after the conversion
+        self.reportHash = reportHash
+
+    @classmethod
+    def fit(cls, voltValues, unitValues, kind="linear", degree=3, weights=None,
+            reportHash=None):
+
+        voltValues = np.asarray(voltValues, dtype=float)
+        unitValues = np.asarray(unitValues, dtype=float)
+        voltRange = (np.min(voltValues), np.max(voltValues))
+
+        if kind == "lookup":
+            order = np.argsort(voltValues, kind="stable")
+            return cls(kind, voltTable=voltValues[order], unitTable=unitValues[order],
+                       voltRange=voltRange, reportHash=reportHash)
+
+        degree = 1 if kind == "linear" else degree
+        coefficients = np.polyfit(voltValues, unitValues, degree, w=weights)
+        return cls(kind, coefficients=coefficients, voltRange=voltRange,
+                   reportHash=reportHash)
+
+    def transform(self, volts, out=None):
+        """
+        Converts an array of voltages (any shape) to units. out is an optional
+        array (not volts itself) for the result, to avoid an allocation per block.
+        """
+
+        volts = np.asarray(volts, dtype=float)
+        if out is None:
+            out = np.empty(volts.shape)
+
+        if self.kind == "lookup":
+            # interpolation inside the table, the end segments are extended
+            out[...] = np.interp(volts, self.voltTable, self.unitTable)
+            for end, first, second in ((0, 0, 1), (-1, -2, -1)):
+                outside = volts < self.voltTable[0] if end == 0 else volts > self.voltTable[-1]
+                if np.any(outside):
+                    endSlope = (self.unitTable[second] - self.unitTable[first]) / \
+                        (self.voltTable[second] - self.voltTable[first])
+                    out[outside] += endSlope * (volts[outside] - self.voltTable[end])
+        else:
+            # Horner's scheme in place, no temporary arrays per coefficient
+            out.fill(self.coefficients[0])
+            for coefficient in self.coefficients[1:]:
+                out *= volts
+                out += coefficient
+
+        if self.offset:
+            out += self.offset
+        return out
+
+    __call__ = transform
+
+    @property
+    def slope(self):
+
+        if self.kind == "linear":
+            return float(self.coefficients[0])
+        low, high = self.voltRange
+        return float(np.diff(self.transform([low, high]))[0] / (high - low))
+
+    def with_reference(self, units, volts):
+        """A copy of the model that gives units at volts (e.g. the 90 degree point)."""
+
+        model = CalibrationModel(self.kind, self.coefficients, self.voltTable,
+                                 self.unitTable, self.voltRange, 0.0, self.reportHash)
+        model.offset = units - float(model.transform(volts))
+        return model
+
+    def to_dict(self):
+        return {"kind": self.kind,
+                "coefficients": None if self.coefficients is None else self.coefficients.tolist(),
+                "voltTable": None if self.voltTable is None else self.voltTable.tolist(),
+                "unitTable": None if self.unitTable is None else self.unitTable.tolist(),
+                "voltRange": list(self.voltRange),
+                "offset": self.offset,
+                "reportHash": self.reportHash}
+
+    @classmethod
+    def from_dict(cls, dictData):
+        return cls(**dictData)
+
+
+def report_filename(channelNr):
+    return f"calibration_files/CallibrationReportPotmeter{channelNr}.json"
+
+
+def load_calibration_model(channelNr, kind="linear", degree=3,
+                           cacheFolder="calibration_files/cache"):
+    """
+    The calibration model of a potentiometer. The model is fitted once per
+    calibration report and cached on disk; it is fitted again when the report
+    (its hash) or the kind of model changes.
+    """
+
+    reportFilename = report_filename(channelNr)
+    with open(reportFilename, "rb") as infile:
+        reportBytes = infile.read()
+    reportHash = hashlib.sha256(reportBytes).hexdigest()
+
+    name = f"potmeter{channelNr}_{kind}" + (f"{degree}" if kind == "polynomial" else "")
+    cacheFilename = os.path.join(cacheFolder, f"{name}_{reportHash[:16]}.json")
+    if os.path.exists(cacheFilename):
+        return CalibrationModel.from_dict(read_json(cacheFilename))
+
+    report = json.loads(reportBytes)
+
+    # points are weighted by their noise when the report has it (averaged bursts)
+    weights = None
+    if 'voltSD' in report:
+        voltSD = np.asarray(report['voltSD'], dtype=float)
+        weights = 1 / np.maximum(voltSD, max(np.median(voltSD), 1e-6) * 0.1)
+
+    model = CalibrationModel.fit(report['voltValues'], report['degreeValues'],
+                                 kind, degree, weights, reportHash=reportHash)
+
+    os.makedirs(cacheFolder, exist_ok=True)
+    with open(cacheFilename, "w") as outfile:
+        json.dump(model.to_dict(), outfile)
+
+    return model
@@ -0,0 +1,346 @@
+# catalog.py
+#
+# SQLite index of all recorded trials (measurement_files/catalog.sqlite). It
+# holds the settings of every trial, taken from the header of the trial file,
+# and the amplitude statistics per trial and limb, as saved during the
+# measurement or calculated once when the trial is indexed. Queries only read
+# the index, never the samples.
+#
+# The catalog is updated after every trial that is saved. Trials recorded
+# before the catalog existed (or copied from another computer) are added with:
+#   python -m measurement_toolbox.catalog update --folder measurement_files
+# and found with, for example:
+#   python -m measurement_toolbox.catalog query --left-target 3 --sample-frequency 300
+
+# %% imports
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import time
+
+from .storage import find_trials, read_trial_header, trial_number
+from .utils import read_json
+
+# %% Settings
+
+CATALOG_FILENAME = os.path.join("measurement_files", "catalog.sqlite")
+
+TRIAL_FIELDS = ["file", "participant", "trial", "date", "time", "leftTarget",
+                "rightTarget", "duration", "recordedDuration", "sampleFrequency",
+                "interceptAI0", "interceptAI1", "nSamples", "startIndex", "stopIndex"]
+STATISTIC_FIELDS = ["file", "channel", "target", "nCycles", "meanAmplitude",
+                    "sdAmplitude", "meanError", "rmsError"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    file TEXT PRIMARY KEY,
+    participant TEXT,
+    trial INTEGER,
+    date TEXT,
+    time TEXT,
+    leftTarget REAL,
+    rightTarget REAL,
+    duration REAL,
+    recordedDuration REAL,
+    sampleFrequency REAL,
+    interceptAI0 TEXT,
+    interceptAI1 TEXT,
+    nSamples INTEGER,
+    startIndex INTEGER,
+    stopIndex INTEGER,
+    mtime REAL,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS statistics (
+    file TEXT REFERENCES trials(file) ON DELETE CASCADE,
+    channel INTEGER,
+    target REAL,
+    nCycles INTEGER,
+    meanAmplitude REAL,
+    sdAmplitude REAL,
+    meanError REAL,
+    rmsError REAL,
+    PRIMARY KEY (file, channel)
+);
+CREATE INDEX IF NOT EXISTS trialsByParticipant ON trials (participant, trial);
+CREATE INDEX IF NOT EXISTS trialsByTargets ON trials (leftTarget, rightTarget, sampleFrequency);
+"""
+
+# %% Database
+
+
+@contextlib.contextmanager
+def open_catalog(database=CATALOG_FILENAME):
+    """
+    Connection to the catalog, created when it does not exist. Changes are
+    committed when the with-block ends without an error.
+    """
+
+    os.makedirs(os.path.dirname(database) or ".", exist_ok=True)
+    connection = sqlite3.connect(database, timeout=10)
+    connection.row_factory = sqlite3.Row
+    try:
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.executescript(SCHEMA)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+# %% Indexing
+
+
+def read_header(filename):
+    """Trial settings without the samples (.trial, .trialz or old .json trial)."""
+
+    if filename.endswith(".json"):
+        header = read_json(filename)
+        header["channels"] = [key for key in ("dataAI0", "dataAI1") if key in header]
+        header["nSamples"] = len(header[header["channels"][0]]) if header["channels"] else 0
+        for key in header["channels"]:
+            del header[key]
+        return header
+
+    if filename.endswith(".trialz"):
+        from .codec import read_compressed_header
+        header, _ = read_compressed_header(filename)
+        return header
+
+    header, _ = read_trial_header(filename)
+    return header
+
+
+def trial_statistics(filename, calibrationModels=None, header=None):
+    """
+    Amplitude statistics per channel (rows of STATISTIC_FIELDS without the
+    file). The statistics saved with the trial during the measurement are
+    used when the header has them (see cycle_statistics.py), otherwise the
+    trial is analysed with the detection of the batch analysis (see
+    analysis.py). Without calibrationModels these amplitudes are in volt.
+    """
+
+    if header is not None and header.get("cycleStatistics"):
+        return [[channel, summary["target"], summary["nCycles"], summary["mean"],
+                  summary["sd"], summary["meanError"], summary["rmsError"]]
+                for channel, summary in enumerate(header["cycleStatistics"]["channels"])]
+
+    from .analysis import analyse_trial
+
+    rows = analyse_trial(filename, calibrationModels=calibrationModels)["trials"]
+
+    # analysis rows: participant, trial, channel, target, nCycles, mean, SD,
+    # mean error, RMS error, file
+    return [row[2:9] for row in rows]
+
+
+def update_trial(filename, calibrationModels=None, database=CATALOG_FILENAME):
+    """Add a trial to the catalog, or update it when it is already indexed."""
+
+    header = read_header(filename)
+    statistics = trial_statistics(filename, calibrationModels, header)
+
+    sampleFrequency = header.get("sampleFrequency")
+    startIndex = header.get("startIndex") or 0
+    recordedDuration = None
+    if sampleFrequency:
+        recordedDuration = (header["nSamples"] - startIndex) / sampleFrequency
+
+    trial = {
+        "file": os.path.normpath(filename),
+        "participant": os.path.basename(os.path.dirname(os.path.abspath(filename))),
+        "trial": trial_number(filename),
+        "date": header.get("currentDate"),
+        "time": header.get("currentTime"),
+        "leftTarget": header.get("leftTarget"),
+        "rightTarget": header.get("rightTarget"),
+        "duration": header.get("duration"),
+        "recordedDuration": recordedDuration,
+        "sampleFrequency": sampleFrequency,
+        # intercepts are (degrees, volts) pairs, or a number in old trials
+        "interceptAI0": json.dumps(header.get("interceptAI0")),
+        "interceptAI1": json.dumps(header.get("interceptAI1")),
+        "nSamples": header["nSamples"],
+        "startIndex": header.get("startIndex"),
+        "stopIndex": header.get("stopIndex"),
+    }
+    fileStat = os.stat(filename)
+
+    with open_catalog(database) as connection:
+        connection.execute(
+            f"INSERT OR REPLACE INTO trials ({', '.join(TRIAL_FIELDS)}, mtime, size) "
+            f"VALUES ({', '.join('?' * (len(TRIAL_FIELDS) + 2))})",
+            [trial[field] for field in TRIAL_FIELDS] + [fileStat.st_mtime, fileStat.st_size])
+        connection.execute("DELETE FROM statistics WHERE file = ?", (trial["file"],))
+        connection.executemany(
+            f"INSERT INTO statistics ({', '.join(STATISTIC_FIELDS)}) "
+            f"VALUES ({', '.join('?' * len(STATISTIC_FIELDS))})",
+            [[trial["file"]] + list(row) for row in statistics])
+
+
+def update_catalog(folder="measurement_files", calibrationModels=None,
+                   database=CATALOG_FILENAME, force=False):
+    """
+    Index all trials in folder/<participant>/ that are not in the catalog or
+    changed since they were indexed, and remove trials whose file no longer
+    exists. Returns the filenames of the trials that were indexed.
+    """
+
+    with open_catalog(database) as connection:
+        indexed = {row["file"]: (row["mtime"], row["size"]) for row in
+                   connection.execute("SELECT file, mtime, size FROM trials")}
+
+    trialFiles = [os.path.normpath(filename) for filename in find_trials(folder)]
+    toIndex = []
+    for filename in trialFiles:
+        fileStat = os.stat(filename)
+        if force or indexed.get(filename) != (fileStat.st_mtime, fileStat.st_size):
+            toIndex.append(filename)
+
+    for filename in toIndex:
+        try:
+            update_trial(filename, calibrationModels, database)
+        except Exception as error:
+            print(f"Skipping '{filename}': {error!r}")
+
+    # trials that were removed, or replaced by a .trial file (see find_trials)
+    folderPrefix = os.path.normpath(folder) + os.sep
+    removed = [filename for filename in indexed
+               if filename.startswith(folderPrefix) and filename not in trialFiles]
+    with open_catalog(database) as connection:
+        connection.executemany("DELETE FROM trials WHERE file = ?",
+                               [(filename,) for filename in removed])
+
+    return toIndex
+
+# %% Queries
+
+
+def _where(participant=None, trial=None, leftTarget=None, rightTarget=None,
+           sampleFrequency=None, date=None):
+
+    # targets and sample rates are compared with a tolerance, they are floats
+    conditions = []
+    values = []
+    for field, value in (("participant", participant), ("trial", trial), ("date", date)):
+        if value is not None:
+            conditions.append(f"trials.{field} = ?")
+            values.append(value)
+    for field, value in (("leftTarget", leftTarget), ("rightTarget", rightTarget),
+                         ("sampleFrequency", sampleFrequency)):
+        if value is not None:
+            conditions.append(f"abs(trials.{field} - ?) < 1e-9")
+            values.append(float(value))
+
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, values
+
+
+def query_trials(database=CATALOG_FILENAME, **filters):
+    """
+    Trials that match all given filters (participant, trial, leftTarget,
+    rightTarget, sampleFrequency, date as 'dd-mm-yyyy'), as a list of
+    dictionaries with TRIAL_FIELDS, sorted by participant and trial.
+    """
+
+    where, values = _where(**filters)
+    with open_catalog(database) as connection:
+        rows = connection.execute(
+            f"SELECT {', '.join(TRIAL_FIELDS)} FROM trials{where} "
+            "ORDER BY participant, trial", values).fetchall()
+
+    return [dict(row) for row in rows]
+
+
+def query_statistics(database=CATALOG_FILENAME, **filters):
+    """
+    Amplitude statistics per trial and channel of the trials that match the
+    filters (see query_trials), with the participant and trial number.
+    """
+
+    where, values = _where(**filters)
+    fields = ", ".join(f"statistics.{field}" for field in STATISTIC_FIELDS)
+    with open_catalog(database) as connection:
+        rows = connection.execute(
+            f"SELECT trials.participant, trials.trial, {fields} FROM statistics "
+            f"JOIN trials ON trials.file = statistics.file{where} "
+            "ORDER BY trials.participant, trials.trial, statistics.channel",
+            values).fetchall()
+
+    return [dict(row) for row in rows]
+
+# %% Command line
+
+
+def _print_table(rows):
+
+    if not rows:
+        print("No trials found")
+        return
+
+    columns = list(rows[0].keys())
+    text = [[("" if row[column] is None else
+              f"{row[column]:.4g}" if isinstance(row[column], float) else str(row[column]))
+             for column in columns] for row in rows]
+    widths = [max(len(column), *(len(line[position]) for line in text))
+              for position, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for line in text:
+        print("  ".join(value.ljust(width) for value, width in zip(line, widths)))
+
+
+def main(arguments=None):
+
+    parser = argparse.ArgumentParser(description="Index and find recorded trials.")
+    parser.add_argument("--database", default=CATALOG_FILENAME, help="catalog file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    update = commands.add_parser("update", help="index new and changed trials")
+    update.add_argument("--folder", default="measurement_files",
+                        help="folder with one subfolder per participant")
+    update.add_argument("--volt", action="store_true",
+                        help="amplitudes in volt, without the calibration files")
+    update.add_argument("--calibration-fit", default="linear",
+                        choices=("linear", "polynomial", "lookup"),
+                        help="calibration model, as the 'calibrationFit' setting "
+                             "of the measurement (default: linear)")
+    update.add_argument("--force", action="store_true",
+                        help="index all trials, also when they are up to date")
+
+    query = commands.add_parser("query", help="list the trials that match the filters")
+    query.add_argument("--participant")
+    query.add_argument("--trial", type=int)
+    query.add_argument("--left-target", type=float, dest="leftTarget")
+    query.add_argument("--right-target", type=float, dest="rightTarget")
+    query.add_argument("--sample-frequency", type=float, dest="sampleFrequency")
+    query.add_argument("--date", help="dd-mm-yyyy")
+    query.add_argument("--statistics", action="store_true",
+                       help="amplitude statistics per trial and limb instead of the settings")
+    args = parser.parse_args(arguments)
+
+    if args.command == "update":
+        calibrationModels = None
+        if not args.volt:
+            from .calibration import load_calibration_model
+            calibrationModels = [load_calibration_model(channelNr, args.calibration_fit)
+                                 for channelNr in (0, 1)]
+        indexed = update_catalog(args.folder, calibrationModels, args.database, args.force)
+        print(f"{len(indexed)} trial(s) indexed in '{args.database}'")
+        return
+
+    filters = {key: getattr(args, key) for key in
+               ("participant", "trial", "leftTarget", "rightTarget", "sampleFrequency", "date")}
+    queryStart = time.perf_counter()
+    if args.statistics:
+        rows = query_statistics(args.database, **filters)
+    else:
+        rows = query_trials(args.database, **filters)
+    queryTime = time.perf_counter() - queryStart
+
+    _print_table(rows)
+    print(f"{len(rows)} row(s) in {1e3 * queryTime:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+# codec.py
+#
+# Lossless compression of recorded trials for the archive. The DAQ device
+# (USB-6009, 14 bit) only returns voltages on a grid of ADC steps, so every
+# channel is stored as integer codes:
+#   - the step and offset of the grid are recovered from the samples, the
+#     code of a sample is round((volts - offset) / step)
+#   - a code is decoded as offset + code * step; the few codes whose voltage
+#     differs from this in the last bits are stored with their exact voltage,
+#     so decoding gives back the original float64 values bit for bit
+#   - the codes are delta coded (uint16, wrapping) and compressed with zlib
+# A channel that is not on a grid (e.g. simulated data) is stored as
+# compressed float64. A compressed trial is saved as trial_N.trialz:
+#   - 8 magic bytes and the header length (uint64, little endian)
+#   - a JSON header with the trial metadata (as in a .trial file) and the
+#     encoding of every channel
+#   - the compressed data of every channel, channel after channel
+#
+# Command line (all trials in measurement_files/<participant>/):
+#   python -m measurement_toolbox.codec archive --folder measurement_files
+#   python -m measurement_toolbox.codec restore --folder measurement_files
+
+# %% imports
+import argparse
+import glob
+import json
+import os
+import zlib
+import numpy as np
+
+from .storage import CHANNEL_NAMES, find_trials, load_trial, save_trial
+
+# %% Settings
+
+COMPRESSED_MAGIC = b"MAFTRIZ1"
+CODEC_VERSION = 2
+COMPRESSION_LEVEL = 6
+
+# deviation from the grid (in steps) up to which samples count as quantized
+GRID_TOLERANCE = 0.01
+
+# %% Channel codec
+
+
+def find_grid(values):
+    """
+    Step and offset of the grid of quantized samples, and the code of every
+    sample. Returns None when the samples are not on a grid of at most 2**16
+    levels, or when two different voltages would get the same code.
+    """
+
+    if values.size == 0 or not np.all(np.isfinite(values)):
+        return None
+
+    levels, levelOfSample = np.unique(values, return_inverse=True)
+    offset = float(levels[0])
+    if len(levels) == 1:
+        return 1.0, offset, np.zeros(values.size, dtype=np.int64)
+
+    # the smallest difference between two levels is one step; the step is
+    # refined over the whole range
+    differences = np.diff(levels)
+    stepCounts = np.round(differences / differences.min())
+    if np.max(np.abs(differences / differences.min() - stepCounts)) > GRID_TOLERANCE:
+        return None
+    step = float((levels[-1] - levels[0]) / stepCounts.sum())
+
+    levelCodes = np.round((levels - offset) / step).astype(np.int64)
+    if levelCodes[-1] >= 2**16 or np.any(np.diff(levelCodes) <= 0):
+        return None
+
+    return step, offset, levelCodes[levelOfSample.reshape(-1)]
+
+
+def grid_values(step, offset, codes):
+    # voltage of every code on the grid, the same for encoding and decoding
+    return offset + codes * step
+
+
+def encode_channel(values):
+    """
+    Encode the samples of one channel. Returns the encoding (saved in the
+    header) and the compressed data.
+    """
+
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    grid = find_grid(values)
+
+    if grid is None:
+        return {"method": "raw"}, zlib.compress(values.astype("<f8").tobytes(),
+                                                COMPRESSION_LEVEL)
+
+    step, offset, codes = grid
+    levelCodes, firstSample = np.unique(codes, return_index=True)
+    levelValues = values[firstSample]
+    exceptions = grid_values(step, offset, levelCodes).view(np.uint64) != \
+        levelValues.view(np.uint64)
+
+    # wrapping uint16 differences, undone by a wrapping cumulative sum
+    deltas = np.diff(codes.astype(np.uint16), prepend=np.uint16(0))
+    encoding = {
+        "method": "quantized",
+        "step": step,
+        "offset": offset,
+        # exact voltage of the codes that are not on the grid (a float
+        # survives JSON unchanged)
+        "exceptionCodes": levelCodes[exceptions].tolist(),
+        "exceptionValues": levelValues[exceptions].tolist(),
+    }
+    data = zlib.compress(deltas.astype("<u2").tobytes(), COMPRESSION_LEVEL)
+
+    # voltages that are equal but not identical (0.0 and -0.0) share a code
+    decoded = decode_channel(encoding, data, values.size)
+    if not np.array_equal(decoded.view(np.uint64), values.view(np.uint64)):
+        return {"method": "raw"}, zlib.compress(values.astype("<f8").tobytes(),
+                                                COMPRESSION_LEVEL)
+
+    return encoding, data
+
+
+def decode_channel(encoding, data, nSamples):
+    """Samples of one channel from its encoding and compressed data."""
+
+    if encoding["method"] == "raw":
+        return np.frombuffer(zlib.decompress(data), dtype="<f8", count=nSamples).copy()
+
+    deltas = np.frombuffer(zlib.decompress(data), dtype="<u2", count=nSamples)
+    codes = np.cumsum(deltas, dtype=np.uint16)
+
+    table = grid_values(encoding["step"], encoding["offset"],
+                        np.arange(int(codes.max(initial=0)) + 1))
+    table[encoding["exceptionCodes"]] = encoding["exceptionValues"]
+    return table[codes]
+
+# %% Compressed trial files
+
+
+def save_compressed_trial(filename, channelData, metadata, channelNames=CHANNEL_NAMES):
+    """
+    Save samples with shape (nChannels, nSamples) and a dictionary with
+    metadata as a compressed .trialz file.
+    """
+
+    channelData = np.asarray(channelData, dtype=np.float64)
+    if channelData.shape[0] != len(channelNames):
+        raise ValueError("Number of channel names does not match the data")
+
+    encodings = []
+    channelBytes = []
+    for values in channelData:
+        encoding, data = encode_channel(values)
+        encoding["nBytes"] = len(data)
+        encodings.append(encoding)
+        channelBytes.append(data)
+
+    header = dict(metadata)
+    header.update({
+        "codecVersion": CODEC_VERSION,
+        "channels": list(channelNames),
+        "nSamples": channelData.shape[1],
+        "encodings": encodings,
+    })
+    headerBytes = json.dumps(header).encode("utf-8")
+
+    with open(filename, "wb") as outfile:
+        outfile.write(COMPRESSED_MAGIC)
+        outfile.write(np.uint64(len(headerBytes)).tobytes())
+        outfile.write(headerBytes)
+        for data in channelBytes:
+            outfile.write(data)
+
+
+def read_compressed_header(filename):
+    """Returns the header of a .trialz file and the offset of the channel data."""
+
+    with open(filename, "rb") as infile:
+        if infile.read(len(COMPRESSED_MAGIC)) != COMPRESSED_MAGIC:
+            raise ValueError(f"{filename} is not a compressed trial file")
+
+        headerLength = int(np.frombuffer(infile.read(8), dtype="<u8")[0])
+        header = json.loads(infile.read(headerLength).decode("utf-8"))
+
+    return header, len(COMPRESSED_MAGIC) + 8 + headerLength
+
+
+def read_compressed_trial(filename):
+    """
+    Returns the metadata of a .trialz file (without the encodings) and the
+    samples with shape (nChannels, nSamples).
+    """
+
+    header, offset = read_compressed_header(filename)
+    codecVersion = header.pop("codecVersion")
+    if codecVersion != CODEC_VERSION:
+        raise ValueError(f"{filename} was written with codec version {codecVersion}, "
+                         f"this codec reads version {CODEC_VERSION}")
+    encodings = header.pop("encodings")
+    nSamples = header["nSamples"]
+
+    with open(filename, "rb") as infile:
+        infile.seek(offset)
+        channelData = np.empty((len(encodings), nSamples))
+        for channel, encoding in enumerate(encodings):
+            channelData[channel] = decode_channel(encoding, infile.read(encoding["nBytes"]),
+                                                  nSamples)
+
+    return header, channelData
+
+# %% Archive and restore
+
+
+def _trial_samples(filename):
+
+    # metadata and samples of a .trial or .json trial, as for save_trial
+    trial = load_trial(filename, mmap=False)
+    channelNames = trial.pop("channels")
+    channelData = np.array([trial.pop(key) for key in channelNames], dtype=np.float64)
+    for key in ("formatVersion", "dtype", "nSamples"):
+        trial.pop(key, None)
+    return trial, channelData, channelNames
+
+
+def archive_trial(filename, removeOriginal=False):
+    """
+    Compress a .trial (or old .json) trial to trial_N.trialz. The archive is
+    decoded and compared bit for bit before the original is removed. Returns
+    the filename of the archive.
+    """
+
+    metadata, channelData, channelNames = _trial_samples(filename)
+
+    archiveFilename = os.path.splitext(filename)[0] + ".trialz"
+    save_compressed_trial(archiveFilename, channelData, metadata, channelNames)
+
+    _, decoded = read_compressed_trial(archiveFilename)
+    if decoded.shape != channelData.shape or \
+            not np.array_equal(decoded.view(np.uint64), channelData.view(np.uint64)):
+        os.remove(archiveFilename)
+        raise RuntimeError(f"Compression of {filename} is not lossless")
+
+    if removeOriginal:
+        os.remove(filename)
+
+    return archiveFilename
+
+
+def restore_trial(archiveFilename, removeArchive=False):
+    """Decode a .trialz archive to trial_N.trial. Returns the new filename."""
+
+    header, channelData = read_compressed_trial(archiveFilename)
+    channelNames = header.pop("channels")
+    header.pop("nSamples")
+
+    trialFilename = os.path.splitext(archiveFilename)[0] + ".trial"
+    save_trial(trialFilename, channelData, header, channelNames)
+
+    if removeArchive:
+        os.remove(archiveFilename)
+
+    return trialFilename
+
+
+def archive_trials(folder="measurement_files", removeOriginal=False):
+    """
+    Compress all trials in folder/<participant>/ that have no up-to-date
+    archive. Returns the filenames of the new archives.
+    """
+
+    archived = []
+    for filename in find_trials(folder):
+        if filename.endswith(".trialz"):
+            continue
+
+        archiveFilename = os.path.splitext(filename)[0] + ".trialz"
+        if os.path.exists(archiveFilename) and \
+                os.path.getmtime(archiveFilename) >= os.path.getmtime(filename):
+            continue
+
+        archived.append(archive_trial(filename, removeOriginal))
+        originalSize = os.path.getsize(filename) if not removeOriginal else None
+        archiveSize = os.path.getsize(archiveFilename)
+        ratio = f", {originalSize / archiveSize:.1f}x smaller" if originalSize else ""
+        print(f"Archived '{filename}' as '{archiveFilename}' ({archiveSize} bytes{ratio})")
+
+    return archived
+
+
+def restore_trials(folder="measurement_files", removeArchive=False):
+    """Decode all .trialz archives in folder/<participant>/ without a .trial file."""
+
+    restored = []
+    for archiveFilename in sorted(glob.glob(os.path.join(folder, "*", "trial_*.trialz"))):
+        if os.path.exists(os.path.splitext(archiveFilename)[0] + ".trial"):
+            continue
+
+        restored.append(restore_trial(archiveFilename, removeArchive))
+        print(f"Restored '{archiveFilename}' to '{restored[-1]}'")
+
+    return restored
+
+# %% Command line
+
+
+def main(arguments=None):
+
+    parser = argparse.ArgumentParser(
+        description="Compress recorded trials for the archive, or restore them.")
+    parser.add_argument("command", choices=("archive", "restore"))
+    parser.add_argument("--folder", default="measurement_files",
+                        help="folder with one subfolder per participant")
+    parser.add_argument("--remove", action="store_true",
+                        help="remove the originals (archive) or the archives (restore) "
+                             "after they are converted")
+    args = parser.parse_args(arguments)
+
+    if args.command == "archive":
+        converted = archive_trials(args.folder, args.remove)
+    else:
+        converted = restore_trials(args.folder, args.remove)
+    print(f"{len(converted)} trial(s) {args.command}d")
+
+
+if __name__ == "__main__":
+    main()
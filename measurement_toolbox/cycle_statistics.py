@@ -0,0 +1,150 @@
+# cycle_statistics.py
+
+# %% imports
+import math
+import numpy as np
+
+# %% Running statistics
+
+
+class RunningStatistics:
+    """
+    Mean and SD of a series of values, updated per value in constant time
+    and memory (Welford's algorithm).
+    """
+
+    def __init__(self):
+
+        self.n = 0
+        self.mean = 0.0
+        self._sumSquares = 0.0  # sum of squared deviations from the mean
+
+    def add(self, value):
+
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self._sumSquares += delta * (value - self.mean)
+
+    @property
+    def sd(self):
+        # sample SD (ddof=1), as in the re-analysis
+        return math.sqrt(self._sumSquares / (self.n - 1)) if self.n > 1 else math.nan
+
+
+class CycleStatistics:
+    """
+    Statistics of the amplitudes of a trial per channel, updated for every
+    detected cycle in constant time, so they are known during the trial and
+    saved with it without a second pass over the amplitudes:
+
+        nCycles, mean, sd, cv    - amplitude (cv = sd / mean)
+        meanError, rmsError      - amplitude minus the target of the channel
+        inBand                   - fraction of the cycles inside the target bar
+                                   (target +/- targetSize / 2)
+        period, periodSd         - time between successive cycles (s)
+
+    Only cycles from the start of the trial (startIndex) on are counted.
+    """
+
+    def __init__(self, nChannels, sampleFrequency, targets, targetSize):
+
+        self.nChannels = nChannels
+        self.sampleFrequency = sampleFrequency
+        self.targets = [float(target) for target in targets]
+        self.targetSize = float(targetSize)
+
+        self.amplitudes = [RunningStatistics() for channel in range(nChannels)]
+        self.periods = [RunningStatistics() for channel in range(nChannels)]
+        self.sumErrors = [0.0] * nChannels
+        self.sumSquaredErrors = [0.0] * nChannels
+        self.nInBand = [0] * nChannels
+        self.lastCycleIndex = [None] * nChannels
+
+    def update(self, cycleChannels, cycleIndices, amplitudes, startIndex=0):
+        """
+        Add the cycles of a DetectionResult. Returns the channels with new
+        cycles.
+        """
+
+        updated = set()
+        for channel, cycleIndex, amplitude in zip(cycleChannels.tolist(),
+                                                  cycleIndices.tolist(),
+                                                  amplitudes.tolist()):
+            lastCycleIndex = self.lastCycleIndex[channel]
+            self.lastCycleIndex[channel] = cycleIndex
+            if cycleIndex < startIndex:
+                continue
+
+            error = amplitude - self.targets[channel]
+            self.amplitudes[channel].add(amplitude)
+            self.sumErrors[channel] += error
+            self.sumSquaredErrors[channel] += error ** 2
+            if abs(error) <= self.targetSize / 2:
+                self.nInBand[channel] += 1
+            if lastCycleIndex is not None:
+                self.periods[channel].add((cycleIndex - lastCycleIndex) / self.sampleFrequency)
+            updated.add(channel)
+
+        return sorted(updated)
+
+    def in_band(self, channel):
+        # fraction of the cycles inside the target bar, NaN before the first cycle
+        nCycles = self.amplitudes[channel].n
+        return self.nInBand[channel] / nCycles if nCycles else math.nan
+
+    def channel_summary(self, channel):
+
+        amplitudes = self.amplitudes[channel]
+        nCycles = amplitudes.n
+        mean = amplitudes.mean if nCycles else math.nan
+        return {
+            "target": self.targets[channel],
+            "nCycles": nCycles,
+            "mean": mean,
+            "sd": amplitudes.sd,
+            "cv": amplitudes.sd / mean if nCycles > 1 and mean else math.nan,
+            "meanError": self.sumErrors[channel] / nCycles if nCycles else math.nan,
+            "rmsError": math.sqrt(self.sumSquaredErrors[channel] / nCycles)
+            if nCycles else math.nan,
+            "inBand": self.in_band(channel),
+            "period": self.periods[channel].mean if self.periods[channel].n else math.nan,
+            "periodSd": self.periods[channel].sd,
+        }
+
+    def to_dict(self):
+        """Statistics per channel, to be saved with the trial."""
+
+        # NaN (not enough cycles) is saved as None to keep the header valid JSON
+        return {
+            "targetSize": self.targetSize,
+            "channels": [{key: (value if not isinstance(value, float) or np.isfinite(value)
+                                else None)
+                          for key, value in self.channel_summary(channel).items()}
+                         for channel in range(self.nChannels)],
+        }
+
+    def print_summary(self, limbNames):
+
+        print("Amplitude per cycle:")
+        for channel in range(self.nChannels):
+            summary = self.channel_summary(channel)
+            if summary["nCycles"] == 0:
+                print(f"    {limbNames[channel]:>5}: no cycles")
+                continue
+            # the SD, CV and period need at least two cycles
+            if summary["nCycles"] == 1:
+                print(f"    {limbNames[channel]:>5}: mean = {summary['mean']:.1f}, "
+                      f"RMS error = {summary['rmsError']:.1f}, "
+                      f"{100 * summary['inBand']:.0f}% on target (1 cycle)")
+                continue
+            print(f"    {limbNames[channel]:>5}: mean = {summary['mean']:.1f} "
+                  f"(SD {summary['sd']:.1f}, CV {100 * summary['cv']:.0f}%), "
+                  f"RMS error = {summary['rmsError']:.1f}, "
+                  f"period = {summary['period']:.2f} s, "
+                  f"{100 * summary['inBand']:.0f}% on target ({summary['nCycles']} cycles)")
+
+
+def accuracy_text(inBand):
+    # running accuracy shown above a feedback bar
+    return f"{100 * inBand:.0f}%" if np.isfinite(inBand) else ""
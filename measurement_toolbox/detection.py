@@ -0,0 +1,332 @@
+# detection.py
+
+# %% imports
+import collections
+import numpy as np
+
+# %% Detection settings
+
+# the lower this threshold the higher the sensitivity for finding peaks.
+THRESHOLD = 0.05
+
+# the threshold was tuned on a signal sampled once per frame (~20 frames/s),
+# so the slope is taken over the same time interval at the full sample rate
+SLOPE_INTERVAL = 0.05
+
+# adaptive threshold: a slope must be NOISE_FACTOR times the SD of the slope
+# noise, and at least MIN_THRESHOLD volt and MIN_STEPS ADC steps, so that
+# flipping between neighbouring ADC levels is never taken for a movement. It
+# is never above THRESHOLD. The noise is taken from the quietest NOISE_WINDOW
+# seconds of the baseline
+NOISE_FACTOR = 5.0
+MIN_THRESHOLD = 0.01
+MIN_STEPS = 4
+NOISE_WINDOW = 0.5
+
+
+def slope_lag(sampleFrequency):
+    # number of samples in one slope interval
+    return max(1, round(sampleFrequency * SLOPE_INTERVAL))
+
+# %% Detection results
+
+# peaks: channel, absolute sample index and type (+1 maximum, -1 minimum) of
+# every new peak
+# cycles: channel, sample index of the closing peak and calibrated amplitude
+DetectionResult = collections.namedtuple(
+    "DetectionResult",
+    ["peakChannels", "peakIndices", "peakSigns", "cycleChannels", "cycleIndices",
+     "amplitudes"])
+
+# %% Streaming peak detector
+
+
+class PeakDetector:
+    """
+    Streaming, multi-channel version of the peak detection algorithm described
+    in the README.
+
+    Every call to process() takes all samples that arrived since the previous
+    call for all channels at once, so peaks are found at the full sample rate.
+    The state of the slope/peak state machine is kept in arrays with shape
+    (nChannels,) and all channels are updated with the same array operations.
+
+    The slope of sample n is taken as x[n] - x[n - slopeLag]. With a lag that
+    matches the old frame interval the original threshold keeps its meaning.
+    The calibration slopes convert the voltage amplitudes to sensor units.
+    Calibration models (calibration.CalibrationModel, one per channel) can be
+    given instead, for non-linear sensors: the peak values are converted to
+    units before the amplitude is taken.
+
+    With a prefilter (e.g. filters.LowPassFilter) every block is filtered
+    before the detection; the peak and cycle indices are corrected for the
+    delay of the filter.
+    """
+
+    def __init__(self, nChannels, threshold, slopeLag=1, calibrationSlopes=None,
+                 historyLength=4096, calibrationModels=None, prefilter=None):
+
+        self.nChannels = nChannels
+        self.slopeLag = max(1, int(slopeLag))
+        self.set_threshold(threshold)
+
+        if calibrationSlopes is None:
+            calibrationSlopes = np.ones(nChannels)
+        self.calibrationSlopes = np.asarray(calibrationSlopes, dtype=float)
+        self.calibrationModels = calibrationModels
+        self.prefilter = prefilter
+        self.prefilterDelay = 0 if prefilter is None else int(round(prefilter.delay))
+
+        # number of samples processed so far (absolute sample index of next sample)
+        self.sampleCount = 0
+
+        # last samples of the previous block, needed for the lagged slope
+        self.tail = np.empty((nChannels, 0))
+
+        # last thresholded slope (+1/-1, 0 if none yet) and its sample index
+        self.lastSlopeSign = np.zeros(nChannels, dtype=np.int8)
+        self.lastSlopeIndex = np.full(nChannels, -1, dtype=np.int64)
+
+        # first peak of a pair waiting for its counterpart
+        self.hasPendingPeak = np.zeros(nChannels, dtype=bool)
+        self.pendingPeakValue = np.zeros(nChannels)
+        self.pendingPeakIndex = np.zeros(nChannels, dtype=np.int64)
+
+        # recent samples used to look up the value at a peak index
+        self.history = np.zeros(
+            (nChannels, max(int(historyLength), 2 * self.slopeLag)))
+
+    def set_threshold(self, threshold):
+
+        # scalar or one threshold per channel
+        self.threshold = np.broadcast_to(
+            np.asarray(threshold, dtype=float), (self.nChannels,)).reshape(-1, 1)
+
+    def process(self, block):
+        """
+        Process a block of new samples with shape (nChannels, nSamples).
+        Returns a DetectionResult with the new peaks and the amplitudes of the
+        cycles that were completed in this block.
+        """
+
+        block = np.asarray(block, dtype=float).reshape(self.nChannels, -1)
+        if self.prefilter is not None:
+            block = self.prefilter.process(block)
+        blockStart = self.sampleCount
+        self.sampleCount += block.shape[1]
+        self._store_history(block, blockStart)
+
+        # lagged slope over the previous tail and the new block
+        extended = np.concatenate((self.tail, block), axis=1)
+        self.tail = extended[:, -self.slopeLag:]
+
+        if extended.shape[1] <= self.slopeLag:
+            return self._empty_result()
+
+        slope = extended[:, self.slopeLag:] - extended[:, :-self.slopeLag]
+        nSlopes = slope.shape[1]
+        firstIndex = self.sampleCount - nSlopes
+
+        # thresholded slope detection, with the last slope of the previous
+        # block as column 0
+        signs = np.empty((self.nChannels, nSlopes + 1), dtype=np.int8)
+        signs[:, 0] = self.lastSlopeSign
+        signs[:, 1:] = (slope > self.threshold).astype(np.int8) - \
+            (slope < -self.threshold).astype(np.int8)
+
+        # column of the most recent slope at or before every column
+        columns = np.arange(nSlopes + 1)
+        lastColumn = np.maximum.accumulate(
+            np.where(signs != 0, columns, -1), axis=1)
+
+        # sample index of every column (column 0 holds the previous slope)
+        columnIndices = np.empty((self.nChannels, nSlopes + 1), dtype=np.int64)
+        columnIndices[:, 0] = self.lastSlopeIndex
+        columnIndices[:, 1:] = firstIndex + columns[:-1]
+
+        previousColumn = lastColumn[:, :-1]
+        hasPrevious = previousColumn >= 0
+        previousColumn = np.maximum(previousColumn, 0)
+        previousSign = np.take_along_axis(signs, previousColumn, axis=1) * hasPrevious
+        currentSign = signs[:, 1:]
+
+        # a peak lies in the middle of the last slope before and the first slope
+        # after a change of direction
+        changes = (currentSign != 0) & (previousSign != 0) & (currentSign != previousSign)
+        peakChannels, peakColumns = np.nonzero(changes)
+        previousIndex = np.take_along_axis(
+            columnIndices, previousColumn, axis=1)[peakChannels, peakColumns]
+        peakIndices = (previousIndex + firstIndex + peakColumns) // 2 - self.slopeLag // 2
+        peakIndices = np.maximum(peakIndices, 0)
+        # a rising slope before the change makes the peak a maximum
+        peakSigns = previousSign[peakChannels, peakColumns]
+
+        # remember the last slope of every channel
+        lastSlope = lastColumn[:, -1]
+        hasSlope = lastSlope >= 0
+        rows = np.flatnonzero(hasSlope)
+        self.lastSlopeSign[rows] = signs[rows, lastSlope[rows]]
+        self.lastSlopeIndex[rows] = columnIndices[rows, lastSlope[rows]]
+
+        cycleChannels, cycleIndices, amplitudes = self._pair_amplitudes(
+            peakChannels, peakIndices)
+
+        # indices of the filtered signal are later than those of the movement
+        if self.prefilterDelay:
+            peakIndices = np.maximum(peakIndices - self.prefilterDelay, 0)
+            cycleIndices = np.maximum(cycleIndices - self.prefilterDelay, 0)
+
+        return DetectionResult(peakChannels, peakIndices, peakSigns,
+                               cycleChannels, cycleIndices, amplitudes)
+
+    def _empty_result(self):
+
+        emptyIndices = np.empty(0, dtype=np.int64)
+        return DetectionResult(emptyIndices, emptyIndices, np.empty(0, dtype=np.int8),
+                               emptyIndices, emptyIndices, np.empty(0))
+
+    def _store_history(self, block, blockStart):
+
+        historyLength = self.history.shape[1]
+        if block.shape[1] > historyLength:
+            blockStart += block.shape[1] - historyLength
+            block = block[:, -historyLength:]
+
+        positions = np.arange(blockStart, blockStart + block.shape[1]) % historyLength
+        self.history[:, positions] = block
+
+    def _pair_amplitudes(self, peakChannels, peakIndices):
+
+        # peaks older than the history are clipped to the oldest stored sample
+        historyLength = self.history.shape[1]
+        oldest = max(0, self.sampleCount - historyLength)
+        peakValues = self.history[peakChannels,
+                                  np.maximum(peakIndices, oldest) % historyLength]
+
+        # pending peaks go in front of the new peaks of their channel
+        pendingChannels = np.flatnonzero(self.hasPendingPeak)
+        channels = np.concatenate((pendingChannels, peakChannels))
+        values = np.concatenate((self.pendingPeakValue[pendingChannels], peakValues))
+        indices = np.concatenate((self.pendingPeakIndex[pendingChannels], peakIndices))
+
+        order = np.argsort(channels, kind="stable")
+        channels, values, indices = channels[order], values[order], indices[order]
+
+        # rank of every peak within its channel
+        counts = np.bincount(channels, minlength=self.nChannels)
+        starts = np.cumsum(counts) - counts
+        ranks = np.arange(len(channels)) - starts[channels]
+
+        # two consecutive peaks (a maximum and a minimum) form one amplitude
+        closing = np.flatnonzero(ranks % 2 == 1)
+        cycleChannels = channels[closing]
+        if self.calibrationModels is None:
+            amplitudes = np.abs(values[closing] - values[closing - 1]) * \
+                self.calibrationSlopes[cycleChannels]
+        else:
+            units = np.empty(len(values))
+            for channel in np.unique(channels):
+                inChannel = channels == channel
+                units[inChannel] = self.calibrationModels[channel].transform(values[inChannel])
+            amplitudes = units[closing] - units[closing - 1]
+
+        # a channel with an odd number of peaks keeps its last peak pending
+        self.hasPendingPeak = counts % 2 == 1
+        last = np.flatnonzero(self.hasPendingPeak)
+        lastPositions = starts[last] + counts[last] - 1
+        self.pendingPeakValue[last] = values[lastPositions]
+        self.pendingPeakIndex[last] = indices[lastPositions]
+
+        return cycleChannels, indices[closing], np.abs(amplitudes)
+
+# %% Noise-adaptive threshold
+
+
+def estimate_noise(baseline, prefilter=None, slopeLag=1, windowSize=None):
+    """
+    SD of the slope noise per channel of a (nChannels, nSamples) baseline, and
+    the largest slope in the window it was taken from. The baseline is
+    filtered as by the PeakDetector (with a new filter state) and the slope is
+    taken over the same lag. The slopes are split in windows of windowSize
+    (the whole baseline when None) and the noise is the robust SD of the
+    quietest window (with the smallest largest slope), so a participant who
+    rests for part of the baseline is enough. When the participant moves all
+    the time, every window contains movement and the largest slope shows it.
+    """
+
+    baseline = np.asarray(baseline, dtype=float)
+    if prefilter is not None:
+        baseline = prefilter.copy().process(baseline)
+
+    slope = baseline[:, slopeLag:] - baseline[:, :-slopeLag]
+    nChannels, nSlopes = slope.shape
+    if windowSize is None or windowSize >= nSlopes:
+        windows = slope[:, np.newaxis, :]
+    else:
+        nWindows = nSlopes // windowSize
+        windows = slope[:, :nWindows * windowSize].reshape(nChannels, nWindows, windowSize)
+
+    largestSlopes = np.max(np.abs(windows), axis=2)
+    quietest = windows[np.arange(nChannels), np.argmin(largestSlopes, axis=1)]
+
+    deviation = np.abs(quietest - np.median(quietest, axis=1, keepdims=True))
+    return 1.4826 * np.median(deviation, axis=1), np.min(largestSlopes, axis=1)
+
+
+def quantization_step(channelData):
+    """
+    Smallest difference between two sample values per channel, the ADC step
+    for quantized samples (0 when a channel has a single value).
+    """
+
+    steps = []
+    for values in np.asarray(channelData, dtype=float):
+        differences = np.diff(np.unique(values))
+        steps.append(differences.min() if differences.size else 0.0)
+    return np.array(steps)
+
+
+def adaptive_threshold(baseline, prefilter=None, slopeLag=1, windowSize=None,
+                       factor=NOISE_FACTOR, minimum=MIN_THRESHOLD, minSteps=MIN_STEPS,
+                       maximum=THRESHOLD):
+    """
+    Slope threshold per channel from the noise in a baseline recording, and
+    the SD of the slope noise. The threshold is at least minimum volt and
+    minSteps ADC steps, and at most maximum (the fixed threshold). A channel
+    that is not at rest in any window of the baseline (a slope of maximum or
+    more) gets the fixed threshold, and NaN as noise.
+    """
+
+    noise, largestSlope = estimate_noise(baseline, prefilter, slopeLag, windowSize)
+    minimum = np.maximum(minimum, minSteps * quantization_step(baseline))
+    threshold = np.minimum(np.maximum(factor * noise, minimum), maximum)
+
+    atRest = largestSlope < maximum
+    return np.where(atRest, threshold, maximum), np.where(atRest, noise, np.nan)
+
+# %% Offline detection
+
+
+def detect_recording(channelData, sampleFrequency, calibrationSlopes=None,
+                     threshold=THRESHOLD, blockSize=1024, calibrationModels=None,
+                     prefilter=None):
+    """
+    Run the online peak detection over a complete recording with shape
+    (nChannels, nSamples), block by block like during a measurement.
+    Returns one DetectionResult with all peaks and cycles.
+    """
+
+    channelData = np.asarray(channelData, dtype=float)
+    detector = PeakDetector(channelData.shape[0], threshold,
+                            slopeLag=slope_lag(sampleFrequency),
+                            calibrationSlopes=calibrationSlopes,
+                            historyLength=max(4096, 2 * blockSize),
+                            calibrationModels=calibrationModels,
+                            prefilter=prefilter)
+
+    results = [detector.process(channelData[:, start:start + blockSize])
+               for start in range(0, channelData.shape[1], blockSize)]
+    if not results:
+        return detector._empty_result()
+
+    return DetectionResult(*[np.concatenate(field) for field in zip(*results)])
@@ -0,0 +1,148 @@
+# feedback_figure.py
+
+# %% imports
+from .cycle_statistics import accuracy_text
+
+# %% Settings
+
+# screen settings feedback figure
+# enter the resolution of your first monitor
+firstMonitorRes = (1920, 1080)
+secondMonitorAvailable = False  # True if you use a second monitor; False if not
+# enter the resolution of your second monitor
+secondMonitorRes = (1920, 1080)
+window_width = 800  # change window width of feedback figure
+window_height = 600  # change window height of feedback figure
+
+# x position of the feedback bar per channel (AI0 drives the right bar, AI1
+# the left bar)
+FEEDBACK_BAR_X = [[2.8, 4.2], [0.8, 2.2]]
+
+
+def window_geometry():
+    """
+    Position and size (x, y, width, height) of the feedback window: in the
+    middle of the first screen or in the second screen.
+    """
+
+    if secondMonitorAvailable:
+        window_x = (
+            (firstMonitorRes[0]-window_width) // 2) + secondMonitorRes[0]
+        window_y = (secondMonitorRes[1] - window_height) // 2
+    else:
+        window_x = ((firstMonitorRes[0]-window_width) // 2)
+        window_y = (firstMonitorRes[1] - window_height) // 2
+    return window_x, window_y, window_width, window_height
+
+# %% Feedback figure
+
+
+class FeedbackFigure:
+    """
+    Feedback figure for the participant: a blue range bar and an orange
+    target per limb, and a red bar at the amplitude of the last cycle. With
+    showAccuracy the percentage of the cycles on target so far is shown
+    above each bar.
+    """
+
+    def __init__(self, left_target_A, right_target_A, minAmplitude, maxAmplitude,
+                 targetSize, feedbackBarSize, nChannels=2, showAccuracy=False):
+
+        # matplotlib is imported when the figure is made
+        import matplotlib.pyplot as plt
+        from matplotlib.patches import Rectangle
+
+        self.targetSize = targetSize
+        self.showAccuracy = showAccuracy
+
+        # makes sure the middle of the target = the given target amplitude
+        left_target_A = left_target_A - (targetSize/2)
+        right_target_A = right_target_A - (targetSize/2)
+
+        # Setup online feedback plot
+        self.fig, self.ax = plt.subplots()
+        manager = plt.get_current_fig_manager()
+
+        # plot feedback figure in the middle of the first screen or in the
+        # second screen (only Qt windows can be placed)
+        if hasattr(getattr(manager, "window", None), "setGeometry"):
+            manager.window.setGeometry(*window_geometry())
+
+        ax2 = self.ax
+        # manager.window.showMaximized()
+        ax2.set_xlim([0, 5])
+        ax2.set_ylim([minAmplitude, maxAmplitude])
+        # ax2.axis('off')
+
+        # plot blue range bars
+        leftRangeRectangle = Rectangle(xy=(1, 0),
+                                       width=1,
+                                       height=maxAmplitude,
+                                       color='b', zorder=1)
+        ax2.add_patch(leftRangeRectangle)
+
+        rightRangeRectangle = Rectangle(xy=(3, 0),
+                                        width=1,
+                                        height=maxAmplitude,
+                                        color='b', zorder=1)
+        ax2.add_patch(rightRangeRectangle)
+
+        # plot Target
+        leftTargetRectangle = Rectangle(xy=(1, left_target_A),
+                                        width=1,
+                                        height=targetSize,
+                                        color='orange', alpha=1.0, zorder=2)
+        ax2.add_patch(leftTargetRectangle)
+
+        rightTargetRectangle = Rectangle(xy=(3, right_target_A),
+                                         width=1,
+                                         height=targetSize,
+                                         color='orange', alpha=1.0, zorder=2)
+        ax2.add_patch(rightTargetRectangle)
+        self.targetRectangles = [leftTargetRectangle, rightTargetRectangle]
+
+        # plots for current amplitude
+        for channel in range(nChannels):
+            ax2.plot([], [], lw=feedbackBarSize, c='red')
+
+        # running accuracy above each bar
+        self.accuracyTexts = [
+            ax2.text(sum(FEEDBACK_BAR_X[channel]) / 2, maxAmplitude, "",
+                     ha='center', va='bottom', fontsize=14, visible=showAccuracy)
+            for channel in range(nChannels)]
+
+    def set_targets(self, left_target_A, right_target_A):
+
+        # new targets for the next trial, without amplitude bars
+        for rectangle, target in zip(self.targetRectangles, (left_target_A, right_target_A)):
+            rectangle.set_y(target - (self.targetSize/2))
+        for line in self.ax.lines:
+            line.set_data([], [])
+        for text in self.accuracyTexts:
+            text.set_text("")
+        self.draw()
+
+    def is_open(self):
+        import matplotlib.pyplot as plt
+        return plt.fignum_exists(self.fig.number)
+
+    def set_amplitude(self, channel, amplitude):
+
+        # shown with the next draw()
+        self.ax.lines[channel].set_xdata(FEEDBACK_BAR_X[channel])
+        self.ax.lines[channel].set_ydata([amplitude, amplitude])
+
+    def set_accuracy(self, channel, inBand):
+        # fraction of the cycles inside the target, shown with the next draw()
+        self.accuracyTexts[channel].set_text(accuracy_text(inBand))
+
+    def draw(self):
+        self.fig.canvas.draw_idle()
+
+    def flush_events(self):
+        # makes sure that the figure is responsive
+        self.fig.canvas.flush_events()
+
+    def close(self):
+        import matplotlib.pyplot as plt
+        plt.close(self.fig)
@@ -0,0 +1,206 @@
+# feedback_window.py
+#
+# Feedback display for the participant painted directly with Qt, without a
+# matplotlib figure. It has the layout of the feedback figure (the parameters
+# of designFeedbackFigure.py) and is only repainted when a new amplitude
+# arrives. Painting takes about a millisecond, so a new amplitude is on screen
+# with the next refresh of the display.
+#
+# It runs in its own process (renderMode = "process"), which checks for new
+# cycles once per refresh of the display:
+#   python -m measurement_toolbox.feedback_window '<settings as JSON>'
+
+# %% imports
+import argparse
+import json
+import time
+import numpy as np
+
+# the Qt binding that matplotlib uses (PyQt5, PySide2, PyQt6 or PySide6)
+from matplotlib.backends.qt_compat import QtCore, QtGui, QtWidgets
+
+from .buffers import SharedRing
+from .cycle_statistics import accuracy_text
+from .feedback_figure import FEEDBACK_BAR_X, window_geometry
+from .render_process import EVENT_ACCURACY, EVENT_CYCLE, RenderStatus, start_module
+
+# %% Feedback window
+
+
+class FeedbackWindow(QtWidgets.QWidget):
+    """
+    Qt version of FeedbackFigure: a blue range bar and an orange target per
+    limb, and a red bar at the amplitude of the last cycle, in the coordinates
+    of the feedback figure (x from 0 to 5, y from minAmplitude to
+    maxAmplitude). feedbackBarSize is the height of the red bar in points, as
+    the line width in the figure. With showAccuracy the percentage of the
+    cycles on target so far is shown above each bar.
+    """
+
+    XLIM = (0, 5)
+
+    def __init__(self, left_target_A, right_target_A, minAmplitude, maxAmplitude,
+                 targetSize, feedbackBarSize, nChannels=2, showAccuracy=False):
+
+        # a QApplication must exist before the first widget is made
+        self.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+        super().__init__()
+
+        self.ylim = (minAmplitude, maxAmplitude)
+        self.targetSize = targetSize
+        self.feedbackBarSize = feedbackBarSize
+
+        # (x, y, width, height) of the range bars and the targets; the middle
+        # of the target = the given target amplitude
+        self.rangeBars = [(1, 0, 1, maxAmplitude), (3, 0, 1, maxAmplitude)]
+        self.targets = [(1, left_target_A - (targetSize/2), 1, targetSize),
+                        (3, right_target_A - (targetSize/2), 1, targetSize)]
+
+        # amplitude of the last cycle per channel, None before the first cycle
+        self.amplitudes = [None] * nChannels
+        self.displayedTime = None
+
+        # running accuracy per channel, "" before the first cycle
+        self.showAccuracy = showAccuracy
+        self.accuracyTexts = [""] * nChannels
+
+        self.setWindowTitle("Feedback")
+        self.setGeometry(*window_geometry())
+        self.show()
+
+    def set_amplitude(self, channel, amplitude):
+        # shown with the next draw()
+        self.amplitudes[channel] = float(amplitude)
+
+    def set_accuracy(self, channel, inBand):
+        # shown with the next draw()
+        self.accuracyTexts[channel] = accuracy_text(inBand)
+
+    def draw(self):
+        # paints right away, not with the next pass of the event loop
+        self.repaint()
+
+    def refresh_interval(self):
+        # ms between two refreshes of the screen of the window
+        screen = self.screen() if hasattr(self, "screen") else None
+        refreshRate = screen.refreshRate() if screen is not None else 0
+        return 1000 / refreshRate if refreshRate > 0 else 1000 / 60
+
+    def to_pixels(self, x, y):
+        xPixels = (x - self.XLIM[0]) / (self.XLIM[1] - self.XLIM[0]) * self.width()
+        yPixels = (self.ylim[1] - y) / (self.ylim[1] - self.ylim[0]) * self.height()
+        return xPixels, yPixels
+
+    def data_rect(self, x, y, width, height):
+
+        left, top = self.to_pixels(x, y + height)
+        right, bottom = self.to_pixels(x + width, y)
+        return QtCore.QRectF(left, top, right - left, bottom - top)
+
+    def paintEvent(self, event):
+
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtGui.QColor("white"))
+
+        for rangeBar in self.rangeBars:
+            painter.fillRect(self.data_rect(*rangeBar), QtGui.QColor("blue"))
+        for target in self.targets:
+            painter.fillRect(self.data_rect(*target), QtGui.QColor("orange"))
+
+        # the red bar is centred on the amplitude
+        barHeight = self.feedbackBarSize * self.logicalDpiY() / 72
+        for channel, amplitude in enumerate(self.amplitudes):
+            if amplitude is None:
+                continue
+            left, y = self.to_pixels(FEEDBACK_BAR_X[channel][0], amplitude)
+            right, y = self.to_pixels(FEEDBACK_BAR_X[channel][1], amplitude)
+            painter.fillRect(QtCore.QRectF(left, y - barHeight / 2, right - left, barHeight),
+                             QtGui.QColor("red"))
+
+        # running accuracy at the top of each bar
+        if self.showAccuracy:
+            painter.setPen(QtGui.QColor("white"))
+            font = painter.font()
+            font.setPointSize(14)
+            painter.setFont(font)
+            for channel, text in enumerate(self.accuracyTexts):
+                left, top = self.to_pixels(FEEDBACK_BAR_X[channel][0], self.ylim[1])
+                right, _ = self.to_pixels(FEEDBACK_BAR_X[channel][1], self.ylim[1])
+                painter.drawText(QtCore.QRectF(left, top, right - left, 2 * font.pointSize()),
+                                 int(QtCore.Qt.AlignmentFlag.AlignHCenter |
+                                     QtCore.Qt.AlignmentFlag.AlignTop), text)
+
+        painter.end()
+        self.displayedTime = time.perf_counter()
+
+# %% Feedback process
+
+
+def run_feedback_window(settings):
+    """
+    Shows the feedback window until the trial ends. settings:
+
+        events, status - names of the shared memory blocks (see render_process.py)
+        nChannels
+        feedback       - arguments of FeedbackWindow
+    """
+
+    events = SharedRing(name=settings["events"])
+    status = RenderStatus(settings["status"])
+
+    window = FeedbackWindow(**settings["feedback"], nChannels=settings["nChannels"])
+    eventsReader = events.reader()
+
+    def check_events():
+
+        if not status["running"]:
+            window.app.quit()
+            return
+
+        newEvents = eventsReader.read()
+        cycles = np.flatnonzero(newEvents[0] == EVENT_CYCLE)
+        if len(cycles) == 0:
+            return
+
+        for event in cycles:
+            window.set_amplitude(int(newEvents[1, event]), newEvents[3, event])
+        for event in np.flatnonzero(newEvents[0] == EVENT_ACCURACY):
+            window.set_accuracy(int(newEvents[1, event]), newEvents[3, event])
+        window.draw()
+
+        # the time is written first, the measurement process reads the count first
+        status["displayedTime"] = window.displayedTime
+        status["displayedEvents"] = eventsReader.position
+
+    # check for new cycles once per refresh of the display
+    timer = QtCore.QTimer()
+    timer.setTimerType(QtCore.Qt.TimerType.PreciseTimer)
+    timer.timeout.connect(check_events)
+    timer.start(max(1, int(window.refresh_interval())))
+
+    status["feedbackReady"] = 1
+    window.app.exec()
+
+    timer.stop()
+    window.close()
+    events.close()
+    status.close()
+
+
+def start_feedback_window(settings):
+    """Starts the feedback process, settings as for run_feedback_window."""
+    return start_module("measurement_toolbox.feedback_window", settings)
+
+
+def main(arguments=None):
+
+    parser = argparse.ArgumentParser(
+        description="Show the feedback of a measurement in a separate process.")
+    parser.add_argument("settings", help="settings as JSON (see run_feedback_window)")
+    args = parser.parse_args(arguments)
+
+    run_feedback_window(json.loads(args.settings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# filters.py
+
+# %% imports
+import numpy as np
+
+# %% Streaming low-pass filter
+
+
+class LowPassFilter:
+    """
+    Butterworth low-pass filter for blocks of samples with shape
+    (nChannels, nSamples). The filter state is kept between blocks, so
+    filtering block by block gives the same result as filtering the whole
+    recording at once.
+
+    delay is the delay of the filter for slow movements in samples (the group
+    delay at 0 Hz).
+    """
+
+    def __init__(self, nChannels, sampleFrequency, cutoff=10.0, order=2):
+
+        # scipy is imported when a filter is made, not with the toolbox
+        from scipy import signal
+
+        self.nChannels = nChannels
+        self.sampleFrequency = sampleFrequency
+        self.cutoff = cutoff
+        self.order = order
+        self.sos = signal.butter(order, cutoff, fs=sampleFrequency, output="sos")
+
+        impulse = np.zeros(int(20 * sampleFrequency / cutoff))
+        impulse[0] = 1
+        response = signal.sosfilt(self.sos, impulse)
+        self.delay = float(np.sum(np.arange(len(response)) * response) / np.sum(response))
+
+        self._sosfilt = signal.sosfilt
+        self._initialState = signal.sosfilt_zi(self.sos)
+        self.state = None
+
+    def reset(self):
+        self.state = None
+
+    def copy(self):
+        # a filter with the same settings and a new state
+        return LowPassFilter(self.nChannels, self.sampleFrequency, self.cutoff, self.order)
+
+    def process(self, block):
+
+        block = np.asarray(block, dtype=float)
+        if block.shape[1] == 0:
+            return block
+
+        # start in steady state at the first sample, without a transient
+        if self.state is None:
+            self.state = self._initialState[:, np.newaxis, :] * \
+                block[np.newaxis, :, :1]
+
+        filtered, self.state = self._sosfilt(self.sos, block, axis=1, zi=self.state)
+        return filtered
@@ -0,0 +1,158 @@
+# latency.py
+
+# %% imports
+import time
+import numpy as np
+
+from .buffers import SampleBuffer
+
+# %% Feedback latency
+
+
+class LatencyRecorder:
+    """
+    Timestamps every pipeline stage of each detected cycle:
+
+        reversal  - the sample of the movement reversal (the peak that
+                    completes the cycle), estimated from the read time of its
+                    DAQ block and its position in that block
+        read      - the DAQ block containing the reversal was read
+        detected  - the detector emitted the amplitude of the cycle
+        displayed - the feedback canvas was flushed with the new bar
+
+    The acquisition thread calls record_block() after every read, the
+    visualisation calls record_cycles() and record_display(). All times are
+    time.perf_counter() values; latencies are relative to the reversal.
+    """
+
+    STAGES = ("read", "detected", "displayed")
+
+    def __init__(self, sampleFrequency):
+
+        self.sampleFrequency = sampleFrequency
+
+        # per block: sample count after the read and the read time
+        self.blocks = SampleBuffer(2, initialCapacity=2**12)
+
+        self.channels = []
+        self.reversalIndices = []
+        self.reversalTimes = []
+        self.readTimes = []
+        self.detectedTimes = []
+        self.displayedTimes = []
+
+        # cycles detected but not displayed yet (positions in the lists above)
+        self.pendingDisplay = []
+
+    def record_block(self, sampleCount):
+
+        # called by the acquisition thread right after a read
+        self.blocks.write([[sampleCount], [time.perf_counter()]])
+
+    def record_cycles(self, cycleChannels, cycleIndices, detectedTime=None):
+
+        if len(cycleIndices) == 0:
+            return
+        if detectedTime is None:
+            detectedTime = time.perf_counter()
+
+        blocks = self.blocks.get(0, len(self.blocks))
+        blockEnds, blockTimes = blocks[0], blocks[1]
+
+        # the block that contains each reversal sample
+        positions = np.minimum(np.searchsorted(blockEnds, cycleIndices, side="right"),
+                               len(blockEnds) - 1)
+        readTimes = blockTimes[positions]
+        reversalTimes = readTimes - (blockEnds[positions] - 1 - cycleIndices) / \
+            self.sampleFrequency
+
+        first = len(self.channels)
+        self.channels.extend(int(channel) for channel in cycleChannels)
+        self.reversalIndices.extend(int(index) for index in cycleIndices)
+        self.reversalTimes.extend(reversalTimes)
+        self.readTimes.extend(readTimes)
+        self.detectedTimes.extend([detectedTime] * len(cycleIndices))
+        self.displayedTimes.extend([np.nan] * len(cycleIndices))
+        self.pendingDisplay.extend(range(first, len(self.channels)))
+
+    def record_display(self, displayedTime=None, nCycles=None):
+
+        # all cycles detected so far (or the first nCycles of them, when the
+        # display runs in another process) are now visible to the participant
+        if displayedTime is None:
+            displayedTime = time.perf_counter()
+        if nCycles is None:
+            nCycles = len(self.pendingDisplay)
+
+        for position in self.pendingDisplay[:nCycles]:
+            self.displayedTimes[position] = displayedTime
+        self.pendingDisplay = self.pendingDisplay[nCycles:]
+
+    def sample_indices(self, times):
+        """
+        Converts perf_counter times (e.g. metronome beats) to DAQ sample
+        indices. A block is never read before its last sample was measured,
+        so the block with the smallest delay gives the start of the sample clock.
+        """
+
+        times = np.asarray(times, dtype=float)
+        if len(self.blocks) == 0 or len(times) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        blocks = self.blocks.get(0, len(self.blocks))
+        clockStart = np.min(blocks[1] - blocks[0] / self.sampleFrequency)
+        return np.round((times - clockStart) * self.sampleFrequency).astype(np.int64)
+
+    def latencies(self):
+        """Returns per stage an array with the latency (s) of every cycle."""
+
+        reversalTimes = np.asarray(self.reversalTimes)
+        return {"read": np.asarray(self.readTimes) - reversalTimes,
+                "detected": np.asarray(self.detectedTimes) - reversalTimes,
+                "displayed": np.asarray(self.displayedTimes) - reversalTimes}
+
+    def summary(self):
+        """Returns per stage the p50, p95 and maximum latency in seconds."""
+
+        summary = {}
+        for stage, values in self.latencies().items():
+            values = values[np.isfinite(values)]
+            if len(values) == 0:
+                summary[stage] = {"n": 0, "p50": None, "p95": None, "max": None}
+                continue
+
+            summary[stage] = {"n": int(len(values)),
+                              "p50": float(np.percentile(values, 50)),
+                              "p95": float(np.percentile(values, 95)),
+                              "max": float(np.max(values))}
+
+        return summary
+
+    def to_dict(self):
+        """Per-cycle latencies and their summary, to be saved with the trial."""
+
+        latencies = self.latencies()
+        return {
+            "channel": self.channels,
+            "reversalIndex": self.reversalIndices,
+            # NaN (not displayed) is saved as None to keep the header valid JSON
+            "readLatency": _to_list(latencies["read"]),
+            "detectionLatency": _to_list(latencies["detected"]),
+            "displayLatency": _to_list(latencies["displayed"]),
+            "summary": self.summary(),
+        }
+
+    def print_summary(self):
+
+        print("Feedback latency after a movement reversal:")
+        for stage, values in self.summary().items():
+            if values["n"] == 0:
+                print(f"    {stage:>9}: no cycles")
+                continue
+            print(f"    {stage:>9}: p50 = {1e3 * values['p50']:.1f} ms, "
+                  f"p95 = {1e3 * values['p95']:.1f} ms, "
+                  f"max = {1e3 * values['max']:.1f} ms ({values['n']} cycles)")
+
+
+def _to_list(values):
+    return [float(value) if np.isfinite(value) else None for value in values]
@@ -0,0 +1,135 @@
+# live_plot.py
+
+# %% imports
+import numpy as np
+import matplotlib.pyplot as plt
+
+# %% Decimation
+
+
+def minmax_decimate(data, binSize, firstIndex=0):
+    """
+    Reduce data with shape (nChannels, nSamples) to the minimum and maximum of
+    every bin of binSize samples, so a line plot keeps its visual envelope.
+    Bins are aligned to absolute sample indices (firstIndex is the index of
+    data[:, 0]), so the decimated view does not flicker while it scrolls.
+    Returns the sample indices (nChannels, nPoints) and the values.
+    """
+
+    nChannels, nSamples = data.shape
+    indices = np.arange(firstIndex, firstIndex + nSamples)
+
+    if binSize <= 1 or nSamples < 2 * binSize:
+        return np.broadcast_to(indices, data.shape), data
+
+    # samples before the first complete bin and after the last are kept as is
+    first = (-firstIndex) % binSize
+    nBins = (nSamples - first) // binSize
+    last = first + nBins * binSize
+
+    bins = data[:, first:last].reshape(nChannels, nBins, binSize)
+    minPositions = np.argmin(bins, axis=2)
+    maxPositions = np.argmax(bins, axis=2)
+
+    # keep the minimum and maximum of every bin in the order they occurred
+    pairPositions = np.sort(np.stack((minPositions, maxPositions), axis=2), axis=2)
+    binOffsets = (first + np.arange(nBins) * binSize)[None, :, None]
+    binPositions = (pairPositions + binOffsets).reshape(nChannels, -1)
+
+    positions = np.concatenate((np.broadcast_to(np.arange(first), (nChannels, first)),
+                                binPositions,
+                                np.broadcast_to(np.arange(last, nSamples),
+                                                (nChannels, nSamples - last))), axis=1)
+    values = np.take_along_axis(data, positions, axis=1)
+
+    return positions + firstIndex, values
+
+# %% Live raw signal plot
+
+
+class LiveSignalPlot:
+    """
+    Raw signal plot for the operator that redraws only the signal lines and the
+    peak markers each frame.
+
+    The x-axis shows the time relative to the newest sample, so the axes, ticks
+    and labels never change and can be cached as a background image (blitting).
+    Only the samples of the visible window are passed to the lines, decimated to
+    at most maxPoints points per line, so the frame time does not depend on the
+    length of the trial.
+    """
+
+    def __init__(self, nChannels, sampleFrequency, windowSamples, lineStyles,
+                 ylim=(0, 5), maxPoints=1000):
+
+        self.sampleFrequency = sampleFrequency
+        self.windowSamples = windowSamples
+        self.binSize = max(1, int(np.ceil(2 * windowSamples / maxPoints)))
+
+        self.fig, self.ax = plt.subplots()
+        self.ax.set_ylim(ylim)
+        self.ax.set_xlim((-windowSamples / sampleFrequency, 0))
+        self.ax.set_xlabel("time [s]")
+        self.ax.set_ylabel("voltage [V]")
+
+        self.signalLines = []
+        self.peakLines = []
+        for channel in range(nChannels):
+            self.signalLines.append(
+                self.ax.plot([], [], lineStyles[channel], animated=True)[0])
+            self.peakLines.append(
+                self.ax.plot([], [], 'ko', animated=True)[0])
+
+        # line of text for the operator, e.g. the relative phase
+        self.infoText = self.ax.text(0.01, 0.98, "", transform=self.ax.transAxes,
+                                     va="top", animated=True)
+
+        # background is captured after every full draw (first show, resize)
+        self.background = None
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+
+        for line in self.signalLines + self.peakLines:
+            self.ax.draw_artist(line)
+        self.ax.draw_artist(self.infoText)
+
+    def set_info(self, text):
+        # shown with the next update()
+        self.infoText.set_text(text)
+
+    def update(self, windowData, windowStart, peaks):
+        """
+        Update the plot with the samples of the visible window (nChannels,
+        nSamples) starting at sample index windowStart, and per channel the
+        sample indices of the peaks inside the window.
+        """
+
+        sampleCount = windowStart + windowData.shape[1]
+        indices, values = minmax_decimate(windowData, self.binSize, windowStart)
+        times = (indices - sampleCount) / self.sampleFrequency
+
+        for channel, line in enumerate(self.signalLines):
+            line.set_data(times[channel], values[channel])
+
+            channelPeaks = np.asarray(peaks[channel], dtype=int)
+            self.peakLines[channel].set_data(
+                (channelPeaks - sampleCount) / self.sampleFrequency,
+                windowData[channel, channelPeaks - windowStart])
+
+        canvas = self.fig.canvas
+        if not getattr(canvas, "supports_blit", False):
+            canvas.draw_idle()
+            return
+
+        if self.background is None:
+            canvas.draw()  # full draw, captures the background in on_draw
+        else:
+            canvas.restore_region(self.background)
+            self.draw_artists()
+        canvas.blit(self.fig.bbox)
@@ -1,30 +1,33 @@
 # measurement.py
 
 # %% imports
+import bisect
 import collections
 import threading
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
-import nidaqmx
-from nidaqmx.constants import TerminalConfiguration, AcquisitionType
-from nidaqmx.stream_readers import AnalogMultiChannelReader
-import sounddevice as sd
 import time
-import keyboard
 import os
-import json
 
-from .calibration import calc_linear_regression
+from .calibration import load_calibration_model
+from .catalog import update_trial
+from .buffers import SampleBuffer, SharedRing
+from .detection import THRESHOLD, slope_lag
+from .latency import LatencyRecorder
+from .metronome import Metronome
+from .online import OnlineAnalysis
+from .phase import PhaseLog, phase_text
+from .sources import NidaqmxSource, ReplaySource, callback_block_size
+from .storage import TrialWriter
 # helper functions
-from .utils import play_sound, check_nidaqmx_connected, check_callibration_available
+from .utils import check_nidaqmx_connected, check_callibration_available
 
 # %% class
 
 
 class MeasurementDAQ:
 
-    def __init__(self, mainSettings):
+    def __init__(self, mainSettings, source=None, acquisitionMode="polling",
+                 latencyBudget=0.02, renderMode="inline", feedbackRenderer="matplotlib"):
 
         self.participantName = mainSettings["participantName"]
 
@@ -38,14 +41,93 @@ class MeasurementDAQ:
         self.interceptAI0 = mainSettings["interceptAI0"]
         self.interceptAI1 = mainSettings["interceptAI1"]
 
-        # create data storage attributes
-        self.dataAI0 = collections.deque()
-        self.dataAI1 = collections.deque()
-
-        # calculate slope potentiometers
-        # calculate regression formula as tuple --> (slope, intercept)
-        self.calibrationFormulaAI0, self.calibrationFormulaAI1 = \
-            calc_linear_regression(self.interceptAI0, self.interceptAI1)
+        # acquisition source: the NI-DAQmx device unless a simulated or replay
+        # source is given (see sources.py)
+        if source is None:
+            source = NidaqmxSource()
+        if isinstance(source, ReplaySource):
+            # checked here, configure() runs in the acquisition thread
+            source.check_sample_frequency(self.sampleFrequency)
+        self.source = source
+
+        # "polling": the acquisition thread reads blocks of 5 samples,
+        # "callback": the source delivers a block every latencyBudget seconds
+        if acquisitionMode not in ("polling", "callback"):
+            raise ValueError(f"Unknown acquisition mode '{acquisitionMode}'")
+        self.acquisitionMode = acquisitionMode
+        self.latencyBudget = latencyBudget
+        self.acquisitionStats = {}
+
+        # "inline": the figures are drawn in this process, "process": they are
+        # drawn in a separate render process, fed through shared memory
+        if renderMode not in ("inline", "process"):
+            raise ValueError(f"Unknown render mode '{renderMode}'")
+        self.renderMode = renderMode
+        self.sharedSamples = None
+
+        # "matplotlib": the feedback is a matplotlib figure, "qt": a window
+        # painted with Qt that is redrawn only for a new amplitude (see
+        # feedback_window.py). Inline the amplitudes only arrive once per frame,
+        # so the Qt window would be no faster than the figure
+        if feedbackRenderer not in ("matplotlib", "qt"):
+            raise ValueError(f"Unknown feedback renderer '{feedbackRenderer}'")
+        if feedbackRenderer == "qt" and renderMode != "process":
+            raise ValueError("The qt feedback renderer needs renderMode 'process'")
+        self.feedbackRenderer = feedbackRenderer
+
+        # trial boundaries as sample indices: the sample at which space was
+        # pressed and the first sample after the trial
+        self.startIndex = None
+        self.stopIndex = None
+
+        # create data storage attribute, one row per channel (AI0, AI1)
+        self.samples = SampleBuffer(self.source.nChannels)
+
+        # background writer that journals the samples during a trial and
+        # recorder of the feedback latency
+        self.trialWriter = None
+        self.latencyRecorder = None
+
+        # plot of the last trial (kept, so its zoom callback stays alive)
+        self.reviewPlot = None
+        self.showReview = True
+
+        # figures of the last trial; with keepFigures they stay open for the
+        # next trial (see session.py)
+        self.livePlot = None
+        self.feedback = None
+        self.keepFigures = False
+
+        # seconds from startMeasuring() until the figures were ready and the
+        # acquisition started, and whether the operator closed the window
+        self.trialSetupStart = None
+        self.setupTime = None
+        self.stoppedByOperator = False
+
+        # set when a trial ends with an error, stops the acquisition thread
+        self.trialAborted = False
+
+        # relative phase of every cycle, saved with the trial
+        self.phaseLog = PhaseLog()
+
+        # running statistics of the amplitudes, saved with the trial; with
+        # showAccuracy the percentage of cycles on target is shown to the
+        # participant during the trial
+        self.cycleStatistics = None
+        self.showAccuracy = False
+
+        # filter and thresholds of the peak detection, saved with the trial
+        self.detectionSettings = {}
+
+        # the audio stream of the metronome stays open for the whole session
+        self.metronome = Metronome()
+
+        # volts -> degrees per channel ("linear", "polynomial" or "lookup"),
+        # fitted once per calibration report and anchored at the 90 degree point
+        self.calibrationFit = mainSettings.get("calibrationFit", "linear")
+        self.calibrationModels = [
+            load_calibration_model(channelNr, self.calibrationFit).with_reference(*intercept)
+            for channelNr, intercept in enumerate((self.interceptAI0, self.interceptAI1))]
 
         # feedback figure settings
         self.maxAmplitude = mainSettings["maxFeedback"]
@@ -53,6 +135,16 @@ class MeasurementDAQ:
         self.targetSize = mainSettings["targetBarHeight"]
         self.feedbackBarSize = mainSettings["feedbackBarHeight"]
 
+        # seconds between frames of the figures and, in the multi-process
+        # mode, between runs of the peak detection
+        self.frameInterval = 0.05
+        self.detectionInterval = 0.01
+
+        # line style in the raw signal plot and name of the limb per channel
+        # (AI0 drives the right bar, AI1 the left bar)
+        self.lineStyles = ['b-', 'r-']
+        self.limbNames = ["right", "left"]
+
     def change_settings(self, measurementSettings):
 
         # trial number
@@ -68,340 +160,418 @@ class MeasurementDAQ:
         # # metronome settings
         self.metronomeFile = measurementSettings["metronomeFile"]
         self.metronomeDuration = measurementSettings["metronomeDuration"]
+        # tempo of the metronome file unless a tempo is given
+        self.metronomeBpm = measurementSettings.get("metronomeBpm")
+
+        # set when space is pressed during the trial
+        self.startIndex = None
+        self.stopIndex = None
 
     def data_acquisition(self, fs, duration, e):
 
         # function to start the data acquisition. Inputs are the sampling frequentie (fs)
         # and the acquisition duration in seconds (duration). Fuction returns an array with the data.
+        # The sample buffer is cleared by startMeasuring.
 
-        self.dataAI0.clear()
-        self.dataAI1.clear()
+        trialSamples = round(duration * fs)
+        metronomeStopIndex = None
 
-        samples_per_read = 5  # Number of samples per read (1/3rd of a second)
-        ai_channels = ["Dev1/ai0", "Dev1/ai1"]
+        if self.acquisitionMode == "callback":
+            samples_per_read = callback_block_size(fs, self.latencyBudget)
+        else:
+            samples_per_read = 5  # Number of samples per read (1/3rd of a second)
 
-        with nidaqmx.Task() as task2:
-            # Configure the AI channel
-            task2.ai_channels.add_ai_voltage_chan(
-                ai_channels[0], terminal_config=TerminalConfiguration.RSE)
-            task2.ai_channels.add_ai_voltage_chan(
-                ai_channels[1], terminal_config=TerminalConfiguration.RSE)
+        import keyboard
 
+        with self.source as source:
             # Configure the sampling timing
-            task2.timing.cfg_samp_clk_timing(
-                rate=fs,
-                sample_mode=AcquisitionType.CONTINUOUS,
-                samps_per_chan=samples_per_read  # Buffer size for continuous acquisition
-            )
+            source.configure(fs, samples_per_read)
 
             # Prepare a buffer to hold the data with correct shape (channels, samples_per_read)
-            data = np.zeros((2, samples_per_read))
+            data = np.zeros((source.nChannels, samples_per_read))
             # data_total = []
 
-            # Create the stream reader
-            reader = AnalogMultiChannelReader(task2.in_stream)
-
             # Start the task
-            e.wait()  # waiting for plot setup in data_visualisation function
+            # waiting for plot setup in data_visualisation function, or for
+            # the end of a trial that failed before it started
+            while not e.wait(0.1):
+                if self.trialAborted:
+                    return
 
             print("start reading")
-            task2.start()
-            self.timeStart = 0
-            endTime = 0
-            starting = False
-
-            # Continuously read data until the duration elapses
-            while e.is_set() and not starting:
-                reader.read_many_sample(
-                    data, number_of_samples_per_channel=samples_per_read, timeout=10.0)
-                self.dataAI0.extend(data[0, :])
-                self.dataAI1.extend(data[1, :])
+            if self.acquisitionMode == "callback":
+                source.start_callbacks(self.store_block, samples_per_read)
+            else:
+                source.start()
+            self.timeStart = time.time()
+
+            # Continuously read data until space is pressed, the trial starts
+            # at the first sample after the press
+            while e.is_set() and self.startIndex is None:
                 # Read data into the buffer
+                self.acquire_block(source, data)
 
                 if keyboard.is_pressed("space"):
                     print("Measurement started")
                     self.timeStart = time.time()
-                    endTime = time.time() + self.duration
-                    starting = True
+                    self.startIndex = len(self.samples)
+                    metronomeStopIndex = self.startIndex + round(self.metronomeDuration * fs)
+                    # store_block keeps no samples from stopIndex on
+                    self.stopIndex = self.startIndex + trialSamples
 
-            while e.is_set and endTime - time.time() >= 0:
-                reader.read_many_sample(
-                    data, number_of_samples_per_channel=samples_per_read, timeout=10.0)
-                self.dataAI0.extend(data[0, :])
-                self.dataAI1.extend(data[1, :])
+            # the trial ends after exactly duration * fs samples
+            while e.is_set() and len(self.samples) < self.stopIndex:
+                self.acquire_block(source, data)
 
-                if endTime - time.time() < self.duration-self.metronomeDuration:
-                    sd.stop()
+                if metronomeStopIndex is not None and len(self.samples) >= metronomeStopIndex:
+                    self.metronome.stop()
+                    metronomeStopIndex = None
 
             timeNeeded = time.time() - self.timeStart
             e.clear()
             # Stop the task
-            task2.stop()
+            if self.acquisitionMode == "callback":
+                source.stop_callbacks()
+            else:
+                source.stop()
+
+            print(f"Acquisition time: {timeNeeded} seconds "
+                  f"({len(self.samples) - (self.startIndex or 0)} samples)")
 
-            print(f"Acquisition time: {timeNeeded} seconds")
+            self.acquisitionStats = {"mode": self.acquisitionMode,
+                                     "samplesPerRead": samples_per_read,
+                                     **source.acquisition_stats()}
+            if self.acquisitionStats["overruns"] or self.acquisitionStats["droppedSamples"]:
+                print(f"WARNING: {self.acquisitionStats['overruns']} buffer overrun(s), "
+                      f"{self.acquisitionStats['droppedSamples']} sample(s) lost")
+
+    def acquire_block(self, source, data):
+
+        # polling: read the next block. With callbacks the source stores the
+        # blocks itself, so only wait (this also paces the keyboard check)
+        if self.acquisitionMode == "callback":
+            time.sleep(self.latencyBudget)
+        else:
+            source.read(data, timeout=10.0)
+            self.store_block(data)
+
+    def store_block(self, data):
+
+        # stores a block that was just read: in memory for the visualisation,
+        # in the journal on disk, and its read time for the latency measurement.
+        # Samples after the end of the trial are not stored.
+        if self.stopIndex is not None:
+            remaining = self.stopIndex - len(self.samples)
+            if remaining <= 0:
+                return
+            data = data[:, :remaining]
+
+        self.samples.write(data)
+        if self.sharedSamples is not None:
+            self.sharedSamples.write(data)
+        self.trialWriter.put(data)
+        self.latencyRecorder.record_block(len(self.samples))
 
     def data_visualisation(self, left_target_A, right_target_A, e):
 
         # function visualizes data from two potmeters. determines the minimum and mixima of the signal.
         # then calculates the amplitude and plots it.
 
-        # the lower this threshold the higher the sensitivity for finding peaks.
-        threshold = 0.05
-
-        # screen settings feedback figure
-        # enter the resolution of your first monitor
-        firstMonitorRes = (1920, 1080)
-        secondMonitorAvailable = False  # True if you use a second monitor; False if not
-        # enter the resolution of your second monitor
-        secondMonitorRes = (1920, 1080)
-        window_width = 800  # change window width of feedback figure
-        window_height = 600  # change window height of feedback figure
-
-        maxAmplitude = self.maxAmplitude
-        minAmplitude = self.minAmplitude
-        targetSize = self.targetSize
-        feedbackBarSize = self.feedbackBarSize
-
-        # makes sure the middle of the target = the given target amplitude
-        left_target_A = left_target_A - (targetSize/2)
-        right_target_A = right_target_A - (targetSize/2)
-
-        def findTreshold(potValue, previousPotValue, threshold):
-
-            if potValue - previousPotValue > threshold:
-                diffValue = 1
-            elif potValue - previousPotValue < -threshold:
-                diffValue = -1
-            else:
-                diffValue = 0
+        # matplotlib is imported when the first trial is plotted, not at startup
+        import matplotlib.pyplot as plt
+        from .feedback_figure import FeedbackFigure
+        from .live_plot import LiveSignalPlot
 
-            return diffValue
+        # the slope is taken over one frame interval (see detection.py)
+        frameInterval = self.frameInterval
+        samplesPerFrame = slope_lag(self.sampleFrequency)
+        plotWindow = 100 * samplesPerFrame  # samples visible in the raw signal plot
 
-        slopeAI0 = self.calibrationFormulaAI0[0]
-        slopeAI1 = self.calibrationFormulaAI1[0]
+        # the calibration models convert the peak voltages to degrees
+        nChannels = len(self.calibrationModels)
 
-        # setup Potentiometer data plot
-        plt.close('all')
-        plt.ion()
-
-        # Setup raw signal plot
-        fig1, ax1 = plt.subplots()
-        ax1.set_ylim((0, 5))
-        ax1.set_xlim((0, 100))
+        # in a session the figures of the previous trial are reused (see
+        # session.py), only the targets change
+        if self.figures_open():
+            self.livePlot.set_info("")
+            self.feedback.set_targets(left_target_A, right_target_A)
+        else:
+            # setup Potentiometer data plot
+            plt.close('all')
+            plt.ion()
 
-        ax1.plot([], [], 'b-')
-        ax1.plot([], [], 'ko')
+            # Setup raw signal plot (blitted, only the visible window is drawn)
+            self.livePlot = LiveSignalPlot(nChannels, self.sampleFrequency, plotWindow,
+                                           self.lineStyles, ylim=(0, 5))
 
-        ax1.plot([], [], 'r-')
-        ax1.plot([], [], 'ko')
+            # Setup online feedback plot
+            self.feedback = FeedbackFigure(
+                **self.feedback_settings(left_target_A, right_target_A), nChannels=nChannels)
 
-        # Setup online feedback plot
-        fig2, ax2 = plt.subplots()
-        manager = plt.get_current_fig_manager()
-
-        # plot feedback figure in the middle of the first screen or in the second screen
-        if secondMonitorAvailable:
-            window_x = (
-                (firstMonitorRes[0]-window_width) // 2) + secondMonitorRes[0]
-            window_y = (secondMonitorRes[1] - window_height) // 2
-            manager.window.setGeometry(
-                window_x, window_y, window_width, window_height)
-        else:
-            window_x = ((firstMonitorRes[0]-window_width) // 2)
-            window_y = (firstMonitorRes[1] - window_height) // 2
-            manager.window.setGeometry(
-                window_x, window_y, window_width, window_height)
-
-        # manager.window.showMaximized()
-        ax2.set_xlim([0, 5])
-        ax2.set_ylim([minAmplitude, maxAmplitude])
-        # ax2.axis('off')
-
-        # plot blue range bars
-        leftRangeRectangle = Rectangle(xy=(1, 0),
-                                       width=1,
-                                       height=maxAmplitude,
-                                       color='b', zorder=1)
-        ax2.add_patch(leftRangeRectangle)
-
-        rightRangeRectangle = Rectangle(xy=(3, 0),
-                                        width=1,
-                                        height=maxAmplitude,
-                                        color='b', zorder=1)
-        ax2.add_patch(rightRangeRectangle)
-
-        # plot Target
-        leftTargetRectangle = Rectangle(xy=(1, left_target_A),
-                                        width=1,
-                                        height=targetSize,
-                                        color='orange', alpha=1.0, zorder=2)
-        ax2.add_patch(leftTargetRectangle)
-
-        rightTargetRectangle = Rectangle(xy=(3, right_target_A),
-                                         width=1,
-                                         height=targetSize,
-                                         color='orange', alpha=1.0, zorder=2)
-        ax2.add_patch(rightTargetRectangle)
-
-        # plots for current amplitude
-        ax2.plot([], [], lw=feedbackBarSize, c='red')
-        ax2.plot([], [], lw=feedbackBarSize, c='red')
+        livePlot = self.livePlot
+        feedback = self.feedback
+        fig1 = livePlot.fig
 
         # Create lists for data collection
         framenumber = 0
 
-        potData1 = []
-        diffData1 = []
-        peaks1 = []
-        amplitudes1 = []
-
-        potData2 = []
-        diffData2 = []
-        peaks2 = []
-        amplitudes2 = []
-
         frames = []
 
-        # create Temporary variables
-        posPositiveSlope1 = 0
-        posNegativeSlope1 = 0
-
-        posPositivePeak1 = 0
-        posNegativePeak1 = 0
-
-        posPositiveSlope2 = 0
-        posNegativeSlope2 = 0
-
-        posPositivePeak2 = 0
-        posNegativePeak2 = 0
+        # peak detection, latency and relative phase of all samples since the
+        # last frame
+        analysis = self.online_analysis(samplesPerFrame)
+        samplesReader = self.samples.reader()
 
         # Setup
         frames.append(framenumber)
 
         e.set()
-        play_sound(self.metronomeFile)
+        self.metronome.start(self.metronomeBpm, f"metronome_files/{self.metronomeFile}")
+        self.setupTime = time.perf_counter() - self.trialSetupStart
         timeStart = time.time()
         # data visualisation loop
         while plt.fignum_exists(fig1.number) and e.is_set():
 
-            try:
-                potData1.append(self.dataAI0[-1])
-                potData2.append(self.dataAI1[-1])
-                diffData1.append(findTreshold(
-                    potData1[-1], potData1[-2], threshold))
-                diffData2.append(findTreshold(
-                    potData2[-1], potData2[-2], threshold))
-            except IndexError:
+            if samplesReader.position == 0 and samplesReader.available() == 0:
                 print("waiting for data.....")
                 time.sleep(1)
                 timeStart = time.time()
                 continue
 
+            # all samples since the previous frame (a view, not a copy)
+            newData = samplesReader.read()
+
             framenumber += 1
             frames.append(framenumber)
 
-            # find peaks potmeter 1
-            if posPositiveSlope1 and posNegativeSlope1:
-                peaks1.append(int((posPositiveSlope1 + posNegativeSlope1)/2))
-                if posPositiveSlope1 > posNegativeSlope1:
-                    posPositivePeak1 = peaks1[-1]
-                    posNegativeSlope1 = 0
-                elif posPositiveSlope1 < posNegativeSlope1:
-                    posNegativePeak1 = peaks1[-1]
-                    posPositiveSlope1 = 0
-
-            if diffData1[-1] == 1:
-                posPositiveSlope1 = framenumber
-            elif diffData1[-1] == -1:
-                posNegativeSlope1 = framenumber
-
-            # calculate amplitude potmeter 1
-
-            if posPositivePeak1 and posNegativePeak1:
-                amplitudes1.append(abs((potData1[posPositivePeak1] - potData1[posNegativePeak1])
-                                   * slopeAI0))
-
-                posPositivePeak1 = 0
-                posNegativePeak1 = 0
-                ax2.lines[0].set_xdata([2.8, 4.2])
-                ax2.lines[0].set_ydata([amplitudes1[-1], amplitudes1[-1]])
-
-            # find peaks potmeter 2
-            if posPositiveSlope2 and posNegativeSlope2:
-                peaks2.append(int((posPositiveSlope2 + posNegativeSlope2)/2))
-                if posPositiveSlope2 > posNegativeSlope2:  # peak is Negative
-                    posPositivePeak2 = peaks2[-1]
-                    posNegativeSlope2 = 0
-                elif posPositiveSlope2 < posNegativeSlope2:  # peak is positive
-                    posPositiveSlope2 = 0
-                    posNegativePeak2 = peaks2[-1]
-
-            if diffData2[-1] == 1:
-                posPositiveSlope2 = framenumber
-            elif diffData2[-1] == -1:
-                posNegativeSlope2 = framenumber
-
-            # calculate amplitude potmeter 2
-
-            if posPositivePeak2 and posNegativePeak2:
-                amplitudes2.append(abs((potData2[posPositivePeak2] - potData2[posNegativePeak2])
-                                   * slopeAI1))
-                posPositivePeak2 = 0
-                posNegativePeak2 = 0
-                ax2.lines[1].set_xdata([0.8, 2.2])
-                ax2.lines[1].set_ydata([amplitudes2[-1], amplitudes2[-1]])
-
-            # Update plot
-            ax1.lines[0].set_ydata(potData1)
-            ax1.lines[0].set_xdata(frames)
-
-            ax1.lines[1].set_xdata(peaks1)
-            ax1.lines[1].set_ydata([potData1[i] for i in peaks1])
+            # find peaks and calculate amplitudes of all channels
+            result, phase = analysis.process(newData, samplesReader.position)
+            if len(phase.eventChannels):
+                livePlot.set_info(phase_text(analysis.latestPhase, self.limbNames))
 
-            ax1.lines[2].set_ydata(potData2)
-            ax1.lines[2].set_xdata(frames)
+            # only the samples inside the plot window are drawn
+            sampleCount = samplesReader.position
+            windowStart = max(0, sampleCount - plotWindow)
+            windowData = self.samples.get(windowStart, sampleCount)
+            visiblePeaks = []
 
-            ax1.lines[3].set_xdata(peaks2)
-            ax1.lines[3].set_ydata([potData2[i] for i in peaks2])
+            for channel in range(nChannels):
+                newAmplitudes = result.amplitudes[result.cycleChannels == channel]
+                if len(newAmplitudes):
+                    feedback.set_amplitude(channel, newAmplitudes[-1])
+                    feedback.set_accuracy(channel, analysis.cycleStatistics.in_band(channel))
 
-            if len(frames) >= 50:
-                ax1.set_xlim((len(frames)-50, len(frames)+50))
+                visiblePeaks.append(analysis.peaks[channel][
+                    bisect.bisect_left(analysis.peaks[channel], windowStart):])
 
-            fig1.canvas.draw_idle()
-            fig1.canvas.draw_idle()
+            # Update plot
+            livePlot.update(windowData, windowStart, visiblePeaks)
 
             # makes sure that both figures are responsive
             fig1.canvas.flush_events()
-            fig2.canvas.flush_events()
+            if len(result.amplitudes):
+                feedback.draw()
+            feedback.flush_events()
+
+            # the new feedback bars are on screen now
+            if len(result.amplitudes):
+                self.latencyRecorder.record_display()
 
-            plt.pause(0.05)
+            plt.pause(frameInterval)
 
+        # the window was closed before the end of the trial
+        self.stoppedByOperator = e.is_set()
         e.clear()  # set event to false
         aquisitionTime = time.time() - timeStart
         print('Visualisation time = ' + str(aquisitionTime))
         print("visualisation fs = {} frames/s".format(round(len(frames)/aquisitionTime, 2)))
 
-        plt.close('all')
-        plt.figure(2)
+        if not self.keepFigures:
+            self.close_figures()
+        if self.showReview:
+            self.plot_trial(analysis.peaks, samplesReader.position)
+
+    def data_detection(self, left_target_A, right_target_A, e):
+
+        # multi-process mode: the peak detection runs here, the figures are
+        # drawn by a render process (see render_process.py) that gets the
+        # samples and the detection results through shared memory
+        from .render_process import EVENT_FIELDS, RenderStatus, event_block, start_renderer
+
+        samplesPerFrame = slope_lag(self.sampleFrequency)
+        feedbackSettings = self.feedback_settings(left_target_A, right_target_A)
+
+        events = SharedRing(EVENT_FIELDS, capacity=2**14)
+        status = RenderStatus()
+        status["running"] = 1
+        renderers = [start_renderer({
+            'samples': self.sharedSamples.name,
+            'events': events.name,
+            'status': status.name,
+            'sampleFrequency': self.sampleFrequency,
+            'plotWindow': 100 * samplesPerFrame,
+            'frameInterval': self.frameInterval,
+            'lineStyles': self.lineStyles,
+            'limbNames': self.limbNames,
+            'feedback': None if self.feedbackRenderer == "qt" else feedbackSettings})]
+
+        # the Qt feedback window runs in a process of its own, at the refresh
+        # rate of the display
+        if self.feedbackRenderer == "qt":
+            from .feedback_window import start_feedback_window
+            renderers.append(start_feedback_window({
+                'events': events.name,
+                'status': status.name,
+                'nChannels': len(self.calibrationModels),
+                'feedback': feedbackSettings}))
+
+        analysis = self.online_analysis(samplesPerFrame)
+        samplesReader = self.samples.reader()
+
+        # cycles that are published but not on screen yet:
+        # (number of events up to and including them, number of cycles)
+        pendingCycles = collections.deque()
+
+        try:
+            # the acquisition starts when the figures are on screen
+            while not (status["ready"] and
+                       (status["feedbackReady"] or self.feedbackRenderer != "qt")):
+                if any(renderer.poll() is not None for renderer in renderers):
+                    raise RuntimeError("The render process stopped before the trial started")
+                time.sleep(0.1)
+
+            e.set()
+            self.metronome.start(self.metronomeBpm, f"metronome_files/{self.metronomeFile}")
+            self.setupTime = time.perf_counter() - self.trialSetupStart
+
+            # detection loop, much faster than the frame rate: the detection
+            # never waits for a redraw
+            while e.is_set() and status["running"] and renderers[0].poll() is None:
+
+                newData = samplesReader.read()
+                if newData.shape[1]:
+                    result, phase = analysis.process(newData, samplesReader.position)
+                    # running accuracy of the channels with new cycles
+                    accuracy = []
+                    for channel in np.unique(result.cycleChannels):
+                        lastCycle = result.cycleIndices[result.cycleChannels == channel][-1]
+                        accuracy.append((channel, lastCycle,
+                                         analysis.cycleStatistics.in_band(channel)))
+                    events.write(event_block(result, phase, accuracy))
+                    if len(result.amplitudes):
+                        pendingCycles.append((len(events), len(result.amplitudes)))
+
+                displayedEvents = status["displayedEvents"]
+                displayedTime = status["displayedTime"]
+                while pendingCycles and pendingCycles[0][0] <= displayedEvents:
+                    self.latencyRecorder.record_display(displayedTime,
+                                                        pendingCycles.popleft()[1])
+
+                time.sleep(self.detectionInterval)
+
+            # the window was closed before the end of the trial
+            self.stoppedByOperator = e.is_set()
+
+        finally:
+            e.clear()  # set event to false
+            status["running"] = 0
+            for renderer in renderers:
+                renderer.wait()
+            events.close()
+            events.unlink()
+            status.close()
+            status.unlink()
+
+        if self.showReview:
+            self.plot_trial(analysis.peaks, samplesReader.position)
+
+    def online_analysis(self, samplesPerFrame):
+
+        # the lower this threshold the higher the sensitivity for finding peaks.
+        # With adaptiveThreshold it is replaced when the trial starts by a
+        # threshold per channel from the noise in the last baselineDuration
+        # seconds before the start (see detection.py)
+        threshold = THRESHOLD
+        adaptiveThreshold = True
+        baselineDuration = 2.0
+
+        # low-pass filter before the peak detection (None for no filter)
+        filterCutoff = 10.0  # Hz
+
+        analysis = OnlineAnalysis(self, samplesPerFrame, threshold, adaptiveThreshold,
+                                  baselineDuration, filterCutoff)
+
+        # saved with the trial
+        self.detectionSettings = analysis.detectionSettings
+        self.phaseLog = analysis.phaseLog
+        self.cycleStatistics = analysis.cycleStatistics
+        return analysis
+
+    def feedback_settings(self, left_target_A, right_target_A):
+
+        # arguments of FeedbackFigure (see feedback_figure.py)
+        return {'left_target_A': left_target_A,
+                'right_target_A': right_target_A,
+                'minAmplitude': self.minAmplitude,
+                'maxAmplitude': self.maxAmplitude,
+                'targetSize': self.targetSize,
+                'feedbackBarSize': self.feedbackBarSize,
+                'showAccuracy': self.showAccuracy}
+
+    def plot_trial(self, peaks, sampleCount):
+
+        # overview of the trial with all peaks, at the full sample rate (see
+        # review.py; saved trials: python -m measurement_toolbox.review)
+        import matplotlib.pyplot as plt
+        from .review import ReviewPlot
+
+        if self.reviewPlot is not None:
+            plt.close(self.reviewPlot.fig)
+        plt.ion()
 
-        plt.plot(potData1, 'b-')
+        potData = self.samples.to_array()[:, :sampleCount]
+        self.reviewPlot = ReviewPlot(potData, self.sampleFrequency, peaks, self.lineStyles,
+                                     startIndex=self.startIndex,
+                                     title=f"trial {self.trialNr}")
 
-        for i, val in enumerate(peaks1):
-            plt.plot(val, potData1[val], 'ko')
+    def figures_open(self):
+        # True when the figures of the previous trial can be used again
+        import matplotlib.pyplot as plt
+        return (self.livePlot is not None and plt.fignum_exists(self.livePlot.fig.number)
+                and self.feedback.is_open())
 
-        plt.plot(potData2, 'r-')
+    def close_figures(self):
 
-        for i, val in enumerate(peaks2):
-            plt.plot(val, potData2[val], 'ko')
+        import matplotlib.pyplot as plt
+        if self.livePlot is not None:
+            plt.close(self.livePlot.fig)
+            self.feedback.close()
+        self.livePlot = None
+        self.feedback = None
 
     def startMeasuring(self, measurementSettings):
 
+        self.trialSetupStart = time.perf_counter()
+
         # checking if everything is ready before measuring
         # self.check_system_ready()
         self.change_settings(measurementSettings)
 
+        # cleared before the visualisation starts reading: with figures that
+        # are reused it may start before the acquisition thread
+        self.samples.clear()
+
+        # samples are journaled to disk while measuring
+        os.makedirs(f"measurement_files/{self.participantName}", exist_ok=True)
+        self.trialWriter = TrialWriter(self.trial_filename(), self.trial_metadata())
+
+        # timestamps of every pipeline stage of each detected cycle
+        self.latencyRecorder = LatencyRecorder(self.sampleFrequency)
+
         # start measuring
         measuringEvent = threading.Event()
+        self.trialAborted = False
+        trialCompleted = False
 
         # start sampling in the background
         acquisitionThread = threading.Thread(target=self.data_acquisition,
@@ -409,41 +579,101 @@ class MeasurementDAQ:
                                              args=(self.sampleFrequency,
                                                    self.duration, measuringEvent))
 
-        acquisitionThread.start()
-
-        # start plotting
-        self.data_visualisation(
-            self.leftTarget, self.rightTarget, measuringEvent)
-        sd.stop()  # stops playing sound
-        acquisitionThread.join()
+        try:
+            # multi-process mode: the samples are also written to shared memory
+            # for the render process, which needs at most the plot window
+            if self.renderMode == "process":
+                self.sharedSamples = SharedRing(self.source.nChannels,
+                                                capacity=400 * slope_lag(self.sampleFrequency))
 
-        self.saveAsJson()
+            acquisitionThread.start()
 
-    def saveAsJson(self):
-
-        os.makedirs(f"measurement_files/{self.participantName}", exist_ok=True)
-
-        dictData = {
-            'dataAI0': list(self.dataAI0),
-            'dataAI1': list(self.dataAI1),
+            # start plotting
+            if self.renderMode == "process":
+                self.data_detection(
+                    self.leftTarget, self.rightTarget, measuringEvent)
+            else:
+                self.data_visualisation(
+                    self.leftTarget, self.rightTarget, measuringEvent)
+            trialCompleted = True
+
+        finally:
+            # also after an error or Ctrl+C: the acquisition stops, and the
+            # writer thread is stopped with the journal kept for recover_trials
+            if not trialCompleted:
+                self.trialAborted = True
+                measuringEvent.clear()
+            self.metronome.stop()  # stops playing sound
+            if acquisitionThread.is_alive():
+                acquisitionThread.join()
+
+            if self.sharedSamples is not None:
+                self.sharedSamples.close()
+                self.sharedSamples.unlink()
+                self.sharedSamples = None
+
+            if not trialCompleted:
+                self.trialWriter.abort()
+                self.trialWriter = None
+
+        self.saveTrial()
+
+        self.latencyRecorder.print_summary()
+        self.cycleStatistics.print_summary(self.limbNames)
+
+    def trial_metadata(self):
+
+        # metadata stored with every trial, next to the samples
+        return {
             'duration': self.duration,
             'leftTarget': self.leftTarget,
             'rightTarget': self.rightTarget,
             'sampleFrequency': self.sampleFrequency,
+            'startIndex': self.startIndex,
+            'stopIndex': self.stopIndex,
             'interceptAI0': self.interceptAI0,
             'interceptAI1': self.interceptAI1,
             'currentDate': time.strftime("%d-%m-%Y", time.localtime()),
             'currentTime': time.strftime("%H:%M:%S", time.localtime())
         }
 
-        jsonData = json.dumps(dictData)
-        fullFilename = f"measurement_files/{
-            self.participantName}/trial_{str(self.trialNr)}.json"
-        with open(fullFilename, "w") as outfile:
-            outfile.write(jsonData)
+    def trial_filename(self):
+
+        return f"measurement_files/{self.participantName}/trial_{str(self.trialNr)}.trial"
+
+    def saveTrial(self):
+
+        # finishes the journal of the trial writer as a binary .trial file (see
+        # storage.py). This happens in the writer thread, so the next trial can
+        # start right away. Only if blocks could not be journaled the samples in
+        # memory are saved instead.
+        channelData = None
+        if self.trialWriter.droppedBlocks:
+            channelData = self.samples.to_array()
+
+        metadata = self.trial_metadata()
+        metadata['latency'] = self.latencyRecorder.to_dict()
+        metadata['acquisition'] = self.acquisitionStats
+        metadata['phase'] = self.phaseLog.to_dict()
+        metadata['detection'] = self.detectionSettings
+        metadata['cycleStatistics'] = self.cycleStatistics.to_dict()
+        # beat onsets of the metronome as DAQ sample indices
+        metadata['metronome'] = {
+            'bpm': self.metronome.bpm,
+            'beatIndices': self.latencyRecorder.sample_indices(
+                self.metronome.beat_times()).tolist()}
+
+        # the trial is added to the catalog (see catalog.py) once it is saved
+        self.trialWriter.close(metadata, channelData, onSaved=self.catalog_trial)
+        self.trialWriter = None
 
         self.trialNr += 1
 
+    def catalog_trial(self, filename):
+
+        # amplitude statistics in degrees, with the calibration models of the feedback
+        update_trial(filename, self.calibrationModels)
+
     def check_system_ready(self):
         """
         This function checks if the measuring setup is ready to measure.
@@ -459,3 +689,4 @@ class MeasurementDAQ:
 
             raise ValueError("Zero point(s) of potentiometer not found. "
                              "Use the .calcPointZero() method to set the zero points of the potentiometers!")
+
@@ -0,0 +1,201 @@
+# metronome.py
+
+# %% imports
+import threading
+import time
+import wave
+import numpy as np
+
+# %% Click sounds
+
+
+def synthesize_click(sampleRate, frequency=1000.0, duration=0.03):
+    """A short sine burst with an exponential decay, as float32 samples."""
+
+    t = np.arange(int(sampleRate * duration)) / sampleRate
+    click = np.sin(2 * np.pi * frequency * t) * np.exp(-t / (duration / 5))
+    return (0.8 * click).astype(np.float32)
+
+
+def load_click(metronomeFile, sampleRate):
+    """
+    Decodes a metronome wav file (a click repeated at a fixed tempo) and
+    returns the first click as float32 samples at sampleRate, together with
+    the tempo of the file in beats per minute.
+    """
+
+    with wave.open(metronomeFile, 'rb') as wav_file:
+        fileRate = wav_file.getframerate()
+        channels = wav_file.getnchannels()
+        frames = wav_file.readframes(wav_file.getnframes())
+
+    audio = np.frombuffer(frames, dtype=np.int16).reshape(-1, channels)
+    audio = audio.mean(axis=1) / 32768
+
+    # a click is a burst of sound between silences, its onset is the first
+    # audible sample after a silence
+    audible = np.flatnonzero(np.abs(audio) > 0.01 * np.max(np.abs(audio)))
+    minimumGap = int(0.1 * fileRate)
+    gaps = np.flatnonzero(np.diff(audible) > minimumGap)
+    onsets = audible[np.r_[0, gaps + 1]]
+
+    period = int(np.median(np.diff(onsets))) if len(onsets) > 1 else len(audio)
+    bpm = 60 * fileRate / period
+
+    clickEnd = audible[gaps[0]] + 1 if len(gaps) else audible[-1] + 1
+    click = audio[onsets[0]:clickEnd]
+
+    if fileRate != sampleRate:
+        fileTimes = np.arange(len(click)) / fileRate
+        click = np.interp(np.arange(int(len(click) * sampleRate / fileRate)) / sampleRate,
+                          fileTimes, click)
+
+    return click.astype(np.float32), bpm
+
+# %% Metronome engine
+
+
+class Metronome:
+    """
+    Metronome that plays clicks from the callback of one sounddevice
+    OutputStream. The stream is opened once and stays open (playing silence)
+    between trials, so the start-up latency of the audio device is paid once
+    per session.
+
+    Beats are scheduled on the sample clock of the audio stream, so the
+    interval between clicks is exact. The time at which every click leaves
+    the sound card is logged as a time.perf_counter() value (beatTimes), which
+    the measurement converts to DAQ sample indices.
+
+    Decoded wav files are cached, a file is only read the first time it is used.
+    """
+
+    def __init__(self, sampleRate=44100, latency="low"):
+
+        self.sampleRate = sampleRate
+        self.latency = latency
+        self.stream = None
+
+        self.clicks = {}  # cache of decoded clicks: filename -> (click, bpm)
+        self.click = synthesize_click(sampleRate)
+        self.bpm = None
+
+        # position of the stream in audio frames and the beat schedule
+        self.frame = 0
+        self.running = False
+        self.startFrame = 0
+        self.beatInterval = 0.0
+        self.beatNumber = 0
+        self.nextBeatFrame = 0
+        self.activeOnsets = []
+
+        self.beatTimes = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def open(self):
+
+        if self.stream is not None:
+            return
+
+        # imported when the audio stream is opened, not with the toolbox
+        import sounddevice as sd
+
+        self.stream = sd.OutputStream(samplerate=self.sampleRate, channels=1,
+                                      dtype="float32", latency=self.latency,
+                                      callback=self._callback)
+        self.stream.start()
+
+    def close(self):
+
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+    def load(self, metronomeFile):
+        """Returns the click and tempo of a wav file, decoded only once."""
+
+        if metronomeFile not in self.clicks:
+            self.clicks[metronomeFile] = load_click(metronomeFile, self.sampleRate)
+        return self.clicks[metronomeFile]
+
+    def start(self, bpm=None, metronomeFile=None, lead=0.05):
+        """
+        Start clicking at bpm beats per minute, lead seconds from now. With a
+        metronomeFile its click is played, at the tempo of the file unless
+        bpm is given; without a file a synthesized click is played.
+        """
+
+        self.open()
+
+        if metronomeFile is not None:
+            click, fileBpm = self.load(metronomeFile)
+            bpm = bpm or fileBpm
+        else:
+            click = synthesize_click(self.sampleRate)
+        if not bpm:
+            raise ValueError("No tempo given for the metronome")
+
+        self.running = False
+        with self._lock:
+            self.beatTimes = []
+        self.click = click
+        self.bpm = bpm
+        self.beatInterval = 60 * self.sampleRate / bpm
+        self.beatNumber = 0
+        self.startFrame = self.frame + int(lead * self.sampleRate)
+        self.nextBeatFrame = self.startFrame
+        self.running = True  # set last, the callback checks this first
+
+    def stop(self):
+
+        # no new beats, a click that is playing is finished
+        self.running = False
+
+    def beat_times(self, first=0):
+        """The perf_counter times at which the clicks were played, from beat first on."""
+
+        with self._lock:
+            return self.beatTimes[first:]
+
+    def _callback(self, outdata, frames, timeInfo, status):
+
+        outdata.fill(0)
+        blockStart = self.frame
+        blockEnd = blockStart + frames
+
+        # time at which the first frame of this block leaves the sound card,
+        # on the perf_counter clock
+        if timeInfo.currentTime:
+            outputDelay = timeInfo.outputBufferDacTime - timeInfo.currentTime
+        else:
+            outputDelay = self.stream.latency
+        blockTime = time.perf_counter() + outputDelay
+
+        # beats that start in this block
+        while self.running and self.nextBeatFrame < blockEnd:
+            self.activeOnsets.append(self.nextBeatFrame)
+            with self._lock:
+                self.beatTimes.append(
+                    blockTime + (self.nextBeatFrame - blockStart) / self.sampleRate)
+            self.beatNumber += 1
+            self.nextBeatFrame = self.startFrame + round(self.beatNumber * self.beatInterval)
+
+        # mix the clicks that are (still) playing
+        click = self.click
+        for onset in self.activeOnsets:
+            first = max(blockStart, onset)
+            last = min(blockEnd, onset + len(click))
+            outdata[first - blockStart:last - blockStart, 0] += \
+                click[first - onset:last - onset]
+
+        self.activeOnsets = [onset for onset in self.activeOnsets
+                             if onset + len(click) > blockEnd]
+        self.frame = blockEnd
@@ -0,0 +1,127 @@
+# online.py
+
+# %% imports
+import numpy as np
+
+from .cycle_statistics import CycleStatistics
+from .detection import NOISE_WINDOW, PeakDetector, THRESHOLD, adaptive_threshold
+from .filters import LowPassFilter
+from .phase import PhaseEstimator, PhaseLog
+
+# %% Online analysis
+
+
+class OnlineAnalysis:
+    """
+    Online analysis of a trial without any drawing: peak detection (with the
+    low-pass filter and the adaptive threshold), the latency of every cycle
+    and the relative phase. The measurement (a MeasurementDAQ) provides the
+    samples, the trial start, the targets, the calibration models, the
+    latency recorder and the metronome.
+
+    process() is called with all samples since the previous call, from the
+    visualisation loop or, in the multi-process mode, from the detection loop
+    that publishes the results to the render process.
+    """
+
+    def __init__(self, measurement, slopeLag, threshold=THRESHOLD,
+                 adaptiveThreshold=True, baselineDuration=2.0, filterCutoff=10.0):
+
+        self.measurement = measurement
+        self.nChannels = len(measurement.calibrationModels)
+        self.slopeLag = slopeLag
+        self.adaptiveThreshold = adaptiveThreshold
+        self.baselineDuration = baselineDuration
+
+        # streaming peak detector, fed with every sample since the last call
+        self.prefilter = None
+        if filterCutoff:
+            self.prefilter = LowPassFilter(self.nChannels, measurement.sampleFrequency,
+                                           filterCutoff)
+        self.detector = PeakDetector(self.nChannels, threshold, slopeLag=slopeLag,
+                                     calibrationModels=measurement.calibrationModels,
+                                     prefilter=self.prefilter)
+        self.detectionSettings = {
+            'filterCutoff': filterCutoff,
+            'filterOrder': None if self.prefilter is None else self.prefilter.order,
+            'filterDelay': None if self.prefilter is None else self.prefilter.delay,
+            'threshold': [threshold] * self.nChannels,
+            'noise': None}
+
+        # relative phase between the limbs and with the metronome beats
+        self.phaseEstimator = PhaseEstimator(self.nChannels)
+        self.phaseLog = PhaseLog()
+        self.latestPhase = {}
+        self.nBeats = 0
+
+        # running statistics of the amplitudes (AI0 drives the right bar, AI1
+        # the left bar)
+        self.cycleStatistics = CycleStatistics(
+            self.nChannels, measurement.sampleFrequency,
+            [measurement.rightTarget, measurement.leftTarget][:self.nChannels],
+            measurement.targetSize)
+
+        # sample indices of all peaks per channel
+        self.peaks = [[] for channel in range(self.nChannels)]
+
+    def process(self, newData, sampleCount):
+        """
+        Analyse newData, the samples up to sample count sampleCount. Returns
+        the DetectionResult and the PhaseResult of these samples.
+        """
+
+        measurement = self.measurement
+
+        # threshold from the noise before the start of the trial
+        if self.adaptiveThreshold and measurement.startIndex is not None:
+            self.adaptiveThreshold = False
+            self.set_adaptive_threshold(measurement.startIndex)
+
+        # find peaks and calculate amplitudes of all channels
+        result = self.detector.process(newData)
+        measurement.latencyRecorder.record_cycles(result.cycleChannels, result.cycleIndices)
+
+        # cycles before the start of the trial are not counted
+        startIndex = measurement.startIndex if measurement.startIndex is not None else np.inf
+        self.cycleStatistics.update(result.cycleChannels, result.cycleIndices,
+                                    result.amplitudes, startIndex)
+
+        newBeats = measurement.metronome.beat_times(self.nBeats)
+        self.nBeats += len(newBeats)
+        self.phaseEstimator.add_beats(measurement.latencyRecorder.sample_indices(newBeats))
+        phase = self.phaseEstimator.process(result, sampleCount)
+        self.phaseLog.append(phase, sampleCount)
+        for channel, interlimb, metronome in zip(
+                phase.eventChannels, phase.interlimbPhase, phase.metronomePhase):
+            self.latestPhase[channel] = (interlimb, metronome)
+
+        for channel in range(self.nChannels):
+            self.peaks[channel].extend(
+                result.peakIndices[result.peakChannels == channel])
+
+        return result, phase
+
+    def set_adaptive_threshold(self, startIndex):
+
+        measurement = self.measurement
+        baselineStart = max(0, startIndex - round(self.baselineDuration *
+                                                  measurement.sampleFrequency))
+        if startIndex - baselineStart < self.slopeLag:
+            print("Baseline too short, the fixed slope threshold is used")
+            return
+
+        thresholds, noise = adaptive_threshold(
+            measurement.samples.get(baselineStart, startIndex), self.prefilter,
+            self.slopeLag, round(NOISE_WINDOW * measurement.sampleFrequency))
+        self.detector.set_threshold(thresholds)
+
+        # NaN (the baseline was not at rest) is saved as None, as in the
+        # cycle statistics
+        self.detectionSettings.update(
+            threshold=thresholds.tolist(),
+            noise=[value if np.isfinite(value) else None for value in noise.tolist()],
+            baselineSamples=startIndex - baselineStart)
+        print("Slope threshold per channel: " + ", ".join(
+            f"{value * 1e3:.1f} mV" + ("" if np.isfinite(channelNoise) else
+                                       " (not at rest before the start)")
+            for value, channelNoise in zip(thresholds, noise)))
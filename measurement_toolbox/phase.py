@@ -0,0 +1,175 @@
+# phase.py
+
+# %% imports
+import collections
+import numpy as np
+
+# %% Phase results
+
+# per maximum of a limb (an event): channel, sample index, relative phase
+# between the limbs and between the limb and the metronome (degrees).
+# continuous: the same phases at the newest sample of the block
+PhaseResult = collections.namedtuple(
+    "PhaseResult",
+    ["eventChannels", "eventIndices", "interlimbPhase", "metronomePhase",
+     "continuousInterlimb", "continuousMetronome"])
+
+
+def wrap_phase(phase):
+    # degrees in the range (-180, 180]
+    return 180 - np.mod(180 - np.asarray(phase, dtype=float), 360)
+
+# %% Online phase estimation
+
+
+class PhaseEstimator:
+    """
+    Online relative phase between the limbs and between each limb and the
+    metronome, from the peaks found by PeakDetector and the beat onsets of the
+    metronome (as DAQ sample indices).
+
+    The phase of a limb is 0 degrees at a maximum and 180 degrees at a minimum,
+    and increases linearly in between; after the last extremum it is
+    extrapolated with the last half period. The phase of the metronome is 0 at
+    every beat. Only the last extremum of every channel and the last beat are
+    kept, so the memory and the cost per block are constant.
+
+    The interlimb phase is the phase of channel 0 (AI0) minus the phase of
+    channel 1 (AI1), the metronome phase the phase of the limb minus that of
+    the metronome, both in degrees in the range (-180, 180]. Per cycle they
+    are taken at the maximum of a limb (discrete relative phase).
+    """
+
+    def __init__(self, nChannels):
+
+        self.nChannels = nChannels
+
+        # last extremum of every channel, its phase (0 or 180) and the number
+        # of samples between the last two extrema
+        self.lastExtremumIndex = np.full(nChannels, -1, dtype=np.int64)
+        self.lastExtremumPhase = np.zeros(nChannels)
+        self.halfPeriod = np.full(nChannels, np.nan)
+
+        # last metronome beat and the number of samples between beats
+        self.lastBeatIndex = -1
+        self.beatInterval = np.nan
+
+    def add_beats(self, beatIndices):
+
+        for beatIndex in np.sort(np.asarray(beatIndices, dtype=np.int64)):
+            if self.lastBeatIndex >= 0 and beatIndex > self.lastBeatIndex:
+                self.beatInterval = beatIndex - self.lastBeatIndex
+            self.lastBeatIndex = beatIndex
+
+    def limb_phase(self, channel, sampleIndex):
+
+        if self.lastExtremumIndex[channel] < 0 or np.isnan(self.halfPeriod[channel]):
+            return np.nan
+
+        # not beyond the next extremum, which has not been found yet
+        progress = min((sampleIndex - self.lastExtremumIndex[channel]) /
+                       self.halfPeriod[channel], 1.0)
+        return self.lastExtremumPhase[channel] + 180 * progress
+
+    def metronome_phase(self, sampleIndex):
+
+        if self.lastBeatIndex < 0 or np.isnan(self.beatInterval):
+            return np.nan
+        return 360 * (sampleIndex - self.lastBeatIndex) / self.beatInterval
+
+    def interlimb_phase(self, sampleIndex):
+
+        if self.nChannels < 2:
+            return np.nan
+        return wrap_phase(self.limb_phase(0, sampleIndex) - self.limb_phase(1, sampleIndex))
+
+    def process(self, result, sampleCount):
+        """
+        Update the phases with the peaks of a DetectionResult. sampleCount is
+        the number of samples processed so far. Returns a PhaseResult.
+        """
+
+        eventChannels = []
+        eventIndices = []
+        interlimbPhase = []
+        metronomePhase = []
+
+        # the peaks of a block are ordered by channel, the phases need time order
+        for peak in np.argsort(result.peakIndices, kind="stable"):
+            channel = int(result.peakChannels[peak])
+            peakIndex = int(result.peakIndices[peak])
+            isMaximum = result.peakSigns[peak] > 0
+
+            if isMaximum:
+                eventChannels.append(channel)
+                eventIndices.append(peakIndex)
+                if self.nChannels < 2:
+                    interlimbPhase.append(np.nan)
+                elif channel == 0:
+                    interlimbPhase.append(wrap_phase(-self.limb_phase(1, peakIndex)))
+                else:
+                    interlimbPhase.append(wrap_phase(self.limb_phase(0, peakIndex)))
+                metronomePhase.append(wrap_phase(-self.metronome_phase(peakIndex)))
+
+            if self.lastExtremumIndex[channel] >= 0 and peakIndex > self.lastExtremumIndex[channel]:
+                self.halfPeriod[channel] = peakIndex - self.lastExtremumIndex[channel]
+            self.lastExtremumIndex[channel] = peakIndex
+            self.lastExtremumPhase[channel] = 0 if isMaximum else 180
+
+        newest = sampleCount - 1
+        continuousMetronome = np.array(
+            [wrap_phase(self.limb_phase(channel, newest) - self.metronome_phase(newest))
+             for channel in range(self.nChannels)])
+
+        return PhaseResult(np.array(eventChannels, dtype=np.int64),
+                           np.array(eventIndices, dtype=np.int64),
+                           np.array(interlimbPhase), np.array(metronomePhase),
+                           self.interlimb_phase(newest), continuousMetronome)
+
+
+def phase_text(latestPhase, limbNames):
+    """
+    One line for the operator with the latest relative phases. latestPhase
+    holds per channel the (interlimb, metronome) phase of its last cycle.
+    """
+
+    text = []
+    for channel, (interlimb, metronome) in sorted(latestPhase.items()):
+        if channel == 0 and np.isfinite(interlimb):
+            text.append(f"{limbNames[0]}-{limbNames[1]} {interlimb:.0f}\u00b0")
+        if np.isfinite(metronome):
+            text.append(f"{limbNames[channel]}-metronome {metronome:.0f}\u00b0")
+
+    return "relative phase: " + ", ".join(text) if text else ""
+
+# %% Phase log
+
+
+class PhaseLog:
+    """Collects the phases of a trial: every cycle and once per frame."""
+
+    def __init__(self):
+
+        self.cycles = {"channel": [], "sampleIndex": [], "interlimbPhase": [],
+                       "metronomePhase": []}
+        self.continuous = {"sampleIndex": [], "interlimbPhase": [],
+                           "metronomePhase": []}
+
+    def append(self, phaseResult, sampleCount):
+
+        self.cycles["channel"].extend(phaseResult.eventChannels.tolist())
+        self.cycles["sampleIndex"].extend(phaseResult.eventIndices.tolist())
+        self.cycles["interlimbPhase"].extend(_to_list(phaseResult.interlimbPhase))
+        self.cycles["metronomePhase"].extend(_to_list(phaseResult.metronomePhase))
+
+        self.continuous["sampleIndex"].append(int(sampleCount - 1))
+        self.continuous["interlimbPhase"].extend(_to_list([phaseResult.continuousInterlimb]))
+        self.continuous["metronomePhase"].append(_to_list(phaseResult.continuousMetronome))
+
+    def to_dict(self):
+        return {"cycles": self.cycles, "continuous": self.continuous}
+
+
+def _to_list(values):
+    # NaN (phase not known yet) is saved as None to keep the header valid JSON
+    return [float(value) if np.isfinite(value) else None for value in values]
@@ -0,0 +1,247 @@
+# render_process.py
+#
+# Multi-process mode of the measurement: the raw signal plot and the feedback
+# figure are drawn in a separate Python process, so redrawing the figures never
+# holds the GIL of the process that reads the DAQ and detects the peaks. The
+# measurement process publishes the samples and the detection results in shared
+# memory (SharedRing in buffers.py) and starts this module with the names of
+# the shared memory blocks:
+#   python -m measurement_toolbox.render_process '<settings as JSON>'
+
+# %% imports
+import argparse
+import bisect
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+from .buffers import SharedRing, open_shared_memory
+from .phase import phase_text
+
+# %% Events
+
+# detection results are published as events, one column per event:
+# (kind, channel, sampleIndex, value, value2)
+#   peak  - value is the sign of the peak (+1 maximum, -1 minimum)
+#   cycle - value is the amplitude of the cycle
+#   phase - value is the interlimb phase, value2 the phase with the metronome
+#   accuracy - value is the fraction of the cycles on target so far (see
+#              cycle_statistics.py), sampleIndex is that of the last cycle
+EVENT_PEAK = 0
+EVENT_CYCLE = 1
+EVENT_PHASE = 2
+EVENT_ACCURACY = 3
+EVENT_FIELDS = 5
+
+
+def event_block(result, phase, accuracy=()):
+    """
+    The events of a DetectionResult and a PhaseResult, shape (5, nEvents).
+    accuracy holds (channel, sampleIndex, inBand) per channel with new cycles.
+    """
+
+    accuracy = np.array(accuracy, dtype=float).reshape(-1, 3).T
+    counts = [len(result.peakIndices), len(result.cycleIndices), len(phase.eventIndices),
+              accuracy.shape[1]]
+    block = np.full((EVENT_FIELDS, sum(counts)), np.nan)
+    block[0] = np.repeat([EVENT_PEAK, EVENT_CYCLE, EVENT_PHASE, EVENT_ACCURACY], counts)
+    block[1] = np.concatenate((result.peakChannels, result.cycleChannels,
+                               phase.eventChannels, accuracy[0]))
+    block[2] = np.concatenate((result.peakIndices, result.cycleIndices,
+                               phase.eventIndices, accuracy[1]))
+    block[3] = np.concatenate((result.peakSigns, result.amplitudes,
+                               phase.interlimbPhase, accuracy[2]))
+    block[4, counts[0] + counts[1]:counts[0] + counts[1] + counts[2]] = phase.metronomePhase
+    return block
+
+# %% Status
+
+
+class RenderStatus:
+    """
+    Flags and counters in shared memory, written by both processes:
+
+        running         - 1 while the trial runs; either process sets it to 0
+                          to end the trial (e.g. when the window is closed)
+        ready           - 1 when the figures are on screen
+        feedbackReady   - 1 when the feedback window is on screen (only
+                          with the Qt feedback window, see feedback_window.py)
+        displayedEvents - number of events that are on screen
+        displayedTime   - perf_counter time at which they were drawn
+        frames          - number of frames drawn
+    """
+
+    FIELDS = ("running", "ready", "feedbackReady", "displayedEvents", "displayedTime",
+              "frames")
+
+    def __init__(self, name=None):
+
+        self.memory = open_shared_memory(8 * len(self.FIELDS), name)
+        self._values = np.ndarray((len(self.FIELDS),), dtype=np.float64,
+                                  buffer=self.memory.buf)
+        if name is None:
+            self._values[:] = 0
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def __getitem__(self, field):
+        return float(self._values[self.FIELDS.index(field)])
+
+    def __setitem__(self, field, value):
+        self._values[self.FIELDS.index(field)] = value
+
+    def close(self):
+        self._values = None
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+# %% Render process
+
+
+def start_module(module, settings):
+    # runs python -m module with the settings as JSON, from the toolbox folder
+    toolboxFolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen([sys.executable, "-m", module, json.dumps(settings)],
+                            cwd=toolboxFolder)
+
+
+def start_renderer(settings):
+    """
+    Starts the render process. settings holds the names of the shared memory
+    ('samples', 'events', 'status') and the figure settings (see run_renderer).
+    """
+
+    return start_module("measurement_toolbox.render_process", settings)
+
+
+def run_renderer(settings):
+    """
+    Draws the figures until the trial ends or the raw signal window is
+    closed. settings:
+
+        samples, events, status - names of the shared memory blocks
+        sampleFrequency, plotWindow, frameInterval, lineStyles, limbNames
+        feedback                - arguments of FeedbackFigure, None when
+                                  the feedback is shown by the Qt feedback
+                                  window (see feedback_window.py)
+    """
+
+    # matplotlib is only imported in the render process
+    import matplotlib.pyplot as plt
+    from .feedback_figure import FeedbackFigure
+    from .live_plot import LiveSignalPlot
+
+    samples = SharedRing(name=settings["samples"])
+    events = SharedRing(name=settings["events"])
+    status = RenderStatus(settings["status"])
+
+    nChannels = samples.nChannels
+    plotWindow = settings["plotWindow"]
+    frameInterval = settings["frameInterval"]
+
+    plt.close('all')
+    plt.ion()
+
+    # Setup raw signal plot (blitted, only the visible window is drawn)
+    livePlot = LiveSignalPlot(nChannels, settings["sampleFrequency"], plotWindow,
+                              settings["lineStyles"], ylim=(0, 5))
+    fig1 = livePlot.fig
+
+    # Setup online feedback plot
+    feedbackFigure = None
+    if settings["feedback"] is not None:
+        feedbackFigure = FeedbackFigure(**settings["feedback"], nChannels=nChannels)
+
+    plt.pause(frameInterval)
+    status["ready"] = 1
+
+    eventsReader = events.reader()
+    peaks = [[] for channel in range(nChannels)]
+    latestPhase = {}
+    frames = 0
+
+    timeStart = time.time()
+    while plt.fignum_exists(fig1.number) and status["running"]:
+
+        newEvents = eventsReader.read()
+        kinds = newEvents[0]
+        channels = newEvents[1].astype(int)
+        indices = newEvents[2].astype(np.int64)
+
+        for channel in range(nChannels):
+            channelEvents = channels == channel
+            peaks[channel].extend(
+                indices[(kinds == EVENT_PEAK) & channelEvents].tolist())
+
+            newAmplitudes = newEvents[3][(kinds == EVENT_CYCLE) & channelEvents]
+            if len(newAmplitudes) and feedbackFigure is not None:
+                feedbackFigure.set_amplitude(channel, newAmplitudes[-1])
+
+            newAccuracy = newEvents[3][(kinds == EVENT_ACCURACY) & channelEvents]
+            if len(newAccuracy) and feedbackFigure is not None:
+                feedbackFigure.set_accuracy(channel, newAccuracy[-1])
+
+        phaseEvents = np.flatnonzero(kinds == EVENT_PHASE)
+        for event in phaseEvents:
+            latestPhase[channels[event]] = (newEvents[3, event], newEvents[4, event])
+        if len(phaseEvents):
+            livePlot.set_info(phase_text(latestPhase, settings["limbNames"]))
+
+        # only the samples inside the plot window are drawn
+        sampleCount = len(samples)
+        windowStart = max(0, sampleCount - plotWindow)
+        windowData = samples.get(windowStart, sampleCount)
+        visiblePeaks = [peaks[channel][bisect.bisect_left(peaks[channel], windowStart):]
+                        for channel in range(nChannels)]
+
+        # Update plot
+        livePlot.update(windowData, windowStart, visiblePeaks)
+        frames += 1
+        status["frames"] = frames
+
+        # makes sure that both figures are responsive
+        newCycles = feedbackFigure is not None and np.any(kinds == EVENT_CYCLE)
+        fig1.canvas.flush_events()
+        if newCycles:
+            feedbackFigure.draw()
+        if feedbackFigure is not None:
+            feedbackFigure.flush_events()
+
+        # the new feedback bars are on screen now (the time is written first,
+        # the measurement process reads the count first)
+        if newCycles:
+            status["displayedTime"] = time.perf_counter()
+            status["displayedEvents"] = eventsReader.position
+
+        plt.pause(frameInterval)
+
+    status["running"] = 0
+    visualisationTime = time.time() - timeStart
+    print('Visualisation time = ' + str(visualisationTime))
+    print("visualisation fs = {} frames/s".format(round(frames/visualisationTime, 2)))
+
+    plt.close('all')
+    samples.close()
+    events.close()
+    status.close()
+
+
+def main(arguments=None):
+
+    parser = argparse.ArgumentParser(
+        description="Draw the figures of a measurement in a separate process.")
+    parser.add_argument("settings", help="settings as JSON (see run_renderer)")
+    args = parser.parse_args(arguments)
+
+    run_renderer(json.loads(args.settings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# review.py
+#
+# Review of a recorded trial at the full sample rate. The recording is reduced
+# once to a pyramid of min/max envelopes, so zooming and panning only draw a
+# few thousand points per channel, also for recordings of several minutes.
+# The peaks of a channel are drawn as one artist.
+#
+# Command line:
+#   python -m measurement_toolbox.review measurement_files/PP1/trial_1.trial
+
+# %% imports
+import argparse
+import numpy as np
+
+from .live_plot import minmax_decimate
+
+# %% Decimation pyramid
+
+
+class DecimationPyramid:
+    """
+    Min/max envelopes of samples with shape (nChannels, nSamples) at bin sizes
+    of factor, factor**2, ... samples (see minmax_decimate), down to about
+    minPoints points per channel. view() returns the coarsest level that
+    still has maxPoints points in the requested range, so the number of points
+    to draw does not depend on the length of the recording or the zoom.
+    """
+
+    def __init__(self, channelData, factor=4, minPoints=1000):
+
+        self.channelData = channelData
+        self.nChannels, self.nSamples = channelData.shape
+
+        # level 0 are the samples themselves
+        self.binSizes = [1]
+        self.levels = [None]
+        binSize = factor
+        while self.nSamples // binSize >= minPoints // 2:
+            self.binSizes.append(binSize)
+            self.levels.append(minmax_decimate(channelData, binSize))
+            binSize *= factor
+
+    def level(self, start, stop, maxPoints):
+        # coarsest level with at least maxPoints points (2 per bin) in [start, stop)
+        level = 0
+        for candidate, binSize in enumerate(self.binSizes):
+            if 2 * (stop - start) / binSize >= maxPoints:
+                level = candidate
+        return level
+
+    def view(self, start, stop, maxPoints=4000):
+        """
+        Returns per channel the sample indices and values of the envelope of
+        samples [start, stop) (at least maxPoints points when the level of
+        detail allows it).
+        """
+
+        start = max(0, int(start))
+        stop = min(self.nSamples, int(stop))
+        level = self.level(start, stop, maxPoints)
+
+        if level == 0:
+            indices = np.arange(start, stop)
+            return ([indices] * self.nChannels,
+                    [self.channelData[channel, start:stop] for channel in range(self.nChannels)])
+
+        # the points of a level are sorted per channel; one point on each
+        # side of the range keeps the line connected to the edges
+        levelIndices, levelValues = self.levels[level]
+        indices = []
+        values = []
+        for channel in range(self.nChannels):
+            first = max(0, np.searchsorted(levelIndices[channel], start) - 1)
+            last = np.searchsorted(levelIndices[channel], stop) + 1
+            indices.append(levelIndices[channel, first:last])
+            values.append(levelValues[channel, first:last])
+
+        return indices, values
+
+# %% Review plot
+
+
+class ReviewPlot:
+    """
+    Plot of a complete recording with the peaks of every channel. The lines
+    show the envelope of the visible range from a DecimationPyramid and are
+    updated when the x-axis changes (zoom, pan). All peaks of a channel are
+    one marker line.
+    """
+
+    def __init__(self, channelData, sampleFrequency, peaks, lineStyles=('b-', 'r-'),
+                 startIndex=None, maxPoints=4000, title=None):
+
+        # matplotlib is imported when the plot is made
+        import matplotlib.pyplot as plt
+
+        channelData = np.asarray(channelData, dtype=float)
+        self.sampleFrequency = sampleFrequency
+        self.maxPoints = maxPoints
+        self.pyramid = DecimationPyramid(channelData)
+
+        self.fig, self.ax = plt.subplots()
+        self.ax.set_xlabel("time [s]")
+        self.ax.set_ylabel("voltage [V]")
+        if title:
+            self.ax.set_title(title)
+
+        self.signalLines = []
+        for channel in range(channelData.shape[0]):
+            self.signalLines.append(self.ax.plot([], [], lineStyles[channel])[0])
+
+            channelPeaks = np.asarray(peaks[channel], dtype=int)
+            self.ax.plot(channelPeaks / sampleFrequency, channelData[channel, channelPeaks],
+                         'ko', linestyle='none')
+
+        # start of the trial (space pressed)
+        if startIndex:
+            self.ax.axvline(startIndex / sampleFrequency, color='k', linestyle=':')
+
+        duration = max(channelData.shape[1] - 1, 1) / sampleFrequency
+        if channelData.size:
+            margin = 0.05 * max(np.ptp(channelData), 0.1)
+            self.ax.set_ylim(np.min(channelData) - margin, np.max(channelData) + margin)
+        self.ax.callbacks.connect('xlim_changed', self.on_xlim_changed)
+        self.ax.set_xlim(0, duration)
+
+    def on_xlim_changed(self, ax):
+
+        xmin, xmax = ax.get_xlim()
+        start = int(np.floor(xmin * self.sampleFrequency))
+        stop = int(np.ceil(xmax * self.sampleFrequency)) + 1
+        indices, values = self.pyramid.view(start, stop, self.maxPoints)
+
+        for channel, line in enumerate(self.signalLines):
+            line.set_data(indices[channel] / self.sampleFrequency, values[channel])
+        self.fig.canvas.draw_idle()
+
+
+def review_trial(filename, lineStyles=('b-', 'r-')):
+    """Shows a saved trial with the peaks found by the analysis (see analysis.py)."""
+
+    from .analysis import detect_trial
+    from .storage import load_trial
+
+    trial = load_trial(filename)
+    channelData, result = detect_trial(trial)
+    peaks = [result.peakIndices[result.peakChannels == channel]
+             for channel in range(channelData.shape[0])]
+
+    return ReviewPlot(channelData, trial["sampleFrequency"], peaks, lineStyles,
+                      startIndex=trial.get("startIndex"), title=filename)
+
+
+def main(arguments=None):
+
+    parser = argparse.ArgumentParser(description="Review a recorded trial.")
+    parser.add_argument("filename", help=".trial (or .json) file of the trial")
+    args = parser.parse_args(arguments)
+
+    import matplotlib.pyplot as plt
+
+    # the plot must stay referenced: matplotlib keeps weak references to callbacks
+    reviewPlot = review_trial(args.filename)
+    plt.show()
+    return reviewPlot
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# session.py
+
+# %% imports
+import os
+
+from .utils import excel_trial_settings
+
+# %% Experiment plan
+
+
+def compile_plan(excelSettings):
+    """
+    Measurement settings of every trial of the Excel file (see
+    get_excel_settings), checked before the first trial: a typing error in
+    row 30 is found before the session starts, not after 29 trials.
+    """
+
+    plan = []
+    for excelIndex in range(len(excelSettings)):
+        try:
+            settings = excel_trial_settings(excelSettings, excelIndex)
+        except (KeyError, ValueError) as error:
+            raise ValueError(f"Invalid settings for trial {excelIndex + 1} "
+                             f"in the Excel file: {error}") from error
+
+        if not os.path.exists(f"metronome_files/{settings['metronomeFile']}"):
+            raise FileNotFoundError(f"Metronome file '{settings['metronomeFile']}' of trial "
+                                    f"{excelIndex + 1} not found in metronome_files")
+
+        settings["trialNr"] = excelIndex + 1
+        plan.append(settings)
+
+    return plan
+
+# %% Session runner
+
+
+class MeasurementSession:
+    """
+    Runs the trials of an Excel plan back to back, without a settings window
+    between the trials. Everything that does not change between trials is set
+    up once for the whole session:
+
+        - the Excel plan is read and checked once (compile_plan)
+        - the DAQ task stays open and configured
+        - the audio stream of the metronome stays open and every metronome
+          file is decoded before the first trial
+        - the figures stay open, only the targets are updated (not in the
+          multi-process mode, where the render processes are started per trial)
+
+    Every trial still starts when space is pressed. The session stops after
+    the last trial of the plan, or when the operator closes the raw signal
+    window during a trial.
+    """
+
+    def __init__(self, experiment, excelSettings, firstTrial=None, showReview=False):
+
+        self.experiment = experiment
+        self.plan = compile_plan(excelSettings)
+        self.firstTrial = experiment.trialNr if firstTrial is None else firstTrial
+        self.showReview = showReview
+
+    def run(self):
+
+        experiment = self.experiment
+        trials = [settings for settings in self.plan if settings["trialNr"] >= self.firstTrial]
+        if not trials:
+            print("All trials of the Excel file have been measured")
+            return
+
+        previousSettings = (experiment.keepFigures, experiment.showReview)
+        experiment.keepFigures = True
+        experiment.showReview = self.showReview
+
+        # decode the metronome files before the first trial
+        for metronomeFile in sorted({settings["metronomeFile"] for settings in trials}):
+            experiment.metronome.load(f"metronome_files/{metronomeFile}")
+        experiment.metronome.open()
+
+        # the DAQ task is opened once and closed after the last trial
+        try:
+            with experiment.source:
+                for settings in trials:
+                    print(f"Trial {settings['trialNr']} of {len(self.plan)}: "
+                          f"left target {settings['leftTarget']}, "
+                          f"right target {settings['rightTarget']}, "
+                          f"{settings['duration']} s. Press space to start")
+
+                    experiment.startMeasuring(settings)
+                    print(f"Trial {settings['trialNr']} was ready "
+                          f"{1e3 * experiment.setupTime:.0f} ms after the previous trial")
+
+                    if experiment.stoppedByOperator:
+                        print("Session stopped")
+                        break
+        finally:
+            experiment.keepFigures, experiment.showReview = previousSettings
+            experiment.close_figures()
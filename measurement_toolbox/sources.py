@@ -0,0 +1,453 @@
+# sources.py
+
+# %% imports
+import threading
+import time
+import numpy as np
+
+from .storage import CHANNEL_NAMES, load_trial
+
+# %% Acquisition source interface
+
+
+class AcquisitionSource:
+    """
+    Base class for everything that delivers samples to the toolbox.
+
+    Usage (this is what MeasurementDAQ.data_acquisition does):
+
+        with source:
+            source.configure(sampleFrequency, samplesPerRead)
+            source.start()
+            source.read(data)  # fills data with shape (nChannels, samplesPerRead)
+            source.stop()
+
+    Instead of start() and read() a source can also deliver blocks itself:
+    start_callbacks(callback, blockSize) calls callback(data) for every block
+    until stop_callbacks(). The base class does this with a reader thread;
+    NidaqmxSource uses the every-N-samples event of the driver.
+
+    The with-blocks can be nested: the source is opened by the outer block
+    and only closed when it ends, so a measurement session can keep the
+    device open between trials.
+
+    read_burst() measures a finite number of samples at a given sample rate
+    (used for calibration), read_single() returns one on-demand sample per
+    channel (used for calculating the calibration offset).
+    """
+
+    nChannels = 0
+
+    def __init__(self):
+        self.sampleFrequency = None
+        self.samplesPerRead = None
+        self.sampleCount = 0  # samples read since start()
+        self._callbackThread = None
+        self._callbackRunning = threading.Event()
+        self._openCount = 0  # number of with-blocks using the source
+        self.reset_stats()
+
+    def reset_stats(self):
+
+        # samples waiting in the (host) buffer, overruns and lost samples
+        self.backlog = 0
+        self.maxBacklog = 0
+        self.overruns = 0
+        self.droppedSamples = 0
+
+    def update_backlog(self, backlog):
+
+        self.backlog = backlog
+        self.maxBacklog = max(self.maxBacklog, backlog)
+
+    def acquisition_stats(self):
+        return {"maxBacklog": int(self.maxBacklog),
+                "overruns": int(self.overruns),
+                "droppedSamples": int(self.droppedSamples)}
+
+    def __enter__(self):
+        if self._openCount == 0:
+            self.open()
+        self._openCount += 1
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._openCount -= 1
+        if self._openCount == 0:
+            self.close()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def configure(self, sampleFrequency, samplesPerRead):
+        self.sampleFrequency = sampleFrequency
+        self.samplesPerRead = samplesPerRead
+
+    def start(self):
+        self.sampleCount = 0
+        self.reset_stats()
+
+    def stop(self):
+        pass
+
+    def read(self, data, timeout=10.0):
+        raise NotImplementedError
+
+    def start_callbacks(self, callback, blockSize):
+        """Start the source and call callback(data) for every block of blockSize samples."""
+
+        self.start()
+        self._callbackRunning.set()
+
+        def readBlocks():
+            data = np.zeros((self.nChannels, blockSize))
+            while self._callbackRunning.is_set():
+                self.read(data)
+                callback(data)
+
+        self._callbackThread = threading.Thread(target=readBlocks, daemon=True)
+        self._callbackThread.start()
+
+    def stop_callbacks(self):
+
+        self._callbackRunning.clear()
+        if self._callbackThread is not None:
+            self._callbackThread.join()
+            self._callbackThread = None
+        self.stop()
+
+    def read_burst(self, nSamples, sampleFrequency):
+        """Measures nSamples samples per channel, returns shape (nChannels, nSamples)."""
+
+        data = np.zeros((self.nChannels, nSamples))
+        self.configure(sampleFrequency, nSamples)
+        self.start()
+        self.read(data)
+        self.stop()
+        return data
+
+    def read_single(self):
+        raise NotImplementedError
+
+# %% NI-DAQmx
+
+# DAQmx errors for samples that were overwritten before they were read
+OVERRUN_ERRORS = (-200279, -200277)
+
+
+class NidaqmxSource(AcquisitionSource):
+    """Reads the analog inputs of a NI-DAQmx device (the USB-6009 by default)."""
+
+    def __init__(self, channels=("Dev1/ai0", "Dev1/ai1")):
+
+        super().__init__()
+        self.channels = list(channels)
+        self.nChannels = len(self.channels)
+        self.task = None
+        self.reader = None
+        self.timing = None  # (sampleFrequency, samplesPerRead) of the task
+
+    def open(self):
+
+        import nidaqmx
+        from nidaqmx.constants import TerminalConfiguration
+
+        self.task = nidaqmx.Task()
+        for channel in self.channels:
+            self.task.ai_channels.add_ai_voltage_chan(
+                channel, terminal_config=TerminalConfiguration.RSE)
+
+    def close(self):
+
+        if self.task is not None:
+            self.task.close()
+            self.task = None
+            self.reader = None
+            self.timing = None
+
+    def configure(self, sampleFrequency, samplesPerRead):
+
+        from nidaqmx.constants import AcquisitionType, TaskMode
+        from nidaqmx.stream_readers import AnalogMultiChannelReader
+
+        super().configure(sampleFrequency, samplesPerRead)
+
+        # a task that stays open between trials is only configured once
+        if self.timing == (sampleFrequency, samplesPerRead):
+            return
+
+        # Configure the sampling timing
+        self.task.timing.cfg_samp_clk_timing(
+            rate=sampleFrequency,
+            sample_mode=AcquisitionType.CONTINUOUS,
+            samps_per_chan=samplesPerRead  # Buffer size for continuous acquisition
+        )
+
+        # Create the stream reader
+        self.reader = AnalogMultiChannelReader(self.task.in_stream)
+
+        # commit the task: after stop() it returns to the committed state, so
+        # the next start() does not have to reserve the device again
+        self.task.control(TaskMode.TASK_COMMIT)
+        self.timing = (sampleFrequency, samplesPerRead)
+
+    def start(self):
+
+        super().start()
+        self.task.start()
+
+    def stop(self):
+
+        self.update_dropped_samples()
+        self.task.stop()
+
+    def read(self, data, timeout=10.0):
+
+        self.update_backlog(self.task.in_stream.avail_samp_per_chan)
+        self.reader.read_many_sample(
+            data, number_of_samples_per_channel=data.shape[1], timeout=timeout)
+        self.sampleCount += data.shape[1]
+
+    def start_callbacks(self, callback, blockSize):
+
+        # the driver calls everyNSamples from its own thread each time blockSize
+        # new samples are in the host buffer, no Python polling in between
+        from nidaqmx.errors import DaqError
+
+        data = np.zeros((self.nChannels, blockSize))
+
+        def everyNSamples(taskHandle, eventType, numberOfSamples, callbackData):
+            try:
+                self.update_backlog(self.task.in_stream.avail_samp_per_chan)
+                self.reader.read_many_sample(
+                    data, number_of_samples_per_channel=blockSize, timeout=0)
+            except DaqError as error:
+                if error.error_code in OVERRUN_ERRORS:
+                    self.overruns += 1
+                    print(f"DAQ buffer overrun ({error.error_code}), samples were lost")
+                    return 0
+                raise
+
+            self.sampleCount += blockSize
+            callback(data)
+            return 0
+
+        self.task.register_every_n_samples_acquired_into_buffer_event(
+            blockSize, everyNSamples)
+        self.start()
+
+    def stop_callbacks(self):
+
+        self.stop()
+        # unregister the event, so the task can be configured again
+        self.task.register_every_n_samples_acquired_into_buffer_event(
+            self.samplesPerRead, None)
+
+    def update_dropped_samples(self):
+
+        # acquired samples that were neither read nor are still waiting
+        acquired = self.task.in_stream.total_samp_per_chan_acquired
+        waiting = self.task.in_stream.avail_samp_per_chan
+        self.droppedSamples = max(0, acquired - self.sampleCount - waiting)
+
+    def read_burst(self, nSamples, sampleFrequency):
+
+        from nidaqmx.constants import AcquisitionType
+        from nidaqmx.stream_readers import AnalogMultiChannelReader
+
+        # finite acquisition: the device stops after nSamples samples
+        self.timing = None
+        self.task.timing.cfg_samp_clk_timing(
+            rate=sampleFrequency,
+            sample_mode=AcquisitionType.FINITE,
+            samps_per_chan=nSamples
+        )
+        self.reader = AnalogMultiChannelReader(self.task.in_stream)
+
+        data = np.zeros((self.nChannels, nSamples))
+        self.task.start()
+        self.reader.read_many_sample(data, number_of_samples_per_channel=nSamples,
+                                     timeout=nSamples / sampleFrequency + 10.0)
+        self.task.stop()
+        return data
+
+    def read_single(self):
+
+        # on-demand read of every channel, without sample clock
+        if self.task is None:
+            with self:
+                return self.read_single()
+
+        values = self.task.read()
+        return np.atleast_1d(np.asarray(values, dtype=float))
+
+# %% Synthetic signals
+
+
+class SimulatedSource(AcquisitionSource):
+    """
+    Generates rhythmic movement signals: one sine per channel with noise,
+    linear drift and optional ADC quantization. With realTime=True read()
+    waits until the samples would have been measured, like a real device;
+    with realTime=False samples are delivered as fast as possible.
+    The signal only depends on the seed, so runs are reproducible.
+    """
+
+    def __init__(self, nChannels=2, frequency=1.5, amplitude=1.0, offset=2.5,
+                 noise=0.005, drift=0.0, phase=None, resolution=None,
+                 realTime=True, seed=0):
+
+        super().__init__()
+        self.nChannels = nChannels
+        self.frequency = self._per_channel(frequency)
+        self.amplitude = self._per_channel(amplitude)
+        self.offset = self._per_channel(offset)
+        self.noise = self._per_channel(noise)
+        self.drift = self._per_channel(drift)  # volt per second
+        if phase is None:
+            phase = np.arange(nChannels) * np.pi / 2
+        self.phase = self._per_channel(phase)
+        self.resolution = resolution  # ADC step in volt, None for no quantization
+        self.realTime = realTime
+        self.seed = seed
+
+        self.rng = np.random.default_rng(seed)
+        self.startTime = None
+
+    def _per_channel(self, value):
+        return np.broadcast_to(np.asarray(value, dtype=float), (self.nChannels,)).reshape(-1, 1)
+
+    def start(self):
+
+        super().start()
+        self.rng = np.random.default_rng(self.seed)
+        self.startTime = time.perf_counter()
+
+    def signal(self, sampleIndices):
+        """Returns the samples at the given sample indices, shape (nChannels, n)."""
+
+        t = np.asarray(sampleIndices, dtype=float) / self.sampleFrequency
+        data = self.offset + self.drift * t + \
+            self.amplitude * np.sin(2 * np.pi * self.frequency * t + self.phase)
+        data = data + self.noise * self.rng.standard_normal(data.shape)
+
+        if self.resolution:
+            data = np.round(data / self.resolution) * self.resolution
+
+        return data
+
+    def read(self, data, timeout=10.0):
+
+        nSamples = data.shape[1]
+        if self.realTime:
+            elapsed = time.perf_counter() - self.startTime
+            self.update_backlog(max(0, int(elapsed * self.sampleFrequency) - self.sampleCount))
+
+            readyTime = self.startTime + (self.sampleCount + nSamples) / self.sampleFrequency
+            waitTime = readyTime - time.perf_counter()
+            if waitTime > timeout:
+                raise TimeoutError("Simulated samples not available within timeout")
+            if waitTime > 0:
+                time.sleep(waitTime)
+
+        data[:] = self.signal(np.arange(self.sampleCount, self.sampleCount + nSamples))
+        self.sampleCount += nSamples
+
+    def read_single(self):
+
+        if self.sampleFrequency is None:
+            self.sampleFrequency = 1000
+        sampleIndex = 0 if self.startTime is None else \
+            int((time.perf_counter() - self.startTime) * self.sampleFrequency)
+
+        return self.signal([sampleIndex])[:, 0]
+
+# %% Replay of recorded trials
+
+
+class ReplaySource(AcquisitionSource):
+    """
+    Streams a recorded trial (.trial or trial_N.json) as if it is measured
+    again. speed=1 replays in real time, speed=50 fifty times faster and
+    speed=None as fast as possible. At the end of the recording the replay
+    starts again if loop is True, otherwise the last sample is repeated.
+    The sample frequency must be that of the recording.
+    """
+
+    def __init__(self, filename, speed=1.0, loop=False, channelNames=CHANNEL_NAMES):
+
+        super().__init__()
+        self.filename = filename
+        self.speed = speed
+        self.loop = loop
+
+        trial = load_trial(filename, mmap=False)
+        self.recording = np.array([trial[key] for key in channelNames
+                                   if key in trial], dtype=float)
+        self.nChannels = self.recording.shape[0]
+        self.recordedFrequency = trial["sampleFrequency"]
+        self.finished = False
+        self.startTime = None
+
+    def configure(self, sampleFrequency, samplesPerRead):
+
+        self.check_sample_frequency(sampleFrequency)
+        super().configure(sampleFrequency, samplesPerRead)
+
+    def check_sample_frequency(self, sampleFrequency):
+
+        # the measurement times the trial and designs the filter for the
+        # configured frequency, so it must not differ from the recording
+        if sampleFrequency != self.recordedFrequency:
+            raise ValueError(f"{self.filename} was recorded at {self.recordedFrequency} Hz, "
+                             f"not at {sampleFrequency} Hz")
+
+    def start(self):
+
+        super().start()
+        self.finished = False
+        self.startTime = time.perf_counter()
+
+    def read(self, data, timeout=10.0):
+
+        nSamples = data.shape[1]
+        if self.speed:
+            readyTime = self.startTime + (self.sampleCount + nSamples) / \
+                (self.recordedFrequency * self.speed)
+            waitTime = readyTime - time.perf_counter()
+            if waitTime > 0:
+                time.sleep(min(waitTime, timeout))
+
+        data[:] = self._samples(self.sampleCount, nSamples)
+        self.sampleCount += nSamples
+
+    def _samples(self, first, nSamples):
+
+        nRecorded = self.recording.shape[1]
+        indices = np.arange(first, first + nSamples)
+
+        if self.loop:
+            indices = indices % nRecorded
+        elif indices[-1] >= nRecorded:
+            self.finished = True
+            indices = np.minimum(indices, nRecorded - 1)
+
+        return self.recording[:, indices]
+
+    def read_single(self):
+        return self._samples(self.sampleCount, 1)[:, 0]
+
+
+# %% Block size for callbacks
+
+
+def callback_block_size(sampleFrequency, latencyBudget=0.02):
+    """
+    Number of samples per callback, so a block is delivered at least every
+    latencyBudget seconds. This keeps the number of Python wake-ups at about
+    1 / latencyBudget per second, whatever the sample rate.
+    """
+    return max(1, int(sampleFrequency * latencyBudget))
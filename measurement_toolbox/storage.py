@@ -0,0 +1,404 @@
+# storage.py
+
+# %% imports
+import glob
+import json
+import os
+import queue
+import re
+import threading
+import time
+import numpy as np
+
+from .utils import read_json
+
+# %% Binary trial format
+#
+# A .trial file contains:
+#   - 8 magic bytes and the header length (uint64, little endian)
+#   - a JSON header with the trial metadata (the same keys as a trial_N.json),
+#     the channel names, the sample dtype and the number of samples
+#   - the samples of every channel as one contiguous array, channel after
+#     channel, starting at an offset that is a multiple of 64 bytes
+#
+# The sample block can be opened with np.memmap, so any time range of a trial
+# can be read without loading the whole file.
+
+MAGIC = b"MAFTRIAL"
+FORMAT_VERSION = 1
+DATA_ALIGNMENT = 64
+CHANNEL_NAMES = ("dataAI0", "dataAI1")
+
+
+def save_trial(filename, channelData, metadata, channelNames=CHANNEL_NAMES):
+    """
+    Save samples with shape (nChannels, nSamples) and a dictionary with
+    metadata as a binary .trial file.
+    """
+
+    channelData = np.ascontiguousarray(channelData)
+    if channelData.shape[0] != len(channelNames):
+        raise ValueError("Number of channel names does not match the data")
+
+    header = dict(metadata)
+    header.update({
+        "formatVersion": FORMAT_VERSION,
+        "channels": list(channelNames),
+        "dtype": channelData.dtype.str,
+        "nSamples": channelData.shape[1],
+    })
+
+    headerBytes = _pad_header(json.dumps(header).encode("utf-8"))
+
+    with open(filename, "wb") as outfile:
+        outfile.write(MAGIC)
+        outfile.write(np.uint64(len(headerBytes)).tobytes())
+        outfile.write(headerBytes)
+        outfile.write(channelData.tobytes())
+
+
+def _pad_header(headerBytes):
+
+    # pad with spaces (still valid JSON) so the samples start aligned
+    headerEnd = len(MAGIC) + 8 + len(headerBytes)
+    padding = -headerEnd % DATA_ALIGNMENT
+    return headerBytes + b" " * padding
+
+
+def read_trial_header(filename):
+    """Returns the header of a .trial file and the offset of the samples."""
+
+    with open(filename, "rb") as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a trial file")
+
+        headerLength = int(np.frombuffer(infile.read(8), dtype="<u8")[0])
+        header = json.loads(infile.read(headerLength).decode("utf-8"))
+
+    return header, len(MAGIC) + 8 + headerLength
+
+
+def open_trial_samples(filename, mode="r"):
+    """
+    Memory-map the samples of a .trial file. Returns the header and an array
+    with shape (nChannels, nSamples) that is only read from disk when sliced.
+    """
+
+    header, offset = read_trial_header(filename)
+    shape = (len(header["channels"]), header["nSamples"])
+
+    if header["nSamples"] == 0:
+        return header, np.empty(shape, dtype=header["dtype"])
+
+    samples = np.memmap(filename, dtype=header["dtype"], mode=mode,
+                        offset=offset, shape=shape)
+
+    return header, samples
+
+
+def load_trial(filename, start=0, stop=None, mmap=True):
+    """
+    Load a trial from a .trial file, a compressed .trialz archive (see
+    codec.py) or an old trial_N.json file.
+
+    Returns a dictionary with the same keys as the JSON files. The channels
+    ('dataAI0', 'dataAI1', ...) are numpy arrays holding samples [start, stop).
+    For .trial files these are memory-mapped views unless mmap is False.
+    """
+
+    if filename.endswith(".json"):
+        trial = read_json(filename)
+        channelNames = [key for key in CHANNEL_NAMES if key in trial]
+        for key in channelNames:
+            trial[key] = np.asarray(trial[key], dtype=float)[start:stop]
+        trial["channels"] = channelNames
+        return trial
+
+    if filename.endswith(".trialz"):
+        from .codec import read_compressed_trial
+        trial, channelData = read_compressed_trial(filename)
+        for channel, key in enumerate(trial["channels"]):
+            trial[key] = channelData[channel, start:stop]
+        return trial
+
+    header, samples = open_trial_samples(filename)
+    trial = dict(header)
+    for channel, key in enumerate(header["channels"]):
+        channelSamples = samples[channel, start:stop]
+        trial[key] = channelSamples if mmap else np.array(channelSamples)
+
+    return trial
+
+# %% Finding and converting trials
+
+
+def trial_number(filename):
+
+    match = re.search(r"trial_(\d+)\.", os.path.basename(filename))
+    return int(match.group(1)) if match else -1
+
+
+def find_trials(folder="measurement_files"):
+    """
+    Find all trials in folder/<participant>/. When a trial exists in more
+    than one format the .trial file is used, then the .trialz archive.
+    Returns a sorted list of filenames.
+    """
+
+    trials = {}
+    for extension in (".json", ".trialz", ".trial"):
+        for filename in glob.glob(os.path.join(folder, "*", "trial_*" + extension)):
+            trials[os.path.splitext(filename)[0]] = filename
+
+    return sorted(trials.values(),
+                  key=lambda filename: (os.path.dirname(filename), trial_number(filename)))
+
+
+def convert_json_trial(jsonFilename, removeJson=False):
+    """Convert one trial_N.json file to trial_N.trial. Returns the new filename."""
+
+    trial = read_json(jsonFilename)
+    channelNames = [key for key in CHANNEL_NAMES if key in trial]
+    channelData = np.array([trial.pop(key) for key in channelNames], dtype=float)
+
+    trialFilename = os.path.splitext(jsonFilename)[0] + ".trial"
+    save_trial(trialFilename, channelData, trial, channelNames)
+
+    # check the conversion before the original is removed
+    converted = load_trial(trialFilename)
+    for channel, key in enumerate(channelNames):
+        if not np.array_equal(converted[key], channelData[channel]):
+            raise RuntimeError(f"Conversion of {jsonFilename} is not lossless")
+
+    if removeJson:
+        os.remove(jsonFilename)
+
+    return trialFilename
+
+
+def convert_json_trials(folder="measurement_files", removeJson=False):
+    """
+    Convert all trial_N.json files in folder/<participant>/ to .trial files.
+    Trials that already have an up-to-date .trial file are skipped.
+    """
+
+    converted = []
+    for jsonFilename in sorted(glob.glob(os.path.join(folder, "*", "trial_*.json"))):
+        trialFilename = os.path.splitext(jsonFilename)[0] + ".trial"
+        if os.path.exists(trialFilename) and \
+                os.path.getmtime(trialFilename) >= os.path.getmtime(jsonFilename):
+            continue
+
+        converted.append(convert_json_trial(jsonFilename, removeJson))
+        print(f"Converted '{jsonFilename}' to '{trialFilename}'")
+
+    return converted
+
+# %% Incremental trial writer
+#
+# During acquisition the samples are appended to a journal (trial_N.partial):
+#   - 8 magic bytes, the header length (uint64) and a JSON header with the
+#     metadata known at the start of the trial
+#   - one record per acquired block: the number of samples (uint32) followed
+#     by the block with shape (nChannels, nSamples)
+# When the trial ends the journal is turned into trial_N.trial and removed.
+# After a crash recover_trial() rebuilds a trial from the complete records.
+
+JOURNAL_MAGIC = b"MAFJRNL1"
+
+
+class TrialWriter:
+    """
+    Writes acquired blocks to a journal file in a background thread.
+
+    put() only copies the block into a bounded queue and never waits for the
+    disk, so it can be called from the DAQ read loop. The writer thread drains
+    the queue and calls fsync at most every fsyncInterval seconds. When the
+    queue is full the block is not journaled and droppedBlocks is increased;
+    the caller then has to pass the samples to close(). Every writer must be
+    finished with close() or abort(), the writer thread runs until then.
+    """
+
+    def __init__(self, filename, metadata, channelNames=CHANNEL_NAMES,
+                 dtype=np.float64, maxQueueBlocks=2000, fsyncInterval=1.0):
+
+        self.filename = filename
+        self.journalFilename = os.path.splitext(filename)[0] + ".partial"
+        self.channelNames = list(channelNames)
+        self.dtype = np.dtype(dtype)
+        self.fsyncInterval = fsyncInterval
+
+        self.droppedBlocks = 0
+        self.writtenSamples = 0
+
+        self._queue = queue.Queue(maxsize=maxQueueBlocks)
+        self._final = None
+
+        header = dict(metadata)
+        header.update({
+            "formatVersion": FORMAT_VERSION,
+            "channels": self.channelNames,
+            "dtype": self.dtype.str,
+        })
+        self._journal = open(self.journalFilename, "wb")
+        headerBytes = json.dumps(header).encode("utf-8")
+        self._journal.write(JOURNAL_MAGIC)
+        self._journal.write(np.uint64(len(headerBytes)).tobytes())
+        self._journal.write(headerBytes)
+
+        # not a daemon thread: a trial that is being finalized is completed
+        # before the interpreter exits
+        self._thread = threading.Thread(target=self._run, name="TrialWriter")
+        self._thread.start()
+
+    def put(self, block):
+        """Queue a block with shape (nChannels, nSamples) without blocking."""
+
+        try:
+            self._queue.put_nowait(np.array(block, dtype=self.dtype))
+        except queue.Full:
+            self.droppedBlocks += 1
+
+    def close(self, metadata, channelData=None, wait=False, onSaved=None):
+        """
+        Finish the trial: the journal is written out as a .trial file with the
+        given metadata. If blocks were dropped, channelData (all samples of the
+        trial) is saved instead of the journal. onSaved(filename) is called in
+        the writer thread once the .trial file exists (e.g. to update the
+        catalog, see catalog.py).
+        """
+
+        self._final = (metadata, channelData, onSaved)
+        self._queue.put(None)
+
+        if wait:
+            self._thread.join()
+
+    def abort(self, wait=True):
+        """
+        Stop the writer without finishing the trial, e.g. after an error
+        during the trial. The journal stays on disk, so recover_trials() can
+        rebuild the trial from it.
+        """
+
+        self._final = None
+        self._queue.put(None)
+
+        if wait:
+            self._thread.join()
+
+    def _run(self):
+
+        lastSync = time.time()
+
+        while True:
+            try:
+                block = self._queue.get(timeout=self.fsyncInterval)
+            except queue.Empty:
+                block = False
+
+            if block is None:
+                break
+
+            if block is not False:
+                self._journal.write(np.uint32(block.shape[1]).tobytes())
+                self._journal.write(block.tobytes())
+                self.writtenSamples += block.shape[1]
+
+            if time.time() - lastSync >= self.fsyncInterval:
+                self._sync()
+                lastSync = time.time()
+
+        self._sync()
+        self._journal.close()
+
+        if self._final is None:
+            print(f"Trial not finished, samples kept in '{self.journalFilename}'")
+            return
+
+        metadata, channelData, onSaved = self._final
+        if channelData is None:
+            if self.droppedBlocks:
+                print(f"Warning: {self.droppedBlocks} block(s) missing in "
+                      f"'{self.journalFilename}', trial not finalized")
+                return
+            _, channelData = read_journal(self.journalFilename)
+
+        save_trial(self.filename, channelData, metadata, self.channelNames)
+        os.remove(self.journalFilename)
+
+        if onSaved is not None:
+            try:
+                onSaved(self.filename)
+            except Exception as error:
+                print(f"Warning: '{self.filename}' saved, but {error!r}")
+
+    def _sync(self):
+
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+
+def read_journal(journalFilename):
+    """
+    Read the header and all complete blocks of a journal. A block that was
+    only partly written (crash during a write) is ignored.
+    """
+
+    with open(journalFilename, "rb") as infile:
+        if infile.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            raise ValueError(f"{journalFilename} is not a trial journal")
+
+        headerLength = int(np.frombuffer(infile.read(8), dtype="<u8")[0])
+        header = json.loads(infile.read(headerLength).decode("utf-8"))
+        records = infile.read()
+
+    nChannels = len(header["channels"])
+    dtype = np.dtype(header["dtype"])
+
+    blocks = []
+    position = 0
+    while position + 4 <= len(records):
+        nSamples = int(np.frombuffer(records, dtype="<u4", count=1, offset=position)[0])
+        blockBytes = nChannels * nSamples * dtype.itemsize
+        if position + 4 + blockBytes > len(records):
+            break
+
+        blocks.append(np.frombuffer(records, dtype=dtype, count=nChannels * nSamples,
+                                    offset=position + 4).reshape(nChannels, nSamples))
+        position += 4 + blockBytes
+
+    channelData = np.concatenate(blocks, axis=1) if blocks else \
+        np.empty((nChannels, 0), dtype=dtype)
+
+    return header, channelData
+
+
+def recover_trial(journalFilename, removeJournal=True):
+    """
+    Rebuild a .trial file from the journal of a trial that was not finished.
+    Returns the filename of the recovered trial.
+    """
+
+    header, channelData = read_journal(journalFilename)
+    channelNames = header.pop("channels")
+    for key in ("formatVersion", "dtype"):
+        header.pop(key, None)
+    header["recovered"] = True
+
+    trialFilename = os.path.splitext(journalFilename)[0] + ".trial"
+    save_trial(trialFilename, channelData, header, channelNames)
+
+    if removeJournal:
+        os.remove(journalFilename)
+
+    print(f"Recovered {channelData.shape[1]} samples from '{journalFilename}'")
+
+    return trialFilename
+
+
+def recover_trials(folder="measurement_files"):
+    """Recover all unfinished trials (trial_N.partial) in folder/<participant>/."""
+
+    return [recover_trial(journalFilename) for journalFilename in
+            sorted(glob.glob(os.path.join(folder, "*", "trial_*.partial")))]
@@ -1,14 +1,10 @@
 # utils.py
 
 # %% imports
+# pandas and tkinter are imported in the functions that use them,
+# so importing the toolbox stays fast (see benchmarks/import_benchmark.py)
 import json
-import numpy as np
-import wave
-import sounddevice as sd
 import os
-import pandas as pd
-import tkinter as tk
-from tkinter.filedialog import askopenfilename
 
 # %% Utility functions
 
@@ -21,21 +17,6 @@ def read_json(filename):
     return (json_data)
 
 
-def play_sound(metronomeFile):
-
-    fullMetronomeFile = f"metronome_files/{metronomeFile}"
-
-    with wave.open(fullMetronomeFile, 'rb') as wav_file:
-        sample_rate = wav_file.getframerate()
-        channels = wav_file.getnchannels()
-        dtype = np.int16
-        frames = wav_file.readframes(wav_file.getnframes())
-        audio_data = np.frombuffer(frames, dtype=dtype)
-        if channels > 1:
-            audio_data = np.reshape(audio_data, (-1, channels))
-        sd.play(audio_data, samplerate=sample_rate, loop=True)
-
-
 def check_nidaqmx_connected():
 
     import nidaqmx.system
@@ -63,6 +44,10 @@ def check_callibration_available():
 
 def get_excel_settings():
 
+    import pandas as pd
+    import tkinter as tk
+    from tkinter.filedialog import askopenfilename
+
     root = tk.Tk()
     root.attributes('-topmost', True)
     root.withdraw()
@@ -73,3 +58,15 @@ def get_excel_settings():
     dfExcel.columns = dfExcel.columns.str.replace(" ", "_")
 
     return dfExcel
+
+
+def excel_trial_settings(excelSettings, excelIndex):
+
+    # measurement settings of one row of the Excel file
+    return {
+        "rightTarget": float(excelSettings.loc[excelIndex, "Target_Right_Limb"]),
+        "leftTarget": float(excelSettings.loc[excelIndex, "Target_Left_Limb"]),
+        "duration": float(excelSettings.loc[excelIndex, "Trial_Duration"]),
+        "metronomeDuration": float(excelSettings.loc[excelIndex, "Metronome_Duration"]),
+        "metronomeFile": str(excelSettings.loc[excelIndex, "Metronome_Filename"]),
+    }
@@ -0,0 +1,35 @@
+# test_cycle_statistics.py
+#
+# Run from the root of the toolbox:
+#   python -m pytest tests
+
+# %% imports
+import numpy as np
+
+from measurement_toolbox.cycle_statistics import CycleStatistics
+
+# %% Tests
+
+
+def test_summary_of_one_cycle(capsys):
+
+    # one cycle has a mean but no SD, CV or period
+    statistics = CycleStatistics(2, 300, [1.0, 2.0], 0.5)
+    statistics.update(np.array([0]), np.array([100]), np.array([1.1]))
+    statistics.print_summary(["right", "left"])
+
+    output = capsys.readouterr().out
+    assert "nan" not in output.lower()
+    assert "right: mean = 1.1, RMS error = 0.1, 100% on target (1 cycle)" in output
+    assert "left: no cycles" in output
+
+
+def test_summary_of_two_cycles(capsys):
+
+    statistics = CycleStatistics(1, 300, [1.0], 0.5)
+    statistics.update(np.array([0, 0]), np.array([100, 400]), np.array([1.0, 1.2]))
+    statistics.print_summary(["right"])
+
+    output = capsys.readouterr().out
+    assert "nan" not in output.lower()
+    assert "period = 1.00 s" in output
@@ -0,0 +1,89 @@
+# test_detection.py
+#
+# Run from the root of the toolbox:
+#   python -m pytest tests
+
+# %% imports
+import numpy as np
+import pytest
+
+from measurement_toolbox.detection import (NOISE_WINDOW, THRESHOLD, adaptive_threshold,
+                                           detect_recording, slope_lag)
+from measurement_toolbox.filters import LowPassFilter
+from measurement_toolbox.sources import SimulatedSource
+
+# %% Settings
+
+SAMPLE_FREQUENCY = 300
+BASELINE_DURATION = 2.0
+TRIAL_DURATION = 10.0
+MOVEMENT_FREQUENCY = 1.5
+
+
+def simulated_signal(amplitude, duration, seed=1):
+
+    # quantized like the 14-bit ADC of the USB-6009
+    source = SimulatedSource(2, frequency=MOVEMENT_FREQUENCY, amplitude=amplitude,
+                             noise=0.002, resolution=20 / 2**14, seed=seed)
+    source.configure(SAMPLE_FREQUENCY, 5)
+    source.start()
+    return source.signal(np.arange(int(duration * SAMPLE_FREQUENCY)))
+
+
+def threshold_from_baseline(baseline):
+
+    # as OnlineAnalysis.set_adaptive_threshold
+    return adaptive_threshold(baseline, LowPassFilter(2, SAMPLE_FREQUENCY),
+                              slope_lag(SAMPLE_FREQUENCY),
+                              round(NOISE_WINDOW * SAMPLE_FREQUENCY))
+
+
+def count_cycles(channelData, threshold):
+
+    result = detect_recording(channelData, SAMPLE_FREQUENCY, threshold=threshold,
+                              prefilter=LowPassFilter(2, SAMPLE_FREQUENCY))
+    return np.bincount(result.cycleChannels, minlength=channelData.shape[0])
+
+# %% Tests
+
+
+@pytest.mark.parametrize("amplitude", [1.0, 0.5, 0.3])
+def test_moving_baseline(amplitude):
+
+    # the participant already moves with the metronome before space is pressed
+    signal = simulated_signal(amplitude, BASELINE_DURATION + TRIAL_DURATION)
+    baselineSamples = int(BASELINE_DURATION * SAMPLE_FREQUENCY)
+    threshold, noise = threshold_from_baseline(signal[:, :baselineSamples])
+
+    assert np.all(threshold == THRESHOLD)
+    assert np.all(np.isnan(noise))
+
+    # one cycle per movement period, give or take the first and the last
+    nCycles = count_cycles(signal[:, baselineSamples:], threshold)
+    assert np.all(nCycles >= MOVEMENT_FREQUENCY * TRIAL_DURATION - 2)
+
+
+def test_resting_baseline():
+
+    # noise and flipping ADC levels alone give no cycles
+    rest = simulated_signal(0.0, BASELINE_DURATION + TRIAL_DURATION, seed=2)
+    baselineSamples = int(BASELINE_DURATION * SAMPLE_FREQUENCY)
+    threshold, noise = threshold_from_baseline(rest[:, :baselineSamples])
+
+    assert np.all(threshold < THRESHOLD)
+    assert np.all(threshold >= 4 * 20 / 2**14)
+    assert np.all(np.isfinite(noise))
+    assert np.all(count_cycles(rest[:, baselineSamples:], threshold) == 0)
+
+
+def test_baseline_partly_at_rest():
+
+    # half a second at rest is enough for the noise
+    movement = simulated_signal(0.5, BASELINE_DURATION)
+    rest = simulated_signal(0.0, BASELINE_DURATION, seed=2)
+    baseline = np.concatenate([rest[:, :SAMPLE_FREQUENCY], movement[:, SAMPLE_FREQUENCY:]],
+                              axis=1)
+    threshold, noise = threshold_from_baseline(baseline)
+
+    assert np.all(threshold < THRESHOLD)
+    assert np.all(np.isfinite(noise))